@@ -43,6 +43,12 @@ if __name__ == '__main__':
                              "Default 10.")
     parser.add_argument("--startTime", type=float, default=59853,
                         help="Time at start of survey (to set time for summary metrics).")
+    parser.add_argument("--chunkSize", type=int, default=None,
+                        help="Read the observations in chunks of (about) this many observations, "
+                             "rather than all at once. The observations of each object must be grouped "
+                             "together in obsFile. Default None (read all at once).")
+    parser.add_argument("--nProcs", type=int, default=1,
+                        help="Number of processes to use to calculate the metric values. Default 1.")
     args = parser.parse_args()
 
     if args.orbitFile is None:
@@ -79,14 +85,14 @@ if __name__ == '__main__':
         # Use the default (currently, v4).
         colmap = batches.ColMapDict()
 
-    slicer = batches.setupMoSlicer(args.orbitFile, Hrange, obsFile=args.obsFile)
+    slicer = batches.setupMoSlicer(args.orbitFile, Hrange, obsFile=args.obsFile, chunkSize=args.chunkSize)
     # Run discovery metrics using 'trailing' losses
     bdictT, pbundleT = batches.quickDiscoveryBatch(slicer, colmap=colmap, runName=args.opsimRun,
                                                  metadata=args.metadata, detectionLosses='trailing',
                                                  albedo=args.albedo, Hmark=args.hMark)
     # Run these discovery metrics
     print("Calculating quick discovery metrics with simple trailing losses.")
-    bg = mmb.MoMetricBundleGroup(bdictT, outDir=args.outDir, resultsDb=resultsDb)
+    bg = mmb.MoMetricBundleGroup(bdictT, outDir=args.outDir, resultsDb=resultsDb, nProcs=args.nProcs)
     bg.runAll()
 
     # Run all discovery metrics using 'detection' losses
@@ -102,7 +108,7 @@ if __name__ == '__main__':
 
     # Run these discovery metrics
     print("Calculating full discovery metrics with detection losses.")
-    bg = mmb.MoMetricBundleGroup(bdictD, outDir=args.outDir, resultsDb=resultsDb)
+    bg = mmb.MoMetricBundleGroup(bdictD, outDir=args.outDir, resultsDb=resultsDb, nProcs=args.nProcs)
     bg.runAll()
 
     # Run all characterization metrics
@@ -116,7 +122,7 @@ if __name__ == '__main__':
                                                              Hmark=args.hMark, constraint=None)
     # Run these characterization metrics
     print("Calculating characterization metrics.")
-    bg = mmb.MoMetricBundleGroup(bdictC, outDir=args.outDir, resultsDb=resultsDb)
+    bg = mmb.MoMetricBundleGroup(bdictC, outDir=args.outDir, resultsDb=resultsDb, nProcs=args.nProcs)
     bg.runAll()
 
     if args.opsimDb is not None:
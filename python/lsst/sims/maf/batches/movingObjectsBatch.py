@@ -66,7 +66,7 @@ def defaultCharacterization(metadata):
     return char
 
 
-def setupMoSlicer(orbitFile, Hrange, obsFile=None):
+def setupMoSlicer(orbitFile, Hrange, obsFile=None, chunkSize=None):
     """
     Set up the slicer and read orbitFile and obsFile from disk.
 
@@ -79,6 +79,9 @@ def setupMoSlicer(orbitFile, Hrange, obsFile=None):
     obsFile : str, optional
         The file containing the observations of each object, optional.
         If not provided (default, None), then the slicer will not be able to 'slice', but can still plot.
+    chunkSize : int, optional
+        If set, stream the observations in chunks of (about) chunkSize observations of whole objects,
+        rather than reading them all at once. Default None.
 
     Returns
     -------
@@ -86,7 +89,7 @@ def setupMoSlicer(orbitFile, Hrange, obsFile=None):
     """
     # Read the orbit file and set the H values for the slicer.
     slicer = slicers.MoObjSlicer(Hrange=Hrange)
-    slicer.setupSlicer(orbitFile=orbitFile, obsFile=obsFile)
+    slicer.setupSlicer(orbitFile=orbitFile, obsFile=obsFile, chunkSize=chunkSize)
     return slicer
 
 
@@ -4,3 +4,4 @@ from .resultsDb import *
 from .trackingDb import *
 from .sdssDatabase import *
 from .dbObj import *
+from .sqlConstraintMask import *
@@ -1,6 +1,7 @@
 from __future__ import print_function
 from future.utils import with_metaclass
 import os
+import time
 import inspect
 import numpy as np
 from sqlalchemy import func, text, column
@@ -179,7 +180,7 @@ class Database(with_metaclass(DatabaseRegistry, DBObject)):
         return self.execute_arbitrary(sqlQuery, dtype=dtype)
 
     def query_columns(self, tablename, colnames=None, sqlconstraint=None,
-                      groupBy=None, numLimit=None, chunksize=1000000):
+                      groupBy=None, numLimit=None, chunksize=100000):
         """Query a table in the database and return data from colnames in recarray.
 
         Parameters
@@ -196,6 +197,9 @@ class Database(with_metaclass(DatabaseRegistry, DBObject)):
             Number of records to return. Default no limit.
         chunksize : int, opt
             Query database and convert to recarray in series of chunks of chunksize.
+            The rows are counted first, and each chunk is converted straight into the (preallocated)
+            returned array, so only one chunk of query results is held in memory at a time.
+            If None or 0, all of the results are fetched and converted at once. Default 100000.
 
         Returns
         -------
@@ -224,24 +228,47 @@ class Database(with_metaclass(DatabaseRegistry, DBObject)):
                 pass
             dtype.append((str(col).replace('"', ''),) + dt)
 
-        # Execute query on database.
-        exec_query = self.connection.session.execute(query)
-
+        startTime = time.time()
         if chunksize is None or chunksize == 0:
-            # Fetch all results and convert to numpy recarray.
-            results = exec_query.fetchall()
+            # Execute query on database, fetch all results and convert to numpy recarray.
+            results = self.connection.session.execute(query).fetchall()
             data = self._convert_results(results, dtype)
         else:
-            chunks = []
-            # Loop through results, converting in steps of chunksize.
-            results = exec_query.fetchmany(chunksize)
-            while len(results) > 0:
-                chunks.append(self._convert_results(results, dtype))
-                results = exec_query.fetchmany(chunksize)
-            if len(chunks) == 0:
-                data = np.recarray((0,), dtype=dtype)
-            else:
-                data = np.hstack(chunks)
+            data = self._fetchChunks(query, dtype, chunksize)
+        if self.verbose:
+            dt = time.time() - startTime
+            print('Fetched %d rows from %s in %.2f s (%.0f rows/s).'
+                  % (len(data), tablename_str, dt, len(data) / max(dt, 1e-9)))
+        return data
+
+    def _fetchChunks(self, query, dtype, chunksize):
+        """Execute query, filling a preallocated recarray with the results in chunks of chunksize rows.
+
+        Parameters
+        ----------
+        query : sqlalchemy.orm.Query
+            The query to execute.
+        dtype : list of tuples
+            The dtype of the returned recarray.
+        chunksize : int
+            The number of rows to fetch and convert at a time.
+
+        Returns
+        -------
+        numpy.recarray
+        """
+        # Count the rows first, so that the results can go straight into the final array.
+        nrows = query.count()
+        data = np.recarray((nrows,), dtype=dtype)
+        nfilled = 0
+        for chunk in self.get_chunk_iterator(query, chunk_size=chunksize, dtype=np.dtype(dtype)):
+            if nfilled + len(chunk) > len(data):
+                # More rows than counted (the table changed in between): grow the array.
+                data = np.resize(data, nfilled + len(chunk)).view(np.recarray)
+            data[nfilled:nfilled + len(chunk)] = chunk
+            nfilled += len(chunk)
+        if nfilled < len(data):
+            data = data[:nfilled].copy()
         return data
 
     def _build_query(self, tablename, colnames, sqlconstraint=None, groupBy=None, numLimit=None):
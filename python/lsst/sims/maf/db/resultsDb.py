@@ -1,12 +1,14 @@
 from builtins import str
 from builtins import object
 import os, warnings
-from sqlalchemy import create_engine
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Float
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, and_, bindparam
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.exc import DatabaseError
 
@@ -31,6 +33,9 @@ class MetricRow(Base):
     sqlConstraint = Column(String)
     metricMetadata = Column(String)
     metricDataFile = Column(String)
+    # Index the columns used to look up a metric (in updateMetric).
+    __table_args__ = (Index('idx_metrics_lookup', 'metricName', 'slicerName', 'simDataName',
+                            'metricMetadata', 'sqlConstraint'),)
     def __repr__(self):
         return "<Metric(metricId='%d', metricName='%s', slicerName='%s', simDataName='%s', " \
                "sqlConstraint='%s', metadata='%s', metricDataFile='%s')>" \
@@ -55,6 +60,7 @@ class DisplayRow(Base):
     # The figure caption.
     displayCaption = Column(String)
     metric = relationship("MetricRow", backref=backref('displays', order_by=displayId))
+    __table_args__ = (Index('idx_displays_metricId', 'metricId'),)
     def __rep__(self):
         return "<Display(displayGroup='%s', displaySubgroup='%s', " \
                "displayOrder='%.1f', displayCaption='%s')>" \
@@ -73,7 +79,12 @@ class PlotRow(Base):
     metricId = Column(Integer, ForeignKey('metrics.metricId'))
     plotType = Column(String)
     plotFile = Column(String)
+    # Fingerprint of the metric values and plot configuration the plot was made from (see PlotHandler).
+    plotFingerprint = Column(String)
+    # The time taken to make and save the plot (seconds).
+    renderTime = Column(Float)
     metric = relationship("MetricRow", backref=backref('plots', order_by=plotId))
+    __table_args__ = (Index('idx_plots_metricId', 'metricId', 'plotType', 'plotFile'),)
     def __repr__(self):
         return "<Plot(metricId='%d', plotType='%s', plotFile='%s')>" \
           %(self.metricId, self.plotType, self.plotFile)
@@ -93,6 +104,7 @@ class SummaryStatRow(Base):
     summaryName = Column(String)
     summaryValue = Column(Float)
     metric = relationship("MetricRow", backref=backref('summarystats', order_by=statId))
+    __table_args__ = (Index('idx_summarystats_metricId', 'metricId'),)
     def __repr__(self):
         return "<SummaryStat(metricId='%d', summaryName='%s', summaryValue='%f')>" \
           %(self.metricId, self.summaryName, self.summaryValue)
@@ -100,6 +112,10 @@ class SummaryStatRow(Base):
 class ResultsDb(object):
     """The ResultsDb is a sqlite database containing information on the metrics run via MAF,
     the plots created, the display information (such as captions), and any summary statistics output.
+
+    Each update method normally commits its change immediately. Inside a batchWrites() block, the
+    changes are instead collected in memory and written in a single transaction when the block ends
+    (or when flushWrites is called), which is much faster when writing many metrics and plots.
     """
     def __init__(self, outDir= None, database=None, verbose=False):
         """
@@ -138,7 +154,95 @@ class ResultsDb(object):
         except DatabaseError:
             raise ValueError("Cannot create a %s database at %s. Check directory exists." %(self.driver,
                                                                                             self.database))
+        # Find the columns and indexes missing from tables created by older versions (create_all skips
+        #  existing tables). These are only added before the first write (see _migrate), so that reading
+        #  an older (possibly read-only) database does not change it.
+        inspector = inspect(engine)
+        self._missingColumns = []
+        self._missingIndexes = []
+        for table in Base.metadata.sorted_tables:
+            columns = set(c['name'] for c in inspector.get_columns(table.name))
+            self._missingColumns += [column for column in table.columns if column.name not in columns]
+            indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+            self._missingIndexes += [index for index in table.indexes if index.name not in indexes]
         self.slen = 1024
+        # The pending writes, when batching writes (None otherwise).
+        self._batch = None
+
+    def _hasColumn(self, tableName, columnName):
+        """Return True if the column exists in the database (it may be missing from an older database)."""
+        return (tableName, columnName) not in [(c.table.name, c.name) for c in self._missingColumns]
+
+    def _migrate(self):
+        """Add any columns and indexes missing from an older database, before writing to it."""
+        if len(self._missingColumns) == 0 and len(self._missingIndexes) == 0:
+            return
+        connection = self.session.connection()
+        for column in self._missingColumns:
+            connection.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s %s'
+                                       % (column.table.name, column.name,
+                                          column.type.compile(connection.dialect)))
+        for index in self._missingIndexes:
+            index.create(connection)
+        self.session.commit()
+        self._missingColumns = []
+        self._missingIndexes = []
+
+    @contextmanager
+    def batchWrites(self):
+        """Collect the changes made by the update methods within this block, and write them to
+        the database in one transaction at the end of the block.
+
+        The metricIds returned by updateMetric are valid immediately. Nested blocks are written
+        when the outermost block ends. Queries (such as getSummaryStats) within the block do not
+        see the pending displays, plots or summary statistics.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._migrate()
+        # Look up the existing metrics and displays once, rather than querying for each update.
+        metricIds = {}
+        for m in self.session.query(MetricRow):
+            key = (m.metricName, m.slicerName, m.simDataName, m.metricMetadata, m.sqlConstraint)
+            metricIds.setdefault(key, m.metricId)
+        displayIds = set(d.metricId for d in self.session.query(DisplayRow.metricId))
+        self._batch = {'metricIds': metricIds, 'displayIds': displayIds,
+                       'displays': OrderedDict(), 'plots': OrderedDict(), 'summarystats': []}
+        try:
+            yield self
+            self.flushWrites()
+        except BaseException:
+            self.session.rollback()
+            raise
+        finally:
+            self._batch = None
+
+    def flushWrites(self):
+        """Write any pending (batched) changes to the database, in a single transaction."""
+        if self._batch is None:
+            return
+        batch = self._batch
+        displays = list(batch['displays'].values())
+        if len(displays) > 0:
+            delete = DisplayRow.__table__.delete().where(DisplayRow.metricId == bindparam('b_metricId'))
+            self.session.execute(delete, [{'b_metricId': d['metricId']} for d in displays])
+            self.session.bulk_insert_mappings(DisplayRow, displays)
+        plots = list(batch['plots'].values())
+        if len(plots) > 0:
+            delete = PlotRow.__table__.delete().where(and_(PlotRow.metricId == bindparam('b_metricId'),
+                                                           PlotRow.plotType == bindparam('b_plotType'),
+                                                           PlotRow.plotFile == bindparam('b_plotFile')))
+            self.session.execute(delete, [{'b_metricId': p['metricId'], 'b_plotType': p['plotType'],
+                                           'b_plotFile': p['plotFile']} for p in plots])
+            self.session.bulk_insert_mappings(PlotRow, plots)
+        if len(batch['summarystats']) > 0:
+            self.session.bulk_insert_mappings(SummaryStatRow, batch['summarystats'])
+        self.session.commit()
+        batch['displayIds'].update(batch['displays'].keys())
+        batch['displays'] = OrderedDict()
+        batch['plots'] = OrderedDict()
+        batch['summarystats'] = []
 
     def close(self):
         """
@@ -163,6 +267,7 @@ class ResultsDb(object):
 
         Returns metricId: the Id number of this metric in the metrics table.
         """
+        self._migrate()
         if simDataName is None:
             simDataName = 'NULL'
         if sqlConstraint is None:
@@ -171,6 +276,19 @@ class ResultsDb(object):
             metricMetadata = 'NULL'
         if metricDataFile is None:
             metricDataFile = 'NULL'
+        if self._batch is not None:
+            key = (metricName, slicerName, simDataName, metricMetadata, sqlConstraint)
+            metricId = self._batch['metricIds'].get(key)
+            if metricId is None:
+                metricinfo = MetricRow(metricName=metricName, slicerName=slicerName, simDataName=simDataName,
+                                       sqlConstraint=sqlConstraint, metricMetadata=metricMetadata,
+                                       metricDataFile=metricDataFile)
+                self.session.add(metricinfo)
+                # Flush (without committing) to assign the metricId.
+                self.session.flush()
+                metricId = metricinfo.metricId
+                self._batch['metricIds'][key] = metricId
+            return metricId
         # Check if metric has already been added to database.
         prev = self.session.query(MetricRow).filter_by(metricName=metricName,
                                                        slicerName=slicerName,
@@ -196,15 +314,22 @@ class ResultsDb(object):
 
         Replaces existing row with same metricId.
         """
+        self._migrate()
         # Because we want to maintain 1-1 relationship between metricId's and displayDict's:
         # First check if a display line is present with this metricID.
-        displayinfo = self.session.query(DisplayRow).filter_by(metricId=metricId).all()
-        if len(displayinfo) > 0:
-            if overwrite:
-                for d in displayinfo:
-                    self.session.delete(d)
-            else:
+        batch = self._batch
+        if batch is not None:
+            # (The existing display rows are replaced when the batch is written).
+            if not overwrite and (metricId in batch['displayIds'] or metricId in batch['displays']):
                 return
+        else:
+            displayinfo = self.session.query(DisplayRow).filter_by(metricId=metricId).all()
+            if len(displayinfo) > 0:
+                if overwrite:
+                    for d in displayinfo:
+                        self.session.delete(d)
+                else:
+                    return
         # Then go ahead and add new displayDict.
         for k in displayDict:
             if displayDict[k] is None:
@@ -221,28 +346,43 @@ class ResultsDb(object):
         displayCaption = displayDict['caption']
         if displayCaption.endswith('(auto)'):
             displayCaption = displayCaption.replace('(auto)', '', 1)
+        if batch is not None:
+            batch['displays'][metricId] = dict(metricId=metricId,
+                                               displayGroup=displayGroup, displaySubgroup=displaySubgroup,
+                                               displayOrder=displayOrder, displayCaption=displayCaption)
+            return
         displayinfo = DisplayRow(metricId=metricId,
                                  displayGroup=displayGroup, displaySubgroup=displaySubgroup,
                                  displayOrder=displayOrder, displayCaption=displayCaption)
         self.session.add(displayinfo)
         self.session.commit()
 
-    def updatePlot(self, metricId, plotType, plotFile):
+    def updatePlot(self, metricId, plotType, plotFile, plotFingerprint=None, renderTime=None):
         """
         Add a row to or update a row in the plot table.
 
         - metricId: the metric Id of this metric in the metrics table
         - plotType: the 'type' of this plot
         - plotFile: the filename of this plot
+        - plotFingerprint: the fingerprint of the inputs to this plot (optional)
+        - renderTime: the time taken to make this plot, in seconds (optional)
 
         Remove older rows with the same metricId, plotType and plotFile.
         """
+        self._migrate()
+        if self._batch is not None:
+            self._batch['plots'][(metricId, plotType, plotFile)] = dict(metricId=metricId, plotType=plotType,
+                                                                        plotFile=plotFile,
+                                                                        plotFingerprint=plotFingerprint,
+                                                                        renderTime=renderTime)
+            return
         plotinfo = self.session.query(PlotRow).filter_by(metricId=metricId, plotType=plotType,
                                                          plotFile=plotFile).all()
         if len(plotinfo) > 0:
             for p in plotinfo:
                 self.session.delete(p)
-        plotinfo = PlotRow(metricId=metricId, plotType=plotType, plotFile=plotFile)
+        plotinfo = PlotRow(metricId=metricId, plotType=plotType, plotFile=plotFile,
+                           plotFingerprint=plotFingerprint, renderTime=renderTime)
         self.session.add(plotinfo)
         self.session.commit()
 
@@ -260,6 +400,7 @@ class ResultsDb(object):
         recarray also has 'name' and 'value' columns (and each name/value pair is then saved
         as a summary statistic associated with this same metricId).
         """
+        self._migrate()
         # Allow for special summary statistics which return data in a np structured array with
         #   'name' and 'value' columns.  (specificially needed for TableFraction summary statistic).
         if isinstance(summaryValue, np.ndarray):
@@ -270,6 +411,11 @@ class ResultsDb(object):
                         sSuffix = sSuffix.decode('utf-8')
                     else:
                         sSuffix = str(sSuffix)
+                    if self._batch is not None:
+                        self._batch['summarystats'].append(dict(metricId=metricId,
+                                                                summaryName=summaryName + ' ' + sSuffix,
+                                                                summaryValue=float(value['value'])))
+                        continue
                     summarystat = SummaryStatRow(metricId=metricId,
                                                  summaryName=summaryName + ' ' + sSuffix,
                                                  summaryValue=value['value'])
@@ -280,6 +426,10 @@ class ResultsDb(object):
         # Most summary statistics will be simple floats.
         else:
             if isinstance(summaryValue, float) or isinstance(summaryValue, int):
+                if self._batch is not None:
+                    self._batch['summarystats'].append(dict(metricId=metricId, summaryName=summaryName,
+                                                            summaryValue=summaryValue))
+                    return
                 summarystat = SummaryStatRow(metricId=metricId, summaryName=summaryName,
                                              summaryValue=summaryValue)
                 self.session.add(summarystat)
@@ -379,13 +529,13 @@ class ResultsDb(object):
         plotFiles = []
         for mid in metricId:
             # Join the metric table and the plot table based on the metricID (the second filter does the join)
-            query = (self.session.query(MetricRow, PlotRow).filter(MetricRow.metricId == mid)
-                     .filter(MetricRow.metricId == PlotRow.metricId))
-            for m, p in query:
+            query = (self.session.query(MetricRow, PlotRow.plotType, PlotRow.plotFile)
+                     .filter(MetricRow.metricId == mid).filter(MetricRow.metricId == PlotRow.metricId))
+            for m, plotType, plotFile in query:
                 # The plotFile typically ends with .pdf (but the rest of name can have '.' or '_')
-                thumbfile = 'thumb.' + '.'.join(p.plotFile.split('.')[:-1]) + '.png'
+                thumbfile = 'thumb.' + '.'.join(plotFile.split('.')[:-1]) + '.png'
                 plotFiles.append((m.metricId, m.metricName, m.metricMetadata,
-                                  p.plotType, p.plotFile, thumbfile))
+                                  plotType, plotFile, thumbfile))
         # Convert to numpy array.
         dtype = np.dtype([('metricId', int), ('metricName', str, self.slen),
                           ('metricMetadata', str, self.slen),
@@ -394,6 +544,21 @@ class ResultsDb(object):
         plotFiles = np.array(plotFiles, dtype)
         return plotFiles
 
+    def getPlotFingerprints(self):
+        """
+        Return the fingerprints of the inputs of all of the plots, as recorded by updatePlot.
+        Returns a dictionary of fingerprints, keyed by plot file name (plots without a fingerprint are skipped).
+        """
+        fingerprints = {}
+        # Databases made before plot fingerprints were recorded have none (until they are written to).
+        if not self._hasColumn('plots', 'plotFingerprint'):
+            return fingerprints
+        query = self.session.query(PlotRow.plotFile, PlotRow.plotFingerprint).order_by(PlotRow.plotId)
+        for plotFile, plotFingerprint in query:
+            if plotFingerprint is not None:
+                fingerprints[plotFile] = plotFingerprint
+        return fingerprints
+
     def getMetricDataFiles(self, metricId=None):
         """
         Get the metric data filenames for all or a single metric.
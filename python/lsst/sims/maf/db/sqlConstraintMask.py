@@ -0,0 +1,174 @@
+from builtins import object
+import re
+import numpy as np
+
+__all__ = ['SqlConstraintMask']
+
+
+# Tokens: numbers, quoted strings, comparison operators, parentheses/commas, and words.
+_tokenRegex = re.compile(r"""\s*(?:
+    (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![\w.]) |
+    (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*") |
+    (?P<op><=|>=|!=|<>|==|=|<|>) |
+    (?P<punct>[(),]) |
+    (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+_keywords = ('and', 'or', 'not', 'in', 'between')
+
+_comparisons = {'=': np.equal, '==': np.equal, '!=': np.not_equal, '<>': np.not_equal,
+                '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+
+class SqlConstraintMask(object):
+    """Translate a (simple) SQL where clause into a boolean mask on data already in memory.
+
+    This lets a MetricBundleGroup query the database once, for all of its constraints, and then select
+    the visits for each constraint in memory. The supported subset of SQL is: comparisons
+    (=, ==, !=, <>, <, <=, >, >=) between columns and numbers or quoted strings, [NOT] IN (...),
+    [NOT] BETWEEN ... AND ..., combined with AND, OR, NOT and parentheses.
+    Anything else (functions, arithmetic, LIKE, IS NULL, subqueries ..) raises a ValueError, in which
+    case the constraint should be applied by the database instead.
+    Note that (as is common in MAF constraints, and as sqlite allows) double-quoted values are
+    treated as strings, not column names.
+
+    Parameters
+    ----------
+    sqlconstraint : str
+        The sql constraint (without "WHERE"). An empty constraint (or None) selects all data.
+
+    Raises
+    ------
+    ValueError
+        If the constraint can not be translated.
+    """
+    def __init__(self, sqlconstraint):
+        self.sqlconstraint = sqlconstraint
+        self.columns = set()
+        self._tokens = self._tokenize('' if sqlconstraint is None else sqlconstraint)
+        self._pos = 0
+        if len(self._tokens) == 0:
+            self._mask = None
+        else:
+            self._mask = self._parseOr()
+            if self._pos != len(self._tokens):
+                raise ValueError('Could not translate sql constraint %s' % (sqlconstraint))
+
+    def __call__(self, simData):
+        """Return the boolean mask selecting the rows of simData which match the constraint.
+
+        Parameters
+        ----------
+        simData : numpy.ndarray or ColumnarSimData
+            The data, which must include all of the columns in self.columns.
+
+        Returns
+        -------
+        numpy.ndarray
+            The boolean mask.
+        """
+        if self._mask is None:
+            return np.ones(len(simData), dtype=bool)
+        return np.broadcast_to(self._mask(simData), (len(simData),))
+
+    @staticmethod
+    def _tokenize(sqlconstraint):
+        tokens = []
+        pos = 0
+        sqlconstraint = sqlconstraint.strip()
+        while pos < len(sqlconstraint):
+            match = _tokenRegex.match(sqlconstraint, pos)
+            if match is None or match.end() == pos:
+                raise ValueError('Could not translate sql constraint %s' % (sqlconstraint))
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'number':
+                value = float(value) if re.search('[.eE]', value) else int(value)
+            elif kind == 'string':
+                quote = value[0]
+                value = value[1:-1].replace(quote * 2, quote)
+            elif kind == 'word' and value.lower() in _keywords:
+                kind = 'keyword'
+                value = value.lower()
+            tokens.append((kind, value))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _accept(self, kind, value=None):
+        token = self._peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self._pos += 1
+            return True
+        return False
+
+    def _expect(self, kind, value=None):
+        if not self._accept(kind, value):
+            raise ValueError('Could not translate sql constraint %s' % (self.sqlconstraint))
+
+    def _parseOr(self):
+        terms = [self._parseAnd()]
+        while self._accept('keyword', 'or'):
+            terms.append(self._parseAnd())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda data: np.logical_or.reduce([term(data) for term in terms])
+
+    def _parseAnd(self):
+        terms = [self._parseNot()]
+        while self._accept('keyword', 'and'):
+            terms.append(self._parseNot())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda data: np.logical_and.reduce([term(data) for term in terms])
+
+    def _parseNot(self):
+        if self._accept('keyword', 'not'):
+            term = self._parseNot()
+            return lambda data: np.logical_not(term(data))
+        return self._parsePredicate()
+
+    def _parseOperand(self):
+        kind, value = self._peek()
+        self._pos += 1
+        if kind == 'word':
+            self.columns.add(value)
+            return lambda data: data[value]
+        if kind in ('number', 'string'):
+            return lambda data: value
+        raise ValueError('Could not translate sql constraint %s' % (self.sqlconstraint))
+
+    def _parsePredicate(self):
+        if self._accept('punct', '('):
+            term = self._parseOr()
+            self._expect('punct', ')')
+            return term
+        left = self._parseOperand()
+        kind, value = self._peek()
+        if kind == 'op':
+            self._pos += 1
+            right = self._parseOperand()
+            compare = _comparisons[value]
+            return lambda data: compare(left(data), right(data))
+        negate = self._accept('keyword', 'not')
+        if self._accept('keyword', 'in'):
+            self._expect('punct', '(')
+            values = [self._parseOperand()]
+            while self._accept('punct', ','):
+                values.append(self._parseOperand())
+            self._expect('punct', ')')
+            term = lambda data: np.logical_or.reduce([np.equal(left(data), v(data)) for v in values])
+        elif self._accept('keyword', 'between'):
+            low = self._parseOperand()
+            self._expect('keyword', 'and')
+            high = self._parseOperand()
+            term = lambda data: (left(data) >= low(data)) & (left(data) <= high(data))
+        else:
+            raise ValueError('Could not translate sql constraint %s' % (self.sqlconstraint))
+        if negate:
+            return lambda data: np.logical_not(term(data))
+        return term
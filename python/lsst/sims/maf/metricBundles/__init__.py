@@ -1,3 +1,4 @@
 from .metricBundle import *
+from .metricResultCache import *
 from .metricBundleGroup import *
 from .moMetricBundle import *
@@ -16,6 +16,10 @@ import lsst.sims.maf.utils as utils
 
 __all__ = ['MetricBundle', 'createEmptyMetricBundle']
 
+# The extension of the metric data files (or directories, for 'npy') in each fileFormat.
+# See BaseSlicer.writeData.
+fileExtensions = {'npz': '.npz', 'npy': '.npyd'}
+
 
 def createEmptyMetricBundle():
     """Create an empty metric bundle.
@@ -371,20 +375,23 @@ class MetricBundle(object):
         if updateFileRoot:
             self._buildFileRoot()
 
-    def writeDb(self, resultsDb=None, outfileSuffix=None):
+    def _outfileName(self, outfileSuffix=None, fileFormat='npz'):
+        """Build the metric data file name, from the fileRoot."""
+        if outfileSuffix is not None:
+            return self.fileRoot + '_' + outfileSuffix + fileExtensions[fileFormat]
+        return self.fileRoot + fileExtensions[fileFormat]
+
+    def writeDb(self, resultsDb=None, outfileSuffix=None, fileFormat='npz'):
         """Write the metricValues to the database
         """
-        if outfileSuffix is not None:
-            outfile = self.fileRoot + '_' + outfileSuffix + '.npz'
-        else:
-            outfile = self.fileRoot + '.npz'
+        outfile = self._outfileName(outfileSuffix, fileFormat)
         if resultsDb is not None:
             metricId = resultsDb.updateMetric(self.metric.name, self.slicer.slicerName,
                                               self.runName, self.constraint,
                                               self.metadata, outfile)
             resultsDb.updateDisplay(metricId, self.displayDict)
 
-    def write(self, comment='', outDir='.', outfileSuffix=None, resultsDb=None):
+    def write(self, comment='', outDir='.', outfileSuffix=None, resultsDb=None, fileFormat='npz'):
         """Write metricValues (and associated metadata) to disk.
 
         Parameters
@@ -397,11 +404,11 @@ class MetricBundle(object):
             Additional suffix to add to the output files (typically a numerical suffix for movies)
         resultsD : Optional[ResultsDb]
             Results database to store information on the file output
+        fileFormat : Optional[str]
+            The format of the output file: 'npz' (default, a single .npz file) or 'npy' (a .npyd
+            directory of memory-mappable .npy files and a JSON header). See BaseSlicer.writeData.
         """
-        if outfileSuffix is not None:
-            outfile = self.fileRoot + '_' + outfileSuffix + '.npz'
-        else:
-            outfile = self.fileRoot + '.npz'
+        outfile = self._outfileName(outfileSuffix, fileFormat)
         self.slicer.writeData(os.path.join(outDir, outfile),
                               self.metricValues,
                               metricName=self.metric.name,
@@ -409,9 +416,10 @@ class MetricBundle(object):
                               constraint=self.constraint,
                               metadata=self.metadata + comment,
                               displayDict=self.displayDict,
-                              plotDict=self.plotDict)
+                              plotDict=self.plotDict,
+                              fileFormat=fileFormat)
         if resultsDb is not None:
-            self.writeDb(resultsDb=resultsDb)
+            self.writeDb(resultsDb=resultsDb, fileFormat=fileFormat)
 
     def outputJSON(self):
         """Set up and call the baseSlicer outputJSON method, to output to IO string.
@@ -435,9 +443,9 @@ class MetricBundle(object):
         Parameters
         ----------
         filename : str
-           The file from which to read the metric bundle data.
+           The file (or 'npy' format directory) from which to read the metric bundle data.
         """
-        if not os.path.isfile(filename):
+        if not os.path.exists(filename):
             raise IOError('%s not found' % filename)
 
         self._resetMetricBundle()
@@ -471,8 +479,10 @@ class MetricBundle(object):
                 self.setDisplayDict(header['displayDict'])
         if self.metadata is None:
             self._buildMetadata()
-        path, head = os.path.split(filename)
-        self.fileRoot = head.replace('.npz', '')
+        path, head = os.path.split(filename.rstrip(os.sep))
+        for extension in fileExtensions.values():
+            head = head.replace(extension, '')
+        self.fileRoot = head
         self.setPlotFuncs(None)
 
     def computeSummaryStats(self, resultsDb=None):
@@ -486,29 +496,32 @@ class MetricBundle(object):
         if self.summaryValues is None:
             self.summaryValues = {}
         if self.summaryMetrics is not None:
-            # Build array of metric values, to use for (most) summary statistics.
-            rarr_std = np.array(list(zip(self.metricValues.compressed())),
-                                dtype=[('metricdata', self.metricValues.dtype)])
+            if resultsDb and len(self.summaryMetrics) > 0:
+                metricId = resultsDb.updateMetric(self.metric.name, self.slicer.slicerName,
+                                                  self.runName, self.constraint, self.metadata, None)
+            # The metric values to use for (most) summary statistics, and those filled with each of the
+            #  mask values requested by other summary metrics. Summary metrics which implement runSummary
+            #  share the intermediate results (such as the sorted values) of each of these.
+            values = {None: metrics.SummaryValues(self.metricValues.compressed())}
             for m in self.summaryMetrics:
                 # The summary metric colname should already be set to 'metricdata', but in case it's not:
                 m.colname = 'metricdata'
                 summaryName = m.name.replace(' metricdata', '').replace(' None', '')
-                if hasattr(m, 'maskVal'):
-                    # summary metric requests to use the mask value, as specified by itself,
-                    #  rather than skipping masked vals.
-                    rarr = np.array(list(zip(self.metricValues.filled(m.maskVal))),
-                                    dtype=[('metricdata', self.metricValues.dtype)])
-                else:
-                    rarr = rarr_std
-                if np.size(rarr) == 0:
+                # A summary metric can request to use the mask value, as specified by itself,
+                #  rather than skipping masked vals.
+                maskVal = getattr(m, 'maskVal', None)
+                if maskVal not in values:
+                    values[maskVal] = metrics.SummaryValues(self.metricValues.filled(maskVal))
+                summaryValues = values[maskVal]
+                if len(summaryValues) == 0:
                     summaryVal = self.slicer.badval
+                elif m.canRunSummary() and summaryValues.values.dtype != object:
+                    summaryVal = m.runSummary(summaryValues)
                 else:
-                    summaryVal = m.run(rarr)
+                    summaryVal = m.run(summaryValues.records)
                 self.summaryValues[summaryName] = summaryVal
                 # Add summary metric info to results database, if applicable.
                 if resultsDb:
-                    metricId = resultsDb.updateMetric(self.metric.name, self.slicer.slicerName,
-                                                      self.runName, self.constraint, self.metadata, None)
                     resultsDb.updateSummaryStat(metricId, summaryName=summaryName, summaryValue=summaryVal)
 
     def reduceMetric(self, reduceFunc, reducePlotDict=None, reduceDisplayDict=None):
@@ -1,21 +1,111 @@
 from __future__ import print_function
 from builtins import object
 import os
+import multiprocessing
+import contextlib
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
-from collections import OrderedDict
 
 import lsst.sims.maf.db as db
 import lsst.sims.maf.utils as utils
 from lsst.sims.maf.plots import PlotHandler
 import lsst.sims.maf.maps as maps
-from lsst.sims.maf.stackers import BaseDitherStacker
-from .metricBundle import MetricBundle, createEmptyMetricBundle
+from lsst.sims.maf.stackers import orderStackers, sharedRaDecCoords
+from .metricBundle import MetricBundle, createEmptyMetricBundle, fileExtensions
+from .metricResultCache import MetricResultCache
 import warnings
 
 __all__ = ['makeBundlesDictFromList', 'MetricBundleGroup']
 
+# State shared with forked worker processes in MetricBundleGroup._runSlicePointsParallel and plotCurrent.
+_parallelState = None
+
+
+def _runSliceChunk(chunk):
+    """Calculate metric values for one chunk of slicePoints, in a forked worker process.
+
+    Parameters
+    ----------
+    chunk : tuple of int
+        The (start, stop) range of slicePoints to calculate.
+
+    Returns
+    -------
+    dict, tuple of int
+        The (data, mask) arrays of metric values for this chunk, keyed by the bundleDict key,
+        and the (hits, misses) of the metric result cache.
+    """
+    group, bDict, slicer = _parallelState
+    start, stop = chunk
+    cacheStats = group._runSlicePoints(bDict, slicer, start, stop)
+    return {k: (b.metricValues.data[start:stop], b.metricValues.mask[start:stop])
+            for k, b in bDict.items()}, cacheStats
+
+
+def _plotBundleChunk(keys):
+    """Make the plots for a chunk of the current MetricBundles, in a forked worker process.
+
+    Parameters
+    ----------
+    keys : list
+        The keys of the bundles (in the currentBundleDict) to plot.
+
+    Returns
+    -------
+    list, list
+        The resultsDb updates (see _ResultsDbRecorder) and the names of the plot files skipped
+        as unchanged.
+    """
+    group, plotKwargs, fingerprints = _parallelState
+    # Only a non-interactive backend is safe to use in a forked process.
+    plt.switch_backend('Agg')
+    recorder = None if group.resultsDb is None else _ResultsDbRecorder(fingerprints)
+    skipped = group._plotBundles(keys, recorder, **plotKwargs)
+    return ([] if recorder is None else recorder.updates), skipped
+
+
+class _ResultsDbRecorder(object):
+    """Stand-in for the ResultsDb used by a PlotHandler in a worker process.
+
+    The updates are recorded, to be written to the real ResultsDb by the parent process (see replay).
+
+    Parameters
+    ----------
+    fingerprints : dict
+        The plot fingerprints, as returned by ResultsDb.getPlotFingerprints.
+    """
+    def __init__(self, fingerprints):
+        self.fingerprints = fingerprints
+        self.updates = []
+
+    def getPlotFingerprints(self):
+        return self.fingerprints
+
+    def updateMetric(self, metricName, slicerName, simDataName, sqlConstraint, metricMetadata, metricDataFile):
+        # The arguments stand in for the metricId, until the updates are replayed.
+        metricId = (metricName, slicerName, simDataName, sqlConstraint, metricMetadata, metricDataFile)
+        self.updates.append(('updateMetric', metricId, {}))
+        return metricId
+
+    def updateDisplay(self, metricId, displayDict, overwrite=True):
+        self.updates.append(('updateDisplay', metricId, dict(displayDict=displayDict, overwrite=overwrite)))
+
+    def updatePlot(self, metricId, plotType, plotFile, plotFingerprint=None, renderTime=None):
+        self.updates.append(('updatePlot', metricId, dict(plotType=plotType, plotFile=plotFile,
+                                                          plotFingerprint=plotFingerprint,
+                                                          renderTime=renderTime)))
+
+    @staticmethod
+    def replay(updates, resultsDb):
+        """Write the recorded updates to resultsDb."""
+        metricIds = {}
+        for method, metricId, kwargs in updates:
+            if method == 'updateMetric':
+                metricIds[metricId] = resultsDb.updateMetric(*metricId)
+            else:
+                getattr(resultsDb, method)(metricId=metricIds[metricId], **kwargs)
+
 
 def makeBundlesDictFromList(bundleList):
     """Utility to convert a list of MetricBundles into a dictionary, keyed by the fileRoot names.
@@ -78,9 +168,30 @@ class MetricBundleGroup(object):
         If False, metric values will only be saved after summary statistics are calculated.
     dbTable : str, opt
         The name of the table in the dbObj to query for data.
+    nProcs : int, opt
+        The number of processes to use when calculating metric values at each slicePoint.
+        If greater than 1, the slicePoints are split into chunks which are evaluated in forked
+        worker processes (sharing simData with the parent process); the metric values are identical
+        to those calculated serially. Default 1 (run serially).
+    cacheSize : int, opt
+        The number of metric results to keep in the cache used to skip recalculating metric values
+        at slicePoints which use exactly the same visits as a recently calculated slicePoint.
+        If None, the cacheSize of each slicer is used (set by the useCache flag of the healpix slicers).
+        Otherwise this size is used for all slicers; 0 turns off the cache. Note that the cache
+        should not be used with slicers which run maps (as the metric may depend on the map values).
+        Default None.
+    batchSize : int, opt
+        The number of slicePoints calculated in each call to the runBatch method of metrics which
+        provide it (simple reductions such as the Count, Mean, Median or Coaddm5 metrics).
+        0 turns off batch calculation, so that all metrics are run separately for each slicePoint.
+        Default 10000.
+    fileFormat : str, opt
+        The format of the metric data files: 'npz' (default) or 'npy', a directory of memory-mappable
+        .npy files with a JSON header, which is faster to read back. See BaseSlicer.writeData.
     """
     def __init__(self, bundleDict, dbObj, outDir='.', resultsDb=None, verbose=True,
-                 saveEarly=True, dbTable=None):
+                 saveEarly=True, dbTable=None, nProcs=1, cacheSize=None, batchSize=10000,
+                 fileFormat='npz'):
         """Set up the MetricBundleGroup.
         """
         if type(bundleDict) is list:
@@ -120,6 +231,22 @@ class MetricBundleGroup(object):
                 raise ValueError('resultsDb should be an ResultsDb object')
         self.resultsDb = resultsDb
 
+        # Number of processes to use when running through the slicePoints.
+        self.nProcs = nProcs
+        if self.nProcs is None or self.nProcs < 1:
+            self.nProcs = 1
+        # Metric result cache size (None = use the slicer's cacheSize), and the cache hits/misses so far.
+        self.cacheSize = cacheSize
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        # Number of slicePoints to calculate at once, for metrics with runBatch methods.
+        self.batchSize = batchSize
+        # Format of the metric data files.
+        if fileFormat not in fileExtensions:
+            raise ValueError('fileFormat should be one of %s' % (list(fileExtensions.keys())))
+        self.fileFormat = fileFormat
+        self._resetStackerCache()
+
         # Dict to keep track of what's been run:
         self.hasRun = {}
         for bk in bundleDict:
@@ -227,6 +354,11 @@ class MetricBundleGroup(object):
         Calculates metric values, then runs reduce functions and summary statistics for
         all MetricBundles.
 
+        If there is more than one constraint, the data for all of the constraints which can be
+        translated into in-memory selections (see db.SqlConstraintMask) is queried from the database
+        just once, and the visits for each of these constraints are then selected from that data.
+        Any other constraints are queried from the database separately.
+
         Parameters
         ----------
         clearMemory : bool, opt
@@ -236,11 +368,113 @@ class MetricBundleGroup(object):
         plotKwargs : bool, opt
             kwargs to pass to plotCurrent.
         """
+        sharedData, masks, groupBy = self._getSharedData()
         for constraint in self.constraints:
+            simData = None
+            if constraint in masks:
+                simData = self._selectSharedData(constraint, sharedData, masks[constraint], groupBy)
+                if simData is not None and len(simData) == 0:
+                    warnings.warn('No data matching constraint %s' % constraint)
+                    continue
             # Set the 'currentBundleDict' which is a dictionary of the metricBundles which match this
-            #  constraint.
-            self.runCurrent(constraint, clearMemory=clearMemory,
-                            plotNow=plotNow, plotKwargs=plotKwargs)
+            #  constraint. The resultsDb entries for the constraint are written in one transaction.
+            with self._batchResults():
+                self.runCurrent(constraint, simData=simData, clearMemory=clearMemory,
+                                plotNow=plotNow, plotKwargs=plotKwargs)
+
+    def _batchResults(self):
+        """Return a context in which the resultsDb writes are batched (see ResultsDb.batchWrites)."""
+        if self.resultsDb is None:
+            return contextlib.nullcontext()
+        return self.resultsDb.batchWrites()
+
+    def _defaultGroupBy(self):
+        """Return the column which getData groups the visits by (its groupBy='default'), or None.
+
+        Opsim databases group the visits in their default table by MJD, as that table can have a row
+        for each proposal a visit counts towards. Other tables (and databases) are not grouped.
+        """
+        mjdCol = getattr(self.dbObj, 'mjdCol', None)
+        defaultTable = getattr(self.dbObj, 'defaultTable', None)
+        if mjdCol is None or self.dbTable not in (None, defaultTable):
+            return None
+        return str(mjdCol)
+
+    def _getSharedData(self):
+        """Query the data for all of the constraints which can be selected in memory, at once.
+
+        The shared query is not grouped: grouping the combined query would keep only one row for
+        each group, which may not be the row matching a particular constraint (such as a proposalId).
+        Instead, the visits for each constraint are grouped after they are selected.
+
+        Returns
+        -------
+        ColumnarSimData or None, dict of SqlConstraintMask, str or None
+            The data for all of these constraints, the SqlConstraintMask to select the data
+            for each of them, and the column to group the selected visits by.
+            If there are fewer than two such constraints (or the query fails),
+            returns None and an empty dictionary, and each constraint is queried separately.
+        """
+        masks = {}
+        if self.dbObj is None or len(self.constraints) < 2:
+            return None, masks, None
+        for constraint in self.constraints:
+            try:
+                masks[constraint] = db.SqlConstraintMask(constraint)
+            except ValueError:
+                pass
+        if len(masks) < 2:
+            return None, {}, None
+        # Query the columns for all of these metricBundles, plus the columns used in the constraints
+        #  and the column to group by.
+        groupBy = self._defaultGroupBy()
+        dbCols = set()
+        for b in self.bundleDict.values():
+            if b.constraint in masks:
+                dbCols.update(b.dbCols)
+        for mask in masks.values():
+            dbCols.update(mask.columns)
+        if groupBy is not None:
+            dbCols.add(groupBy)
+        dbCols = sorted(dbCols)
+        if '' in masks or None in masks:
+            sqlconstraint = ''
+        else:
+            sqlconstraint = ' or '.join(['(%s)' % (constraint) for constraint in masks])
+        if self.verbose:
+            print("Querying database %s once for constraints %s, for columns %s" %
+                  (self.dbTable, list(masks.keys()), dbCols))
+        try:
+            simData = utils.getSimData(self.dbObj, sqlconstraint, dbCols,
+                                       groupBy=None, tableName=self.dbTable)
+        except (UserWarning, ValueError):
+            # Let each constraint be queried (and any problems be reported) separately.
+            return None, {}, None
+        if self.verbose:
+            print("Found %i visits" % (simData.size))
+        return utils.ColumnarSimData(simData), masks, groupBy
+
+    def _selectSharedData(self, constraint, sharedData, mask, groupBy=None):
+        """Select the visits matching constraint from the shared data, and set the fieldData.
+
+        If groupBy is set, only the first of the selected visits with each value of groupBy is kept
+        (ordered by groupBy), as when querying the database for the constraint with this groupBy.
+        Returns None if the constraint could not be evaluated on the shared data.
+        """
+        try:
+            rows = mask(sharedData)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if groupBy is not None:
+            rows = np.flatnonzero(rows)
+            first = np.unique(sharedData[groupBy][rows], return_index=True)[1]
+            rows = rows[first]
+        simData = sharedData.select(rows)
+        if self.verbose:
+            print("Selected %i visits matching constraint %s" % (simData.size, constraint))
+        self.setCurrent(constraint)
+        self.fieldData = self._getFieldData(constraint)
+        return simData
 
     def setCurrent(self, constraint):
         """Utility to set the currentBundleDict (i.e. a set of metricBundles with the same SQL constraint).
@@ -269,9 +503,11 @@ class MetricBundleGroup(object):
         ----------
         constraint : str
            constraint to use to set the currently active metrics
-        simData : numpy.ndarray, opt
+        simData : numpy.ndarray or ColumnarSimData, opt
            If simData is not None, then this numpy structured array is used instead of querying
-           data from the dbObj.
+           data from the dbObj. A structured array is copied into a ColumnarSimData object
+           (self.simData), so that stacker columns can be added without copying the rest of the data;
+           a ColumnarSimData object is used (and stacker columns added to it) directly.
         clearMemory : bool, opt
            If True, metric values are deleted from memory after they are calculated (and saved to disk).
         plotNow : bool, opt
@@ -312,6 +548,10 @@ class MetricBundleGroup(object):
                     metricsSkipped.append("%s : %s : %s" % (b.metric.name, b.metadata, b.slicer.slicerName))
                 warnings.warn(' This means skipping metrics %s' % metricsSkipped)
                 return
+        # Hold the data as columns, so stackers can add new columns without copying the existing ones.
+        if not isinstance(self.simData, utils.ColumnarSimData):
+            self.simData = utils.ColumnarSimData(self.simData)
+        self._resetStackerCache()
 
         # Find compatible subsets of the MetricBundle dictionary,
         # which can be run/metrics calculated/ together.
@@ -372,13 +612,14 @@ class MetricBundleGroup(object):
         if self.verbose:
             print("Found %i visits" % (self.simData.size))
 
-        # Query for the fieldData if we need it for the opsimFieldSlicer.
+        self.fieldData = self._getFieldData(constraint)
+
+    def _getFieldData(self, constraint):
+        """Query for the fieldData, if it is needed for an opsimFieldSlicer in the currentBundleDict."""
         needFields = [b.slicer.needsFields for b in self.currentBundleDict.values()]
         if True in needFields:
-            self.fieldData = utils.getFieldData(self.dbObj, constraint)
-        else:
-            self.fieldData = None
-
+            return utils.getFieldData(self.dbObj, constraint)
+        return None
 
     def _runCompatible(self, compatibleList):
         """Runs a set of 'compatible' metricbundles in the MetricBundleGroup dictionary,
@@ -413,20 +654,8 @@ class MetricBundleGroup(object):
             if m not in uniqMaps:
                 uniqMaps.append(m)
 
-        # Run stackers.
-        # Run dither stackers first. (this is a bit of a hack -- we should probably figure out
-        # proper hierarchy and DAG so that stackers run in the order they need to. This will catch 90%).
-        ditherStackers = []
-        for s in uniqStackers:
-            if isinstance(s, BaseDitherStacker):
-                ditherStackers.append(s)
-        for stacker in ditherStackers:
-            self.simData = stacker.run(self.simData, override=True)
-            uniqStackers.remove(stacker)
-
-        for stacker in uniqStackers:
-            # Note that stackers will clobber previously existing rows with the same name.
-            self.simData = stacker.run(self.simData, override=True)
+        # Run stackers, in the order required by the columns they use and add.
+        self._runStackers(orderStackers(uniqStackers))
 
         # Pull out one of the slicers to use as our 'slicer'.
         # This will be forced back into all of the metricBundles at the end (so that they track
@@ -445,48 +674,16 @@ class MetricBundleGroup(object):
         for b in bDict.values():
             b._setupMetricValues()
 
-        # Set up an ordered dictionary to be the cache if needed:
-        # (Currently using OrderedDict, it might be faster to use 2 regular Dicts instead)
-        if slicer.cacheSize > 0:
-            cacheDict = OrderedDict()
-            cache = True
-        else:
-            cache = False
         # Run through all slicepoints and calculate metrics.
-        for i, slice_i in enumerate(slicer):
-            slicedata = self.simData[slice_i['idxs']]
-            if len(slicedata) == 0:
-                # No data at this slicepoint. Mask data values.
-                for b in bDict.values():
-                    b.metricValues.mask[i] = True
-            else:
-                # There is data! Should we use our data cache?
-                if cache:
-                    # Make the data idxs hashable.
-                    cacheKey = frozenset(slice_i['idxs'])
-                    # If key exists, set flag to use it, otherwise add it
-                    if cacheKey in cacheDict:
-                        useCache = True
-                        cacheVal = cacheDict[cacheKey]
-                        # Move this value to the end of the OrderedDict
-                        del cacheDict[cacheKey]
-                        cacheDict[cacheKey] = cacheVal
-                    else:
-                        cacheDict[cacheKey] = i
-                        useCache = False
-                    for b in bDict.values():
-                        if useCache:
-                            b.metricValues.data[i] = b.metricValues.data[cacheDict[cacheKey]]
-                        else:
-                            b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slice_i['slicePoint'])
-                    # If we are above the cache size, drop the oldest element from the cache dict.
-                    if len(cacheDict) > slicer.cacheSize:
-                        del cacheDict[list(cacheDict.keys())[0]]
-
-                # Not using memoize, just calculate things normally
-                else:
-                    for b in bDict.values():
-                        b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slice_i['slicePoint'])
+        if self.nProcs > 1 and slicer.nslice > 1:
+            hits, misses = self._runSlicePointsParallel(bDict, slicer)
+        else:
+            hits, misses = self._runSlicePoints(bDict, slicer, 0, slicer.nslice)
+        if hits + misses > 0:
+            self.cacheHits += hits
+            self.cacheMisses += misses
+            if self.verbose:
+                print('Metric result cache: %i hits, %i misses.' % (hits, misses))
         # Mask data where metrics could not be computed (according to metric bad value).
         for b in bDict.values():
             if b.metricValues.dtype.name == 'object':
@@ -501,10 +698,201 @@ class MetricBundleGroup(object):
         # Save data to disk as we go, although this won't keep summary values, etc. (just failsafe).
         if self.saveEarly:
             for b in bDict.values():
-                b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+                b.write(outDir=self.outDir, resultsDb=self.resultsDb, fileFormat=self.fileFormat)
         else:
             for b in bDict.values():
-                b.writeDb(resultsDb=self.resultsDb)
+                b.writeDb(resultsDb=self.resultsDb, fileFormat=self.fileFormat)
+
+    def _resetStackerCache(self):
+        """Forget the stacker columns calculated for the current simData."""
+        # Each entry is a dictionary with the stacker, the sources of its input columns and its output columns.
+        self._stackerCache = []
+        # The index (in self._stackerCache) of the stacker which set each stacker column of self.simData.
+        self._stackerColumnSource = {}
+
+    def _runStackers(self, stackerList):
+        """Run stackers on self.simData, reusing the columns of identical stackers which have already run.
+
+        Each stacker runs at most once for each configuration (and set of input columns) on the data for
+        a constraint. Its output columns are cached, so that later compatible groups using the same
+        stacker get those columns back (without copying) rather than recalculating them.
+
+        Parameters
+        ----------
+        stackerList : list of BaseStacker
+            The stackers to run, in order.
+        """
+        if not isinstance(self.simData, utils.ColumnarSimData):
+            self.simData = utils.ColumnarSimData(self.simData)
+            self._resetStackerCache()
+        # Share the coordinate transformations of the visits between these stackers (only).
+        with sharedRaDecCoords():
+            for stacker in stackerList:
+                # Identify the stacker inputs by which (cached) stacker calculated each required column.
+                inputs = tuple(sorted([(col, self._stackerColumnSource[col]) for col in stacker.colsReq
+                                       if col in self._stackerColumnSource]))
+                entry = None
+                for i, cached in enumerate(self._stackerCache):
+                    # Compare from the new stacker, as running a stacker can add attributes (colsAddedDtypes).
+                    if cached['inputs'] == inputs and stacker == cached['stacker']:
+                        entry = i
+                        break
+                if entry is not None:
+                    for col, values in self._stackerCache[entry]['columns'].items():
+                        self.simData.setColumn(col, values)
+                        self._stackerColumnSource[col] = entry
+                    continue
+                # Don't overwrite the columns cached for a different stacker.
+                for col in stacker.colsAdded:
+                    if col in self._stackerColumnSource:
+                        self.simData.setColumn(col, self.simData[col].copy())
+                # Note that stackers will clobber previously existing rows with the same name.
+                simData = stacker.run(self.simData, override=True)
+                if simData is not self.simData:
+                    # A stacker may have returned new data (such as the CoaddStacker),
+                    #  so the cache no longer applies.
+                    self.simData = utils.ColumnarSimData(simData)
+                    self._resetStackerCache()
+                    continue
+                self._stackerCache.append({'stacker': stacker, 'inputs': inputs,
+                                           'columns': {col: self.simData[col] for col in stacker.colsAdded}})
+                for col in stacker.colsAdded:
+                    self._stackerColumnSource[col] = len(self._stackerCache) - 1
+
+    def _runSlicePoints(self, bDict, slicer, start, stop):
+        """Calculate metric values for slicePoints start:stop of slicer, for the bundles in bDict.
+
+        The metric values are stored directly into the metricValues of each bundle.
+        Metrics which provide runBatch are calculated for blocks of slicePoints at a time,
+        from a compressed (CSR) index of the visits at each slicePoint; the others are run
+        separately for each slicePoint.
+
+        Parameters
+        ----------
+        bDict : dict of MetricBundles
+            The compatible set of MetricBundles to calculate.
+        slicer : BaseSlicer
+            The (already set up) slicer shared by all bundles in bDict.
+        start : int
+            The first slicePoint to calculate.
+        stop : int
+            One past the last slicePoint to calculate.
+
+        Returns
+        -------
+        int, int
+            The number of hits and misses of the metric result cache.
+        """
+        batchDict = {}
+        if self.batchSize > 0:
+            batchDict = {k: b for k, b in bDict.items() if b.metric.canRunBatch()}
+        sliceDict = {k: b for k, b in bDict.items() if k not in batchDict}
+        if len(sliceDict) == 0 and hasattr(slicer, 'canSliceBatch') and slicer.canSliceBatch():
+            # Only batch metrics: take the (CSR) index directly from the slicer, a block at a time.
+            #  (Other slicers' indexes are gathered from each slicePoint, below.)
+            for blockStart in range(start, stop, self.batchSize):
+                blockStop = min(blockStart + self.batchSize, stop)
+                offsets, indices = slicer.sliceIndexBatch(blockStart, blockStop)
+                self._runBatch(batchDict, blockStart, offsets, indices)
+                for b in bDict.values():
+                    b.metricValues.mask[blockStart:blockStop] = (offsets[1:] == offsets[:-1])
+            return 0, 0
+        cacheSize = slicer.cacheSize if self.cacheSize is None else self.cacheSize
+        cache = MetricResultCache(cacheSize) if cacheSize > 0 and len(sliceDict) > 0 else None
+        # The simData indexes of the slicePoints waiting to be calculated by the batch metrics.
+        batchIdxs = []
+        for i in range(start, stop):
+            slice_i = slicer[i]
+            if len(batchDict) > 0:
+                batchIdxs.append(slice_i['idxs'])
+                if len(batchIdxs) == self.batchSize or i == stop - 1:
+                    counts = np.fromiter(map(len, batchIdxs), dtype=int, count=len(batchIdxs))
+                    offsets = np.zeros(len(batchIdxs) + 1, dtype=int)
+                    np.cumsum(counts, out=offsets[1:])
+                    indices = np.concatenate(batchIdxs).astype(int)
+                    self._runBatch(batchDict, i + 1 - len(batchIdxs), offsets, indices)
+                    batchIdxs = []
+            if len(slice_i['idxs']) == 0:
+                # No data at this slicepoint. Mask data values.
+                for b in bDict.values():
+                    b.metricValues.mask[i] = True
+                continue
+            if len(sliceDict) == 0:
+                continue
+            slicedata = self.simData[slice_i['idxs']]
+            if cache is not None:
+                # Reuse the metric values from a slicePoint which used exactly the same visits.
+                cacheKey = cache.fingerprint(slice_i['idxs'])
+                cached = cache.get(cacheKey)
+                if cached is not None:
+                    for b in sliceDict.values():
+                        b.metricValues.data[i] = b.metricValues.data[cached]
+                    continue
+                cache.put(cacheKey, i)
+            for b in sliceDict.values():
+                b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slice_i['slicePoint'])
+        if cache is None:
+            return 0, 0
+        return cache.hits, cache.misses
+
+    def _runBatch(self, bDict, first, offsets, indices):
+        """Calculate metric values for consecutive slicePoints, using the runBatch method of each metric.
+
+        Parameters
+        ----------
+        bDict : dict of MetricBundles
+            The MetricBundles to calculate (all of which have metrics which can run in batches).
+        first : int
+            The first slicePoint of the batch.
+        offsets : numpy.ndarray
+            The offsets into indices for each slicePoint of the batch (one more than the number of slicePoints).
+        indices : numpy.ndarray
+            The simData indexes for slicePoint first + i are indices[offsets[i]:offsets[i + 1]].
+        """
+        for b in bDict.values():
+            b.metricValues.data[first:first + len(offsets) - 1] = b.metric.runBatch(self.simData,
+                                                                                  (offsets, indices))
+
+    def _runSlicePointsParallel(self, bDict, slicer):
+        """Calculate metric values for all slicePoints of slicer, using a pool of self.nProcs processes.
+
+        The slicePoints are split into contiguous chunks, which are calculated in forked worker
+        processes (so that simData and the set-up slicer are shared with the workers, rather than
+        pickled for each task). The resulting metric values are reassembled in slicePoint order.
+
+        Parameters
+        ----------
+        bDict : dict of MetricBundles
+            The compatible set of MetricBundles to calculate.
+        slicer : BaseSlicer
+            The (already set up) slicer shared by all bundles in bDict.
+
+        Returns
+        -------
+        int, int
+            The number of hits and misses of the metric result cache, summed over all chunks.
+        """
+        global _parallelState
+        # Use a few chunks per process, to even out the load when some slicePoints are more expensive.
+        nChunks = min(slicer.nslice, self.nProcs * 4)
+        edges = np.linspace(0, slicer.nslice, nChunks + 1).astype(int)
+        chunks = [(edges[i], edges[i + 1]) for i in range(nChunks) if edges[i + 1] > edges[i]]
+        _parallelState = (self, bDict, slicer)
+        try:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(processes=self.nProcs) as pool:
+                results = pool.map(_runSliceChunk, chunks)
+        finally:
+            _parallelState = None
+        hits = 0
+        misses = 0
+        for (start, stop), (chunkResult, cacheStats) in zip(chunks, results):
+            for k, (data, mask) in chunkResult.items():
+                bDict[k].metricValues.data[start:stop] = data
+                bDict[k].metricValues.mask[start:stop] = mask
+            hits += cacheStats[0]
+            misses += cacheStats[1]
+        return hits, misses
 
     def reduceAll(self, updateSummaries=True):
         """Run the reduce methods for all metrics in bundleDict.
@@ -546,9 +934,10 @@ class MetricBundleGroup(object):
                         name = newmetricbundle.fileRoot
                     reduceBundleDict[name] = newmetricbundle
                     if self.saveEarly:
-                        newmetricbundle.write(outDir=self.outDir, resultsDb=self.resultsDb)
+                        newmetricbundle.write(outDir=self.outDir, resultsDb=self.resultsDb,
+                                              fileFormat=self.fileFormat)
                     else:
-                        newmetricbundle.writeDb(resultsDb=self.resultsDb)
+                        newmetricbundle.writeDb(resultsDb=self.resultsDb, fileFormat=self.fileFormat)
                 # Remove summaryMetrics from top level metricbundle if desired.
                 if updateSummaries:
                     b.summaryMetrics = []
@@ -574,7 +963,7 @@ class MetricBundleGroup(object):
             b.computeSummaryStats(self.resultsDb)
 
     def plotAll(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, trimWhitespace=True,
-                thumbnail=True, closefigs=True):
+                thumbnail=True, closefigs=True, nProcs=None, skipUnchanged=True):
         """Generate all the plots for all the metricBundles in bundleDict.
 
         Generating all ploots, for all MetricBundles, at this point, assumes that
@@ -599,17 +988,25 @@ class MetricBundleGroup(object):
         closefigs : bool, opt
             Close the matplotlib figures after they are saved to disk. If many figures are
             generated, closing the figures saves significant memory. Default True.
+        nProcs : int, opt
+            The number of processes to use to make the plots (see plotCurrent).
+            Default None, which uses self.nProcs.
+        skipUnchanged : bool, opt
+            If True (default), plots which were already saved (and recorded in the resultsDb) from the
+            same metric values and plot configuration are not made again. See PlotHandler.
         """
         for constraint in self.constraints:
             if self.verbose:
                 print('Plotting figures with "%s" constraint now.' % (constraint))
 
             self.setCurrent(constraint)
-            self.plotCurrent(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
-                             trimWhitespace=trimWhitespace, thumbnail=thumbnail, closefigs=closefigs)
+            with self._batchResults():
+                self.plotCurrent(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
+                                 trimWhitespace=trimWhitespace, thumbnail=thumbnail, closefigs=closefigs,
+                                 nProcs=nProcs, skipUnchanged=skipUnchanged)
 
     def plotCurrent(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, trimWhitespace=True,
-                    thumbnail=True, closefigs=True):
+                    thumbnail=True, closefigs=True, nProcs=None, skipUnchanged=True):
         """Generate the plots for the currently active set of MetricBundles.
 
         Parameters
@@ -631,12 +1028,60 @@ class MetricBundleGroup(object):
         closefigs : bool, opt
             Close the matplotlib figures after they are saved to disk. If many figures are
             generated, closing the figures saves significant memory. Default True.
+        nProcs : int, opt
+            The number of processes to use to make the plots. If greater than 1 (and savefig is True),
+            the bundles are plotted in forked worker processes using the Agg backend, and their
+            resultsDb entries are written by this process. Default None, which uses self.nProcs.
+        skipUnchanged : bool, opt
+            If True (default), plots which were already saved (and recorded in the resultsDb) from the
+            same metric values and plot configuration are not made again. See PlotHandler.
         """
-        plotHandler = PlotHandler(outDir=self.outDir, resultsDb=self.resultsDb,
-                                  savefig=savefig, figformat=figformat, dpi=dpi,
-                                  trimWhitespace=trimWhitespace, thumbnail=thumbnail)
+        global _parallelState
+        if nProcs is None:
+            nProcs = self.nProcs
+        plotKwargs = dict(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
+                          trimWhitespace=trimWhitespace, thumbnail=thumbnail, closefigs=closefigs,
+                          skipUnchanged=skipUnchanged)
+        keys = list(self.currentBundleDict.keys())
+        if nProcs > 1 and savefig and len(keys) > 1:
+            fingerprints = {}
+            if self.resultsDb is not None and skipUnchanged:
+                fingerprints = self.resultsDb.getPlotFingerprints()
+            _parallelState = (self, plotKwargs, fingerprints)
+            try:
+                ctx = multiprocessing.get_context('fork')
+                with ctx.Pool(processes=min(nProcs, len(keys))) as pool:
+                    # One bundle per task, as the time to plot each bundle varies a lot.
+                    results = pool.map(_plotBundleChunk, [[k] for k in keys], chunksize=1)
+            finally:
+                _parallelState = None
+            skipped = []
+            for updates, chunkSkipped in results:
+                if self.resultsDb is not None:
+                    _ResultsDbRecorder.replay(updates, self.resultsDb)
+                skipped += chunkSkipped
+        else:
+            skipped = self._plotBundles(keys, self.resultsDb, **plotKwargs)
+        if self.verbose:
+            if len(skipped) > 0:
+                print('Skipped %d unchanged plots.' % (len(skipped)))
+            print('Plotting complete.')
 
-        for b in self.currentBundleDict.values():
+    def _plotBundles(self, keys, resultsDb, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600,
+                     trimWhitespace=True, thumbnail=True, closefigs=True, skipUnchanged=True):
+        """Make the plots for some of the current MetricBundles, recording them in resultsDb.
+
+        Returns
+        -------
+        list of str
+            The plot files which were skipped, as they were unchanged.
+        """
+        plotHandler = PlotHandler(outDir=self.outDir, resultsDb=resultsDb,
+                                  savefig=savefig, figformat=figformat, dpi=dpi,
+                                  trimWhitespace=trimWhitespace, thumbnail=thumbnail,
+                                  skipUnchanged=skipUnchanged)
+        for k in keys:
+            b = self.currentBundleDict[k]
             try:
                 b.plot(plotHandler=plotHandler, outfileSuffix=outfileSuffix, savefig=savefig)
             except ValueError as ve:
@@ -645,8 +1090,7 @@ class MetricBundleGroup(object):
                 warnings.warn(message)
             if closefigs:
                 plt.close('all')
-        if self.verbose:
-            print('Plotting complete.')
+        return plotHandler.skippedFiles
 
     def writeAll(self):
         """Save all the MetricBundles to disk.
@@ -666,7 +1110,7 @@ class MetricBundleGroup(object):
             else:
                 print('Saving metric bundles.')
         for b in self.currentBundleDict.values():
-            b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+            b.write(outDir=self.outDir, resultsDb=self.resultsDb, fileFormat=self.fileFormat)
 
     def readAll(self):
         """Attempt to read all MetricBundles from disk.
@@ -679,7 +1123,7 @@ class MetricBundleGroup(object):
         removeBundles = []
         for b in self.bundleDict:
             bundle = self.bundleDict[b]
-            filename = os.path.join(self.outDir, bundle.fileRoot + '.npz')
+            filename = os.path.join(self.outDir, bundle.fileRoot + fileExtensions[self.fileFormat])
             try:
                 # Create a temporary metricBundle to read the data into.
                 #  (we don't use b directly, as this overrides plotDict/etc).
@@ -704,7 +1148,7 @@ class MetricBundleGroup(object):
                     # Borrow the fileRoot in b (we'll reset it appropriately afterwards).
                     bundle.metric.name = reduceName
                     bundle._buildFileRoot()
-                    filename = os.path.join(self.outDir, bundle.fileRoot + '.npz')
+                    filename = os.path.join(self.outDir, bundle.fileRoot + fileExtensions[self.fileFormat])
                     tmpBundle = createEmptyMetricBundle()
                     try:
                         tmpBundle.read(filename)
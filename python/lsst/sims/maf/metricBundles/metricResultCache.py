@@ -0,0 +1,67 @@
+from builtins import object
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['MetricResultCache']
+
+
+class MetricResultCache(object):
+    """A bounded, least-recently-used cache of metric results, keyed on the simData indexes of a slicePoint.
+
+    Neighboring slicePoints (such as adjacent healpixels) often see exactly the same set of visits,
+    so the metric values calculated at one slicePoint can be reused at the next.
+    The cache stores a value (for MetricBundleGroup, the slicePoint where the metric values were
+    calculated) under a fingerprint of the slicePoint's simData indexes.
+
+    Parameters
+    ----------
+    maxSize : int
+        The maximum number of entries to keep. The least recently used entry is dropped
+        when the cache grows beyond this size.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def fingerprint(idxs):
+        """Return a hashable fingerprint of a set of simData indexes.
+
+        Parameters
+        ----------
+        idxs : numpy.ndarray or list of int
+            The simData indexes. The order of the indexes does not matter.
+
+        Returns
+        -------
+        tuple
+            The number of indexes and the sha1 digest of the sorted indexes.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        # Spatial slicers already return sorted indexes, so only sort if needed.
+        if idxs.size > 1 and np.any(idxs[1:] < idxs[:-1]):
+            idxs = np.sort(idxs)
+        return idxs.size, hashlib.sha1(idxs.tobytes()).digest()
+
+    def get(self, key):
+        """Return the value cached under key (marking it most recently used), or None."""
+        value = self._cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Cache value under key, dropping the least recently used entry if the cache is full."""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxSize:
+            self._cache.popitem(last=False)
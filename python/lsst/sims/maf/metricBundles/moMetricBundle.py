@@ -2,6 +2,8 @@ from __future__ import print_function
 from builtins import object
 import os
 import warnings
+import multiprocessing
+import contextlib
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
@@ -17,6 +19,39 @@ from .metricBundle import MetricBundle
 
 __all__ = ['MoMetricBundle', 'MoMetricBundleGroup', 'createEmptyMoMetricBundle', 'makeCompletenessBundle']
 
+# The MoMetricBundleGroup and compatible bundles being calculated in parallel, inherited by forked workers.
+_parallelState = None
+
+
+def _calcObjectChunk(chunk):
+    """Calculate metric values for one chunk of objects, in a forked worker process.
+
+    Parameters
+    ----------
+    chunk : tuple of (int, numpy.ndarray)
+        The number of random visibility draws made for the objects before this chunk,
+        and the indexes of the objects (slicePoints) to calculate.
+
+    Returns
+    -------
+    dict
+        The (data, mask) arrays of metric values for these objects, keyed by the bundleDict key
+        (and the child bundle key, for child bundles).
+    """
+    group, compatibleList = _parallelState
+    nSkip, sliceIdxs = chunk
+    # Continue the random visibility sequence from where it would be when running serially.
+    for s in group._uniqStackers():
+        s.skipRandom(nSkip)
+    group._calcObjects(compatibleList, sliceIdxs)
+    result = {}
+    for k in compatibleList:
+        b = group.bundleDict[k]
+        result[(k, None)] = (b.metricValues.data[sliceIdxs], b.metricValues.mask[sliceIdxs])
+        for ck, cb in b.childBundles.items():
+            result[(k, ck)] = (cb.metricValues.data[sliceIdxs], cb.metricValues.mask[sliceIdxs])
+    return result
+
 
 def createEmptyMoMetricBundle():
     """Create an empty metric bundle.
@@ -228,8 +263,40 @@ class MoMetricBundle(MetricBundle):
 
 
 class MoMetricBundleGroup(object):
-    def __init__(self, bundleDict, outDir='.', resultsDb=None, verbose=True):
+    """Run a set of moving object metric bundles, which share the same MoObjSlicer.
+
+    Parameters
+    ----------
+    bundleDict : dict of MoMetricBundle
+        The moving object metric bundles to run.
+    outDir : str, opt
+        The output directory. Default '.'.
+    resultsDb : ResultsDb, opt
+        The results database in which to record the outputs. Default None.
+    verbose : bool, opt
+        Print progress information. Default True.
+    vectorizeH : bool, opt
+        If True (default), when all of the stackers and (parent) metrics of a set of compatible bundles
+        can calculate all of the H values at once (see BaseMoStacker.canRunH and BaseMoMetric.canRunH),
+        they are run once per object rather than once per H value. The metric values are the same.
+    nProcs : int, opt
+        The number of processes to use when calculating metric values.
+        If greater than 1, the objects are split into chunks which are evaluated in forked worker
+        processes (sharing the slicer observations with the parent process), and the metric values
+        (including those of child bundles) are merged back before the summary statistics are computed.
+        The metric values are identical to those calculated serially. Default 1 (run serially).
+    fileFormat : str, opt
+        The format of the metric data files: 'npz' (default) or 'npy' (see BaseSlicer.writeData).
+    """
+    def __init__(self, bundleDict, outDir='.', resultsDb=None, verbose=True, vectorizeH=True, nProcs=1,
+                 fileFormat='npz'):
         self.verbose = verbose
+        self.fileFormat = fileFormat
+        self.vectorizeH = vectorizeH
+        self.nProcs = nProcs
+        if self.nProcs is None or self.nProcs < 1:
+            self.nProcs = 1
+        self._stackers = None
         self.bundleDict = bundleDict
         self.outDir = outDir
         if not os.path.isdir(self.outDir):
@@ -314,16 +381,17 @@ class MoMetricBundleGroup(object):
                 compatibleLists.append([k,])
         return compatibleLists
 
-    def runConstraint(self, constraint):
-        """Calculate the metric values for all the metricBundles which match this constraint in the
-        metricBundleGroup. Also calculates child metrics and summary statistics, and writes all to disk.
-        (work is actually done in _runCompatible, so that only completely compatible sets of metricBundles
-        run at the same time).
+    def _compatibleLists(self, constraint):
+        """Find the compatible lists of the keys of the metricBundles which match this constraint.
 
         Parameters
         ----------
         constraint : str
             SQL-where or pandas constraint for the metricBundles.
+
+        Returns
+        -------
+        list of lists
         """
         # Find the dict keys of the bundles which match this constraint.
         keysMatchingConstraint = []
@@ -331,13 +399,27 @@ class MoMetricBundleGroup(object):
             if b.constraint == constraint:
                 keysMatchingConstraint.append(k)
         if len(keysMatchingConstraint) == 0:
+            return []
+        # Identify the sets of these metricBundles can be run at the same time (also have the same stackers).
+        return self._findCompatible(keysMatchingConstraint)
+
+    def runConstraint(self, constraint):
+        """Calculate the metric values for all the metricBundles which match this constraint in the
+        metricBundleGroup. Also calculates child metrics and summary statistics, and writes all to disk.
+        (work is actually done in _runCompatible, so that only completely compatible sets of metricBundles
+        run at the same time).
+
+        Parameters
+        ----------
+        constraint : str
+            SQL-where or pandas constraint for the metricBundles.
+        """
+        compatibleLists = self._compatibleLists(constraint)
+        if len(compatibleLists) == 0:
             return
         # Identify the observations which are relevant for this constraint.
         # This sets slicer.obs (valid for all H values).
         self.slicer.subsetObs(constraint)
-        # Identify the sets of these metricBundles can be run at the same time (also have the same stackers).
-        compatibleLists = self._findCompatible(keysMatchingConstraint)
-
         # And now run each of those subsets of compatible metricBundles.
         for compatibleList in compatibleLists:
             self._runCompatible(compatibleList)
@@ -355,7 +437,18 @@ class MoMetricBundleGroup(object):
         """
         if self.verbose:
             print('Running metrics %s' % compatibleList)
+        self._setupCompatible(compatibleList)
+        self._calcCompatible(compatibleList, range(self.slicer.nSso))
+        self._finishCompatible(compatibleList)
+
+    def _uniqStackers(self):
+        """Find the unique stackers (and check for maps) of the metricBundles.
 
+        The unique stackers are found once, before any of them run: running a stacker changes its
+        attributes, so that it would no longer compare equal to an identical stacker which has not run yet.
+        """
+        if self._stackers is not None:
+            return self._stackers
         bDict = self.bundleDict  #  {key: self.bundleDict.get(key) for key in compatibleList}
 
         # Find the unique stackers and maps. These are already "compatible" (as id'd by compatibleList).
@@ -375,15 +468,76 @@ class MoMetricBundleGroup(object):
 
         if len(uniqMaps) > 0:
             print("Got some maps .. that was unexpected at the moment. Can't use them here yet.")
+        self._stackers = uniqStackers
+        return uniqStackers
 
-        # Set up all of the metric values, including for the child bundles.
+    def _setupCompatible(self, compatibleList):
+        """Set up all of the metric values, including for the child bundles."""
         for k in compatibleList:
             b = self.bundleDict[k]
             b._setupMetricValues()
             for cb in b.childBundles.values():
                 cb._setupMetricValues()
-        # Calculate the metric values.
-        for i, slicePoint in enumerate(self.slicer):
+
+    def _calcCompatible(self, compatibleList, sliceIdxs):
+        """Calculate the metric values of a set of compatible (parent and child) bundles,
+        for the objects (slicePoints) in sliceIdxs, using the current slicer.obs.
+        """
+        sliceIdxs = np.asarray(sliceIdxs, dtype=int)
+        if self.nProcs > 1 and len(sliceIdxs) > 1:
+            self._calcObjectsParallel(compatibleList, sliceIdxs)
+        else:
+            self._calcObjects(compatibleList, sliceIdxs)
+
+    def _calcObjectsParallel(self, compatibleList, sliceIdxs):
+        """Calculate the metric values for the objects in sliceIdxs, using a pool of self.nProcs processes.
+
+        The objects are split into contiguous chunks, which are calculated in forked worker processes.
+        The resulting metric values of the parent and child bundles are merged back into the bundles.
+        """
+        global _parallelState
+        # Count the random visibility draws for each object, so each worker can continue the random
+        # sequence of the (first) object in its chunk.
+        nDraws = np.zeros(len(sliceIdxs), dtype=np.int64)
+        for n, i in enumerate(sliceIdxs):
+            slicePoint = self.slicer[i]
+            nDraws[n] = len(slicePoint['obs']) * len(slicePoint['Hvals'])
+        nSkip = np.concatenate([[0], np.cumsum(nDraws)])
+        # Use a few chunks per process, to even out the load when some objects are more expensive.
+        nChunks = min(len(sliceIdxs), self.nProcs * 4)
+        edges = np.linspace(0, len(sliceIdxs), nChunks + 1).astype(int)
+        chunks = [(int(nSkip[edges[n]]), sliceIdxs[edges[n]:edges[n + 1]]) for n in range(nChunks)
+                  if edges[n + 1] > edges[n]]
+        _parallelState = (self, compatibleList)
+        try:
+            ctx = multiprocessing.get_context('fork')
+            # Fork a new worker for each chunk, so each chunk starts from the random state of this process.
+            with ctx.Pool(processes=self.nProcs, maxtasksperchild=1) as pool:
+                results = pool.map(_calcObjectChunk, chunks, chunksize=1)
+        finally:
+            _parallelState = None
+        for (skip, idxs), chunkResult in zip(chunks, results):
+            for (k, ck), (data, mask) in chunkResult.items():
+                b = self.bundleDict[k]
+                if ck is not None:
+                    b = b.childBundles[ck]
+                b.metricValues.data[idxs] = data
+                b.metricValues.mask[idxs] = mask
+        # And continue the random sequence in this process, as if these objects had been run here.
+        for s in self._uniqStackers():
+            s.skipRandom(int(nSkip[-1]))
+
+    def _calcObjects(self, compatibleList, sliceIdxs):
+        """Calculate the metric values of a set of compatible (parent and child) bundles,
+        for the objects (slicePoints) in sliceIdxs, in this process.
+        """
+        uniqStackers = self._uniqStackers()
+        if (self.vectorizeH and all(s.canRunH() for s in uniqStackers)
+                and all(self.bundleDict[k].metric.canRunH() for k in compatibleList)):
+            self._calcCompatibleH(compatibleList, sliceIdxs, uniqStackers)
+            return
+        for i in sliceIdxs:
+            slicePoint = self.slicer[i]
             ssoObs = slicePoint['obs']
             for j, Hval in enumerate(slicePoint['Hvals']):
                 # Run stackers to add extra columns (that depend on Hval)
@@ -417,25 +571,117 @@ class MoMetricBundleGroup(object):
                                     cb.metricValues.mask[i][j] = True
                                 else:
                                     cb.metricValues.data[i][j] = childVal
+
+    def _calcCompatibleH(self, compatibleList, sliceIdxs, uniqStackers):
+        """Calculate the metric values of a set of compatible (parent and child) bundles,
+        running the stackers and parent metrics for all H values of each object at once.
+        """
+        for i in sliceIdxs:
+            slicePoint = self.slicer[i]
+            ssoObs = slicePoint['obs']
+            Hvals = slicePoint['Hvals']
+            # Mask the parent metrics (and then child metrics) if there was no data.
+            if len(ssoObs) == 0:
+                for k in compatibleList:
+                    b = self.bundleDict[k]
+                    for bundle in [b] + list(b.childBundles.values()):
+                        bundle.metricValues.mask[i] = True
+                continue
+            # Run stackers to add extra columns, keeping the columns which depend on Hval separately.
+            Hcols = {}
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for s in uniqStackers:
+                    ssoObs, cols = s.runH(ssoObs, slicePoint['orbit']['H'], Hvals)
+                    Hcols.update(cols)
+            parentValues = {}
+            for k in compatibleList:
+                parentValues[k] = self.bundleDict[k].metric.runH(ssoObs, slicePoint['orbit'], Hvals, Hcols)
+            for j, Hval in enumerate(Hvals):
+                # The child metrics use the stacker columns for this Hval.
+                if any(len(self.bundleDict[k].childBundles) > 0 for k in compatibleList):
+                    for col, values in Hcols.items():
+                        ssoObs[col] = values[j]
+                for k in compatibleList:
+                    b = self.bundleDict[k]
+                    mVal = parentValues[k][j]
+                    # Mask if the parent metric returned a bad value.
+                    if mVal == b.metric.badval:
+                        b.metricValues.mask[i][j] = True
+                        for cb in b.childBundles.values():
+                            cb.metricValues.mask[i][j] = True
+                    # Otherwise, set the parent value and calculate the child metric values as well.
+                    else:
+                        b.metricValues.data[i][j] = mVal
+                        for cb in b.childBundles.values():
+                            childVal = cb.metric.run(ssoObs, slicePoint['orbit'], Hval, mVal)
+                            if childVal == cb.metric.badval:
+                                cb.metricValues.mask[i][j] = True
+                            else:
+                                cb.metricValues.data[i][j] = childVal
+
+    def _finishCompatible(self, compatibleList):
+        """Compute the summary statistics of a set of (parent and child) bundles, and write them to disk."""
         for k in compatibleList:
             b = self.bundleDict[k]
             b.computeSummaryStats(self.resultsDb)
             for cB in b.childBundles.values():
                 cB.computeSummaryStats(self.resultsDb)
                 # Write to disk.
-                cB.write(outDir=self.outDir, resultsDb=self.resultsDb)
+                cB.write(outDir=self.outDir, resultsDb=self.resultsDb, fileFormat=self.fileFormat)
             # Write to disk.
-            b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+            b.write(outDir=self.outDir, resultsDb=self.resultsDb, fileFormat=self.fileFormat)
 
     def runAll(self):
         """
         Run all constraints and metrics for these moMetricBundles.
+
+        If the slicer was set up to stream its observations (with a chunkSize),
+        the metric values are calculated one chunk of objects at a time (see runChunks).
         """
-        for constraint in self.constraints:
-            self.runConstraint(constraint)
+        # Write all of the resultsDb entries in one transaction.
+        batch = contextlib.nullcontext() if self.resultsDb is None else self.resultsDb.batchWrites()
+        with batch:
+            if self.slicer.chunkSize is not None:
+                self.runChunks()
+            else:
+                for constraint in self.constraints:
+                    self.runConstraint(constraint)
         if self.verbose:
             print('Calculated and saved all metrics.')
 
+    def runChunks(self):
+        """Run all constraints and metrics, reading the observations in chunks of whole objects.
+
+        Only one chunk of observations is held in memory at a time: for each chunk, the metric
+        values are calculated for all constraints and all of the objects in that chunk.
+        Objects without any observations are masked. Summary statistics are computed and the
+        metric values written to disk after the last chunk.
+        """
+        compatibleLists = {}
+        for constraint in self.constraints:
+            compatibleLists[constraint] = self._compatibleLists(constraint)
+            for compatibleList in compatibleLists[constraint]:
+                self._setupCompatible(compatibleList)
+        observed = np.zeros(self.slicer.nSso, bool)
+        for n, sliceIdxs in enumerate(self.slicer.iterObsChunks()):
+            if self.verbose:
+                print('Running metrics for chunk %d (%d objects)' % (n, len(sliceIdxs)))
+            for constraint in self.constraints:
+                if len(compatibleLists[constraint]) == 0:
+                    continue
+                self.slicer.subsetObs(constraint)
+                for compatibleList in compatibleLists[constraint]:
+                    self._calcCompatible(compatibleList, sliceIdxs)
+            observed[sliceIdxs] = True
+        for constraint in self.constraints:
+            for compatibleList in compatibleLists[constraint]:
+                for k in compatibleList:
+                    b = self.bundleDict[k]
+                    for bundle in [b] + list(b.childBundles.values()):
+                        bundle.metricValues.mask[~observed] = True
+                self._finishCompatible(compatibleList)
+
     def plotAll(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, thumbnail=True,
                 closefigs=True):
         """
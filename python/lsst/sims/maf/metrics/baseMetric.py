@@ -194,3 +194,69 @@ class BaseMetric(with_metaclass(MetricRegistry, object)):
             The metric value at each slicePoint.
         """
         raise NotImplementedError('Please implement your metric calculation.')
+
+    def runBatch(self, simData, sliceIndex):
+        """Calculate metric values for many slicePoints at once (optional).
+
+        Metrics whose value is a simple reduction of their column(s) can implement this method,
+        to calculate the values for a whole batch of slicePoints in one vectorized pass rather than
+        calling run once per slicePoint. The MetricBundleGroup uses runBatch instead of run
+        whenever the metric provides it (see canRunBatch).
+
+        Parameters
+        ----------
+        simData : numpy.NDarray or lsst.sims.maf.utils.ColumnarSimData
+            All of the simData (not sliced).
+        sliceIndex : tuple of numpy.NDarray
+            The (offsets, indices) of the simData visits for each slicePoint, in compressed (CSR)
+            form: the visits for slicePoint i of the batch are simData[indices[offsets[i]:offsets[i + 1]]].
+            SlicePoints with no visits may be included; their values are masked afterwards.
+
+        Returns
+        -------
+        numpy.NDarray
+            The metric value for each slicePoint in the batch (len(offsets) - 1 values).
+        """
+        raise NotImplementedError('This metric does not calculate values in batches.')
+
+    def canRunBatch(self):
+        """Return True if the metric can calculate its values with runBatch.
+
+        This is only the case if runBatch is implemented by the same class as run (or a subclass of it),
+        so that a metric which overrides run does not inherit a runBatch which no longer matches.
+        """
+        mro = type(self).__mro__
+        runClass = next(c for c in mro if 'run' in c.__dict__)
+        batchClass = next(c for c in mro if 'runBatch' in c.__dict__)
+        return batchClass is not BaseMetric and issubclass(batchClass, runClass)
+
+    def runSummary(self, summaryValues):
+        """Calculate a summary statistic of the metric values of a MetricBundle (optional).
+
+        Summary metrics can implement this method to work directly on the (unmasked) metric values,
+        sharing intermediate results such as the sorted values with the other summary metrics of the
+        bundle, rather than on the structured array passed to run.
+        MetricBundle.computeSummaryStats uses runSummary whenever the metric provides it
+        (see canRunSummary).
+
+        Parameters
+        ----------
+        summaryValues : lsst.sims.maf.metrics.SummaryValues
+            The metric values to summarize.
+
+        Returns
+        -------
+        int, float or object
+            The summary statistic.
+        """
+        raise NotImplementedError('This metric does not calculate summary statistics from SummaryValues.')
+
+    def canRunSummary(self):
+        """Return True if the metric can calculate summary statistics with runSummary.
+
+        As for canRunBatch, runSummary must be implemented by the same class as run (or a subclass of it).
+        """
+        mro = type(self).__mro__
+        runClass = next(c for c in mro if 'run' in c.__dict__)
+        summaryClass = next(c for c in mro if 'runSummary' in c.__dict__)
+        return summaryClass is not BaseMetric and issubclass(summaryClass, runClass)
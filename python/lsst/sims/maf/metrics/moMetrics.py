@@ -25,6 +25,16 @@ def _setVis(ssoObs, snrLimit, snrCol, visCol):
     return vis
 
 
+def _setVisH(ssoObs, Hcols, nH, snrLimit, snrCol, visCol):
+    """Return the (nH, nObs) visibility mask for all H values, using the H dependent columns
+    in Hcols (or the ssoObs columns, if the column does not depend on H)."""
+    if snrLimit is not None:
+        vis = Hcols.get(snrCol, ssoObs[snrCol]) >= snrLimit
+    else:
+        vis = Hcols.get(visCol, ssoObs[visCol]) > 0
+    return np.broadcast_to(vis, (nH, len(ssoObs)))
+
+
 class BaseMoMetric(BaseMetric):
     """Base class for the moving object metrics.
     Intended to be used with the Moving Object Slicer."""
@@ -96,6 +106,40 @@ class BaseMoMetric(BaseMetric):
         """
         raise NotImplementedError
 
+    def runH(self, ssoObs, orb, Hvals, Hcols):
+        """Calculate the metric values for all H values in a single call.
+
+        This is an optional, faster alternative to calling run for each H value, used by the
+        MoMetricBundleGroup whenever the metric provides it (see canRunH).
+
+        Parameters
+        ----------
+        ssoObs: np.ndarray
+            The input data to the metric. The columns which depend on H are not valid here.
+        orb: np.ndarray
+            The information about the orbit for which the metric is being calculated.
+        Hvals : np.ndarray
+            The H values for which the metric is being calculated.
+        Hcols : dict of np.ndarray
+            The columns which depend on H (such as SNR and vis), each of shape (len(Hvals), len(ssoObs)).
+
+        Returns
+        -------
+        list or np.ndarray
+            The metric value for each H value.
+        """
+        raise NotImplementedError('This metric does not calculate all H values at once.')
+
+    def canRunH(self):
+        """Return True if the metric can calculate its values for all H values at once, with runH.
+
+        As for canRunBatch, runH must be implemented by the same class as run (or a subclass of it).
+        """
+        mro = type(self).__mro__
+        runClass = next(c for c in mro if 'run' in c.__dict__)
+        runHClass = next(c for c in mro if 'runH' in c.__dict__)
+        return runHClass is not BaseMoMetric and issubclass(runHClass, runClass)
+
 
 class BaseChildMetric(BaseMoMetric):
     """Base class for child metrics.
@@ -157,6 +201,10 @@ class NObsMetric(BaseMoMetric):
             vis = np.where(ssoObs[self.visCol] > 0)[0]
             return vis.size
 
+    def runH(self, ssoObs, orb, Hvals, Hcols):
+        vis = _setVisH(ssoObs, Hcols, len(Hvals), self.snrLimit, self.snrCol, self.visCol)
+        return vis.sum(axis=1)
+
 
 class NObsNoSinglesMetric(BaseMoMetric):
     """
@@ -196,6 +244,16 @@ class NNightsMetric(BaseMoMetric):
         nights = len(np.unique(ssoObs[self.nightCol][vis]))
         return nights
 
+    def runH(self, ssoObs, orb, Hvals, Hcols):
+        vis = _setVisH(ssoObs, Hcols, len(Hvals), self.snrLimit, self.snrCol, self.visCol)
+        if len(ssoObs) == 0:
+            return np.zeros(len(Hvals), int)
+        # Group the observations by night, then count the nights with any visible observation.
+        nightOrder = np.argsort(ssoObs[self.nightCol], kind='mergesort')
+        n, nIdx = np.unique(ssoObs[self.nightCol][nightOrder], return_index=True)
+        visNights = np.logical_or.reduceat(vis[:, nightOrder], nIdx, axis=1)
+        return visNights.sum(axis=1)
+
 
 class ObsArcMetric(BaseMoMetric):
     """Calculate the difference between the first and last observation of an SSobject.
@@ -211,6 +269,15 @@ class ObsArcMetric(BaseMoMetric):
         arc = ssoObs[self.mjdCol][vis].max() - ssoObs[self.mjdCol][vis].min()
         return arc
 
+    def runH(self, ssoObs, orb, Hvals, Hcols):
+        vis = _setVisH(ssoObs, Hcols, len(Hvals), self.snrLimit, self.snrCol, self.visCol)
+        if len(ssoObs) == 0:
+            return np.zeros(len(Hvals), float)
+        mjds = ssoObs[self.mjdCol]
+        last = np.where(vis, mjds, -np.inf).max(axis=1)
+        first = np.where(vis, mjds, np.inf).min(axis=1)
+        return np.where(vis.any(axis=1), last - first, 0)
+
 
 class DiscoveryMetric(BaseMoMetric):
     """Identify the discovery opportunities for an SSobject.
@@ -266,6 +333,24 @@ class DiscoveryMetric(BaseMoMetric):
 
     def run(self, ssoObs, orb, Hval):
         vis = _setVis(ssoObs, self.snrLimit, self.snrCol, self.visCol)
+        return self._discover(ssoObs, vis)
+
+    def runH(self, ssoObs, orb, Hvals, Hcols):
+        visH = _setVisH(ssoObs, Hcols, len(Hvals), self.snrLimit, self.snrCol, self.visCol)
+        # As H increases the SNR only decreases, so the visible observations (with an snrLimit) are the
+        # same for a run of H values until the next observation drops below the limit. The discovery
+        # opportunities only need to be found again when the visible observations change.
+        metricValues = []
+        prevVis = None
+        for visRow in visH:
+            if prevVis is None or not np.array_equal(visRow, prevVis):
+                mVal = self._discover(ssoObs, np.where(visRow)[0])
+                prevVis = visRow
+            metricValues.append(mVal)
+        return metricValues
+
+    def _discover(self, ssoObs, vis):
+        """Find the discovery opportunities, using the visible observations ssoObs[vis]."""
         if len(vis) == 0:
             return self.badval
         # Identify discovery opportunities.
@@ -1,3 +1,4 @@
+from builtins import object
 import numpy as np
 from .baseMetric import BaseMetric
 
@@ -8,11 +9,154 @@ __all__ = ['PassMetric', 'Coaddm5Metric', 'MaxMetric', 'AbsMaxMetric', 'MeanMetr
            'CountUniqueMetric', 'CountMetric', 'CountRatioMetric', 'CountSubsetMetric', 'RobustRmsMetric',
            'MaxPercentMetric', 'AbsMaxPercentMetric', 'BinaryMetric', 'FracAboveMetric', 'FracBelowMetric',
            'PercentileMetric', 'NoutliersNsigmaMetric', 'UniqueRatioMetric',
-           'MeanAngleMetric', 'RmsAngleMetric', 'FullRangeAngleMetric', 'CountExplimMetric']
+           'MeanAngleMetric', 'RmsAngleMetric', 'FullRangeAngleMetric', 'CountExplimMetric',
+           'SummaryValues']
 
 twopi = 2.0*np.pi
 
 
+def _batchValues(simData, col, sliceIndex):
+    """Private utility for the runBatch methods below.
+
+    Returns the values of col for all of the slicePoints in sliceIndex (concatenated, in slicePoint
+    order), the offsets of each slicePoint into these values, and the number of values for each slicePoint.
+    """
+    offsets, indices = sliceIndex
+    return simData[col][indices], offsets, np.diff(offsets)
+
+
+def _reduceAt(ufunc, values, offsets):
+    """Private utility for the runBatch methods below.
+
+    Apply ufunc.reduceat to the values of each slicePoint (values[offsets[i]:offsets[i + 1]]).
+    SlicePoints without any values are set to nan (they are masked by the MetricBundleGroup).
+    """
+    result = np.zeros(len(offsets) - 1, float) + np.nan
+    nonempty = np.where(offsets[1:] > offsets[:-1])[0]
+    if len(nonempty) > 0:
+        # As empty slicePoints are skipped, each reduction runs up to the start of the next nonempty slicePoint.
+        result[nonempty] = ufunc.reduceat(values, offsets[nonempty])
+    return result
+
+
+def _sortedBatchValues(values, counts):
+    """Private utility for the runBatch methods below.
+
+    Sort the values within each slicePoint (nan last, as np.sort).
+    """
+    sliceIds = np.repeat(np.arange(len(counts)), counts)
+    return values[np.lexsort((values, sliceIds))]
+
+
+def _hasNanAt(sortedValues, offsets, counts):
+    """Private utility for the runBatch methods below.
+
+    Flag the (nonempty) slicePoints with nan values, which sort last within each slicePoint.
+    """
+    if sortedValues.dtype.kind not in 'fc':
+        return np.zeros(len(counts), bool)
+    return np.isnan(sortedValues[offsets + counts - 1])
+
+
+def _percentileAt(values, offsets, counts, percentile):
+    """Private utility for the runBatch methods below.
+
+    Calculate the percentile of the values of each slicePoint, interpolating linearly (as np.percentile).
+    """
+    return _sortedPercentileAt(_sortedBatchValues(values, counts), offsets, counts, percentile)
+
+
+def _sortedPercentileAt(sortedValues, offsets, counts, percentile):
+    """Private utility for _percentileAt and SummaryValues.
+
+    As _percentileAt, for values which are already sorted within each slicePoint.
+    """
+    result = np.zeros(len(counts), float) + np.nan
+    nonempty = np.where(counts > 0)[0]
+    if len(nonempty) == 0:
+        return result
+    pos = percentile / 100. * (counts[nonempty] - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, counts[nonempty] - 1)
+    t = pos - lo
+    below = sortedValues[offsets[nonempty] + lo]
+    above = sortedValues[offsets[nonempty] + hi]
+    # Interpolate from the nearer end, as np.percentile does.
+    diff = above - below
+    result[nonempty] = np.where(t >= 0.5, above - diff * (1 - t), below + diff * t)
+    # The percentile of values including nan is nan, as np.percentile.
+    result[nonempty[_hasNanAt(sortedValues, offsets[nonempty], counts[nonempty])]] = np.nan
+    return result
+
+
+class SummaryValues(object):
+    """The (unmasked) values of a metric, from which summary statistics are calculated.
+
+    Summary metrics which implement runSummary (see BaseMetric.runSummary) share the intermediate
+    results held here -- the sorted values, mean and standard deviation -- which are calculated
+    only once, when first needed. The results match those of the summary metrics' run methods.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The metric values.
+    colname : str, opt
+        The column name of the values, for summary metrics which only implement run (see records).
+        Default 'metricdata'.
+    """
+    def __init__(self, values, colname='metricdata'):
+        self.values = np.ravel(values)
+        self.colname = colname
+        self._sorted = None
+        self._mean = None
+        self._std = None
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def records(self):
+        """The values as a one column structured array, as passed to the run method of summary metrics."""
+        records = np.empty(len(self.values), dtype=[(self.colname, self.values.dtype)])
+        records[self.colname] = self.values
+        return records
+
+    @property
+    def sorted(self):
+        """The sorted values (nan last, as np.sort)."""
+        if self._sorted is None:
+            self._sorted = np.sort(self.values)
+        return self._sorted
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            self._mean = np.mean(self.values)
+        return self._mean
+
+    @property
+    def std(self):
+        if self._std is None:
+            self._std = np.std(self.values)
+        return self._std
+
+    def _hasNan(self):
+        return self.sorted.dtype.kind in 'fc' and np.isnan(self.sorted[-1])
+
+    def median(self):
+        """The median of the values, as np.median."""
+        if self._hasNan():
+            return np.nan
+        n = len(self.values)
+        return np.mean(self.sorted[(n - 1) // 2: n // 2 + 1])
+
+    def percentile(self, percentile):
+        """The percentile of the values, interpolating linearly as np.percentile."""
+        if self._hasNan():
+            return np.nan
+        return _sortedPercentileAt(self.sorted, np.array([0]), np.array([len(self.values)]), percentile)[0]
+
+
 class PassMetric(BaseMetric):
     """
     Just pass the entire array through
@@ -37,12 +181,23 @@ class Coaddm5Metric(BaseMetric):
     def run(self, dataSlice, slicePoint=None):
         return 1.25 * np.log10(np.sum(10.**(.8*dataSlice[self.colname])))
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        return 1.25 * np.log10(_reduceAt(np.add, 10.**(.8*values), offsets))
+
 class MaxMetric(BaseMetric):
     """Calculate the maximum of a simData column slice.
     """
     def run(self, dataSlice, slicePoint=None):
         return np.max(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        return _reduceAt(np.maximum, values, offsets)
+
+    def runSummary(self, summaryValues):
+        return np.max(summaryValues.values)
+
 class AbsMaxMetric(BaseMetric):
     """Calculate the max of the absolute value of a simData column slice.
     """
@@ -55,6 +210,14 @@ class MeanMetric(BaseMetric):
     def run(self, dataSlice, slicePoint=None):
         return np.mean(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        with np.errstate(invalid='ignore'):
+            return _reduceAt(np.add, values, offsets) / counts
+
+    def runSummary(self, summaryValues):
+        return summaryValues.mean
+
 class AbsMeanMetric(BaseMetric):
     """Calculate the mean of the absolute value of a simData column slice.
     """
@@ -67,6 +230,23 @@ class MedianMetric(BaseMetric):
     def run(self, dataSlice, slicePoint=None):
         return np.median(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        result = np.zeros(len(counts), float) + np.nan
+        nonempty = np.where(counts > 0)[0]
+        if len(nonempty) > 0:
+            sortedValues = _sortedBatchValues(values, counts)
+            # The mean of the middle value(s), as np.median.
+            lo = sortedValues[offsets[nonempty] + (counts[nonempty] - 1) // 2]
+            hi = sortedValues[offsets[nonempty] + counts[nonempty] // 2]
+            result[nonempty] = (lo + hi) / 2.
+            # The median of values including nan is nan, as np.median.
+            result[nonempty[_hasNanAt(sortedValues, offsets[nonempty], counts[nonempty])]] = np.nan
+        return result
+
+    def runSummary(self, summaryValues):
+        return summaryValues.median()
+
 class AbsMedianMetric(BaseMetric):
     """Calculate the median of the absolute value of a simData column slice.
     """
@@ -79,24 +259,44 @@ class MinMetric(BaseMetric):
     def run(self, dataSlice, slicePoint=None):
         return np.min(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        return _reduceAt(np.minimum, values, offsets)
+
+    def runSummary(self, summaryValues):
+        return np.min(summaryValues.values)
+
 class FullRangeMetric(BaseMetric):
     """Calculate the range of a simData column slice.
     """
     def run(self, dataSlice, slicePoint=None):
         return np.max(dataSlice[self.colname])-np.min(dataSlice[self.colname])
 
+    def runSummary(self, summaryValues):
+        return np.max(summaryValues.values) - np.min(summaryValues.values)
+
 class RmsMetric(BaseMetric):
     """Calculate the standard deviation of a simData column slice.
     """
     def run(self, dataSlice, slicePoint=None):
         return np.std(dataSlice[self.colname])
 
+    def runSummary(self, summaryValues):
+        return summaryValues.std
+
 class SumMetric(BaseMetric):
     """Calculate the sum of a simData column slice.
     """
     def run(self, dataSlice, slicePoint=None):
         return np.sum(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        return _reduceAt(np.add, values, offsets)
+
+    def runSummary(self, summaryValues):
+        return np.sum(summaryValues.values)
+
 class CountUniqueMetric(BaseMetric):
     """Return the number of unique values.
     """
@@ -120,6 +320,13 @@ class CountMetric(BaseMetric):
     def run(self, dataSlice, slicePoint=None):
         return len(dataSlice[self.colname])
 
+    def runBatch(self, simData, sliceIndex):
+        offsets, indices = sliceIndex
+        return np.diff(offsets)
+
+    def runSummary(self, summaryValues):
+        return len(summaryValues)
+
 
 class CountExplimMetric(BaseMetric):
     """Count the number of x second visits.  Useful for rejecting very short exposures
@@ -171,6 +378,10 @@ class RobustRmsMetric(BaseMetric):
         rms = iqr/1.349 #approximation
         return rms
 
+    def runSummary(self, summaryValues):
+        iqr = summaryValues.percentile(75) - summaryValues.percentile(25)
+        return iqr / 1.349
+
 class MaxPercentMetric(BaseMetric):
     """Return the percent of the data which has the maximum value.
     """
@@ -214,6 +425,11 @@ class FracAboveMetric(BaseMetric):
         fracAbove = fracAbove * self.scale
         return fracAbove
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        with np.errstate(invalid='ignore'):
+            return _reduceAt(np.add, (values >= self.cutoff).astype(int), offsets) / counts * self.scale
+
 class FracBelowMetric(BaseMetric):
     """Find the fraction of data values below a given value.
     """
@@ -229,6 +445,11 @@ class FracBelowMetric(BaseMetric):
         fracBelow = fracBelow * self.scale
         return fracBelow
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        with np.errstate(invalid='ignore'):
+            return _reduceAt(np.add, (values <= self.cutoff).astype(int), offsets) / counts * self.scale
+
 class PercentileMetric(BaseMetric):
     """Find the value of a column at a given percentile.
     """
@@ -241,6 +462,13 @@ class PercentileMetric(BaseMetric):
         pval = np.percentile(dataSlice[self.colname], self.percentile)
         return pval
 
+    def runBatch(self, simData, sliceIndex):
+        values, offsets, counts = _batchValues(simData, self.colname, sliceIndex)
+        return _percentileAt(values, offsets, counts, self.percentile)
+
+    def runSummary(self, summaryValues):
+        return summaryValues.percentile(self.percentile)
+
 class NoutliersNsigmaMetric(BaseMetric):
     """Calculate the # of visits less than nSigma below the mean (nSigma<0) or
     more than nSigma above the mean of 'col'.
@@ -265,6 +493,12 @@ class NoutliersNsigmaMetric(BaseMetric):
             outsiders = np.where(dataSlice[self.colname] < boundary)
         return len(dataSlice[self.colname][outsiders])
 
+    def runSummary(self, summaryValues):
+        boundary = summaryValues.mean + self.nSigma * summaryValues.std
+        if self.nSigma >= 0:
+            return np.count_nonzero(summaryValues.values > boundary)
+        return np.count_nonzero(summaryValues.values < boundary)
+
 def _rotateAngles(angles):
     """Private utility for the '*Angle' Metrics below.
 
@@ -2,9 +2,14 @@ from builtins import zip
 from builtins import range
 from builtins import object
 import os
+import time
+import hashlib
 import numpy as np
+import pandas as pd
 import warnings
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.colors import Colormap
 import lsst.sims.maf.utils as utils
 
 __all__ = ['applyZPNorm', 'PlotHandler', 'BasePlotter']
@@ -19,6 +24,46 @@ def applyZPNorm(metricValue, plotDict):
     return metricValue
 
 
+def _updateFingerprint(fingerprint, value):
+    """Add a representation of value to the fingerprint (a hashlib hash) of the inputs to a plot.
+
+    Objects without a stable representation (such as functions) change the fingerprint every time,
+    so that plots using them are always redrawn.
+    """
+    if isinstance(value, dict):
+        fingerprint.update(b'{')
+        for key in sorted(value, key=str):
+            fingerprint.update(str(key).encode())
+            _updateFingerprint(fingerprint, value[key])
+        fingerprint.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        fingerprint.update(b'[')
+        for v in value:
+            _updateFingerprint(fingerprint, v)
+        fingerprint.update(b']')
+    elif isinstance(value, np.ma.MaskedArray):
+        _updateFingerprint(fingerprint, value.data)
+        _updateFingerprint(fingerprint, np.ma.getmaskarray(value))
+    elif isinstance(value, np.ndarray):
+        fingerprint.update(('%s%s' % (value.dtype.str, value.shape)).encode())
+        if value.dtype == object:
+            for v in value.ravel():
+                _updateFingerprint(fingerprint, v)
+        else:
+            fingerprint.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, pd.DataFrame):
+        _updateFingerprint(fingerprint, list(value.columns))
+        fingerprint.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, Colormap):
+        fingerprint.update(('Colormap %s' % (value.name)).encode())
+    elif isinstance(value, BasePlotter):
+        # Plotters (which may hold other plotters) are defined by their configuration.
+        fingerprint.update(type(value).__name__.encode())
+        _updateFingerprint(fingerprint, vars(value))
+    else:
+        fingerprint.update(('%s %r' % (type(value).__name__, value)).encode())
+
+
 class BasePlotter(object):
     """
     Serve as the base type for MAF plotters and example of API.
@@ -34,9 +79,31 @@ class BasePlotter(object):
 
 
 class PlotHandler(object):
-
+    """Create (and save) plots of one or more metric bundles.
+
+    Parameters
+    ----------
+    outDir : str, opt
+        The directory in which to save the plots. Default '.'.
+    resultsDb : ResultsDb, opt
+        The results database in which to record the plots. Default None.
+    savefig : bool, opt
+        Save the figures to disk. Default True.
+    figformat : str, opt
+        The matplotlib figure format. Default 'pdf'.
+    dpi : int, opt
+        The dpi of the saved figures. Default 600.
+    thumbnail : bool, opt
+        Also save a png thumbnail of each figure. Default True.
+    trimWhitespace : bool, opt
+        Trim the whitespace around the saved figures. Default True.
+    skipUnchanged : bool, opt
+        If True, a plot is not made again if the plot file (and thumbnail) already exist, and the
+        resultsDb records that they were made from the same metric values, slicer and plot
+        configuration (the same plot fingerprint). Default False.
+    """
     def __init__(self, outDir='.', resultsDb=None, savefig=True,
-                 figformat='pdf', dpi=600, thumbnail=True, trimWhitespace=True):
+                 figformat='pdf', dpi=600, thumbnail=True, trimWhitespace=True, skipUnchanged=False):
         self.outDir = outDir
         self.resultsDb = resultsDb
         self.savefig = savefig
@@ -44,6 +111,10 @@ class PlotHandler(object):
         self.dpi = dpi
         self.trimWhitespace = trimWhitespace
         self.thumbnail = thumbnail
+        self.skipUnchanged = skipUnchanged
+        # The plot fingerprints recorded in the resultsDb (read when first needed), and the plot files skipped.
+        self._fingerprints = None
+        self.skippedFiles = []
         self.filtercolors = {'u': 'cyan', 'g': 'g', 'r': 'y',
                              'i': 'r', 'z': 'm', 'y': 'k', ' ': None}
         self.filterorder = {' ': -1, 'u': 0, 'g': 1, 'r': 2, 'i': 3, 'z': 4, 'y': 5}
@@ -518,6 +589,7 @@ class PlotHandler(object):
                         warnings.warn('Cannot plot object metric values with this plotter.')
                         return
 
+        renderStart = time.time()
         # Update x/y labels using plotType.
         self.setPlotDicts(plotDicts=plotDicts, plotFunc=plotFunc, reset=False)
         # Set outfile name.
@@ -528,6 +600,12 @@ class PlotHandler(object):
         plotType = plotFunc.plotType
         if len(self.mBundles) > 1:
             plotType = 'Combo' + plotType
+        plotFingerprint = None
+        if self.savefig and self.resultsDb:
+            plotFingerprint = self._plotFingerprint(plotFunc, outfile, plotType)
+            if self.skipUnchanged and self._isUnchanged(outfile, plotType, plotFingerprint):
+                self.skippedFiles.append(self._plotFile(outfile, plotType))
+                return None
         # Make plot.
         fignum = None
         for mB, plotDict in zip(self.mBundles, self.plotDicts):
@@ -558,13 +636,49 @@ class PlotHandler(object):
             if displayDict is None:
                 displayDict = self._buildDisplayDict()
             self.saveFig(fignum, outfile, plotType, self.jointMetricNames, self.slicer.slicerName,
-                         self.jointRunNames, self.constraints, self.jointMetadata, displayDict)
+                         self.jointRunNames, self.constraints, self.jointMetadata, displayDict,
+                         plotFingerprint=plotFingerprint, renderStart=renderStart)
         return fignum
 
+    def _plotFile(self, outfileRoot, plotType):
+        return outfileRoot + '_' + plotType + '.' + self.figformat
+
+    def _thumbFile(self, outfileRoot, plotType):
+        return 'thumb.' + outfileRoot + '_' + plotType + '.png'
+
+    def _plotFingerprint(self, plotFunc, outfileRoot, plotType):
+        """Return a fingerprint of everything which goes into a plot (with the current plotDicts).
+
+        This covers the metric values and slicePoints of each metric bundle, the plotDicts,
+        the plotter, the figure settings and the matplotlib version and rcParams (except the backend).
+        """
+        fingerprint = hashlib.sha1()
+        rcParams = dict((k, v) for k, v in plt.rcParams.items() if k not in ('backend', 'interactive'))
+        _updateFingerprint(fingerprint, [matplotlib.__version__, rcParams])
+        _updateFingerprint(fingerprint, [self._plotFile(outfileRoot, plotType), self.figformat, self.dpi,
+                                         self.trimWhitespace, self.thumbnail, plotFunc, self.plotDicts])
+        for mB in self.mBundles:
+            _updateFingerprint(fingerprint, [mB.slicer.slicerName, mB.slicer.slicePoints, mB.metricValues])
+        return fingerprint.hexdigest()
+
+    def _isUnchanged(self, outfileRoot, plotType, plotFingerprint):
+        """Check if the plot files exist, and were made from inputs with the same fingerprint."""
+        if self._fingerprints is None:
+            self._fingerprints = self.resultsDb.getPlotFingerprints()
+        plotFile = self._plotFile(outfileRoot, plotType)
+        if self._fingerprints.get(plotFile) != plotFingerprint:
+            return False
+        if not os.path.isfile(os.path.join(self.outDir, plotFile)):
+            return False
+        if self.thumbnail and not os.path.isfile(os.path.join(self.outDir,
+                                                             self._thumbFile(outfileRoot, plotType))):
+            return False
+        return True
+
     def saveFig(self, fignum, outfileRoot, plotType, metricName, slicerName,
-                runName, constraint, metadata, displayDict=None):
+                runName, constraint, metadata, displayDict=None, plotFingerprint=None, renderStart=None):
         fig = plt.figure(fignum)
-        plotFile = outfileRoot + '_' + plotType + '.' + self.figformat
+        plotFile = self._plotFile(outfileRoot, plotType)
         if self.trimWhitespace:
             fig.savefig(os.path.join(self.outDir, plotFile), dpi=self.dpi,
                         bbox_inches='tight', format=self.figformat)
@@ -572,7 +686,7 @@ class PlotHandler(object):
             fig.savefig(os.path.join(self.outDir, plotFile), dpi=self.dpi, format=self.figformat)
         # Generate a png thumbnail.
         if self.thumbnail:
-            thumbFile = 'thumb.' + outfileRoot + '_' + plotType + '.png'
+            thumbFile = self._thumbFile(outfileRoot, plotType)
             plt.savefig(os.path.join(self.outDir, thumbFile), dpi=72, bbox_inches='tight')
         # Save information about the file to resultsDb.
         if self.resultsDb:
@@ -581,4 +695,6 @@ class PlotHandler(object):
             metricId = self.resultsDb.updateMetric(metricName, slicerName, runName, constraint,
                                                    metadata, None)
             self.resultsDb.updateDisplay(metricId=metricId, displayDict=displayDict, overwrite=False)
-            self.resultsDb.updatePlot(metricId=metricId, plotType=plotType, plotFile=plotFile)
+            renderTime = None if renderStart is None else time.time() - renderStart
+            self.resultsDb.updatePlot(metricId=metricId, plotType=plotType, plotFile=plotFile,
+                                      plotFingerprint=plotFingerprint, renderTime=renderTime)
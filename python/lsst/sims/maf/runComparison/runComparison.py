@@ -5,7 +5,8 @@ import os
 import warnings
 import numpy as np
 import pandas as pd
-from lsst.sims.maf.db import ResultsDb
+from sqlalchemy import create_engine, text
+from lsst.sims.maf.db import ResultsDb, MetricRow, SummaryStatRow
 import lsst.sims.maf.metricBundles as mb
 import lsst.sims.maf.plots as plots
 
@@ -52,13 +53,22 @@ class RunComparison(object):
         A list of directories (relative to baseDir) where the MAF outputs in runNames reside.
         Optional - if not provided, assumes directories are simply the names in runNames.
         Must have same length as runNames (note that runNames can contain duplicate entries).
+    statsCache : str, opt
+        The filename of a sqlite file in which to cache the summary statistics of all runs.
+        The summary statistics are read from all of the results databases once (one query per
+        results database) and combined into a single table. If statsCache is set, this table is saved
+        and reused by later RunComparisons, as long as none of the results databases has changed.
+        Default None (do not cache the summary statistics).
     """
     def __init__(self, baseDir, runNames, rundirs=None,
-                 defaultResultsDb='resultsDb_sqlite.db', verbose=False):
+                 defaultResultsDb='resultsDb_sqlite.db', verbose=False, statsCache=None):
         self.baseDir = baseDir
         self.runlist = runNames
         self.verbose = verbose
         self.defaultResultsDb = defaultResultsDb
+        self.statsCache = statsCache
+        # All of the summary statistics of all runs, grouped by metricName (read when first needed).
+        self._metricStats = None
         if rundirs is not None:
             if len(rundirs) != len(self.runlist):
                 raise ValueError('runNames and rundirs must be the same length')
@@ -106,6 +116,74 @@ class RunComparison(object):
         # Now de-duplicate the runlist (we don't need to loop over extra items).
         self.runlist = list(self.runresults.keys())
 
+    def _statSources(self):
+        """Return the run name, subdirectory, results database filename and modification time
+        of each of the results databases (in the order they are searched)."""
+        sources = []
+        for r in self.runlist:
+            for subdir, resultsDb in self.runresults[r].items():
+                database = os.path.abspath(resultsDb.database)
+                sources.append((r, subdir, database, os.path.getmtime(database)))
+        return pd.DataFrame(sources, columns=['runName', 'subdir', 'database', 'mtime'])
+
+    def _readSummaryStats(self):
+        """Read all of the summary statistics of all runs, with a single query for each results database.
+
+        Returns
+        -------
+        pandas DataFrame
+            One row per summary statistic, with the runName, subdir, metricId, metricName,
+            metricMetadata, slicerName, summaryName and summaryValue.
+            Within each results database, the rows are in the order used by ResultsDb.getMetricId.
+        """
+        sources = self._statSources()
+        engine = None
+        if self.statsCache is not None:
+            engine = create_engine('sqlite:///%s' % self.statsCache)
+            if os.path.isfile(self.statsCache):
+                try:
+                    cachedSources = pd.read_sql_table('sources', engine)
+                    if (list(cachedSources.itertuples(index=False, name=None))
+                            == list(sources.itertuples(index=False, name=None))):
+                        return pd.read_sql_table('summarystats', engine)
+                except ValueError:
+                    # The cache is missing a table; rebuild it.
+                    pass
+        frames = []
+        for r, subdir in zip(sources['runName'], sources['subdir']):
+            resultsDb = self.runresults[r][subdir]
+            query = (resultsDb.session.query(MetricRow.metricId, MetricRow.metricName,
+                                             MetricRow.metricMetadata, MetricRow.slicerName,
+                                             SummaryStatRow.summaryName, SummaryStatRow.summaryValue)
+                     .filter(MetricRow.metricId == SummaryStatRow.metricId)
+                     .order_by(MetricRow.slicerName, MetricRow.metricMetadata, MetricRow.metricId,
+                               SummaryStatRow.statId))
+            stats = pd.read_sql(query.statement, resultsDb.session.bind)
+            stats.insert(0, 'runName', r)
+            stats.insert(1, 'subdir', subdir)
+            frames.append(stats)
+        columns = ['runName', 'subdir', 'metricId', 'metricName', 'metricMetadata', 'slicerName',
+                   'summaryName', 'summaryValue']
+        if len(frames) == 0:
+            stats = pd.DataFrame(columns=columns)
+        else:
+            stats = pd.concat(frames, ignore_index=True)
+        if engine is not None:
+            stats.to_sql('summarystats', engine, if_exists='replace', index=False)
+            sources.to_sql('sources', engine, if_exists='replace', index=False)
+            with engine.begin() as conn:
+                conn.execute(text('create index if not exists idx_metricName on summarystats (metricName)'))
+        return stats
+
+    def _statsForMetric(self, metricName):
+        """Return the summary statistics of all runs for metricName (reading all statistics if needed)."""
+        if self._metricStats is None:
+            stats = self._readSummaryStats()
+            self._metricStats = {name: group for name, group in stats.groupby('metricName', sort=False)}
+        if metricName not in self._metricStats:
+            return None
+        return self._metricStats[metricName]
+
     def close(self):
         """
         Close all connections to the results database files.
@@ -215,19 +293,30 @@ class RunComparison(object):
         """
         summaryValues = {}
         summaryNames = {}
+        # Select the matching summary statistics of all runs at once.
+        matching = {}
+        metricStats = self._statsForMetric(metricName)
+        if metricStats is not None:
+            selection = np.ones(len(metricStats), bool)
+            if metricMetadata is not None:
+                selection &= (metricStats['metricMetadata'] == metricMetadata).values
+            if slicerName is not None:
+                selection &= (metricStats['slicerName'] == slicerName).values
+            if summaryName is not None:
+                selection &= (metricStats['summaryName'] == summaryName).values
+            for key, group in metricStats[selection].groupby(['runName', 'subdir'], sort=False):
+                matching[key] = {'summaryName': group['summaryName'].values,
+                                 'summaryValue': group['summaryValue'].values}
         for r in self.runlist:
             summaryValues[r] = {}
             summaryNames[r] = {}
             # Check if this metric/metadata/slicer/summary stat name combo is in
             # this resultsDb .. or potentially in another subdirectory's resultsDb.
             for subdir in self.runresults[r]:
-                mId = self.runresults[r][subdir].getMetricId(metricName=metricName,
-                                                             metricMetadata=metricMetadata,
-                                                             slicerName=slicerName)
                 # Note that we may have more than one matching summary metric value per run.
-                if len(mId) > 0:
+                if (r, subdir) in matching:
                     # And we may have more than one summary metric value per resultsDb
-                    stats = self.runresults[r][subdir].getSummaryStats(mId, summaryName=summaryName)
+                    stats = matching[(r, subdir)]
                     if len(stats['summaryName']) == 1 and colName is not None:
                         name = colName
                         summaryValues[r][name] = stats['summaryValue'][0]
@@ -271,11 +360,10 @@ class RunComparison(object):
         header = pd.DataFrame([summaryBase, mName, mData, sName, suNames],
                               index=['BaseName', 'MetricName', 'MetricMetadata',
                                      'SlicerName', 'SummaryName'])
-        tempDFList = []
-        for r in self.runlist:
-            tempDFList.append(pd.DataFrame(summaryValues[r], index=[r]))
-        # Concatenate dataframes for each run.
-        stats = pd.concat(tempDFList)
+        # Build the dataframe of all runs at once (with the columns in the order they were found).
+        columns = list(dict.fromkeys(s for r in self.runlist for s in summaryValues[r]))
+        stats = pd.DataFrame([[summaryValues[r][s] for s in columns] for r in self.runlist],
+                             index=self.runlist, columns=columns)
         return header, stats
 
     def addSummaryStats(self, metricDict=None, verbose=False):
@@ -307,6 +395,8 @@ class RunComparison(object):
         """
         if metricDict is None:
             metricDict = self.buildMetricDict()
+        headers = []
+        stats = []
         for mName, metric in metricDict.items():
             if 'summaryName' not in metric:
                 metric['summaryName'] = None
@@ -315,10 +405,23 @@ class RunComparison(object):
                                                            slicerName=metric['slicerName'],
                                                            summaryName=metric['summaryName'],
                                                            colName=mName, verbose=verbose)
-            if self.summaryStats is None:
-                self.summaryStats = tempStats
-                self.headerStats = tempHeader
-            else:
+            headers.append(tempHeader)
+            stats.append(tempStats)
+        if self.summaryStats is not None:
+            headers.insert(0, self.headerStats)
+            stats.insert(0, self.summaryStats)
+        if len(stats) == 0:
+            return
+        columns = [c for s in stats for c in s.columns]
+        if len(set(columns)) == len(columns):
+            # Build the dataframes in one step (all of them are indexed by the runlist).
+            self.summaryStats = pd.concat(stats, axis=1)
+            self.headerStats = pd.concat(headers, axis=1)
+        else:
+            # Join one at a time, to rename duplicate columns.
+            self.summaryStats = stats[0]
+            self.headerStats = headers[0]
+            for tempHeader, tempStats in zip(headers[1:], stats[1:]):
                 self.summaryStats = self.summaryStats.join(tempStats, lsuffix='_x')
                 self.headerStats = self.headerStats.join(tempHeader, lsuffix='_x')
 
@@ -4,6 +4,7 @@ from .oneDSlicer import *
 from .nDSlicer import *
 from .movieSlicer import *
 from .hourglassSlicer import *
+from .cameraFootprint import *
 from .baseSpatialSlicer import *
 from .healpixSlicer import *
 from .healpixSubsetSlicer import *
@@ -8,16 +8,133 @@ from builtins import object
 # Base class for all 'Slicer' objects.
 #
 import inspect
+import os
 from io import StringIO
 import json
 import warnings
 import numpy as np
 import numpy.ma as ma
+import pandas as pd
+from matplotlib import cm
+from matplotlib.colors import Colormap
 from lsst.sims.maf.utils import getDateVersion
 from future.utils import with_metaclass
 
 __all__ = ['SlicerRegistry', 'BaseSlicer']
 
+
+class _HeaderEncoder(json.JSONEncoder):
+    """Encode the numpy (and colormap) values found in the headers of 'npy' format metric data files."""
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return {'__ndarray__': obj.tolist(), 'dtype': obj.dtype.str}
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, Colormap):
+            return {'__cmap__': obj.name}
+        warnings.warn('Cannot save %s in the metric data file header; saving None instead.' % (obj,))
+        return None
+
+
+def _decodeHeader(obj):
+    """Restore the values encoded by _HeaderEncoder (as a json object_hook)."""
+    if '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+    if '__cmap__' in obj:
+        try:
+            return cm.get_cmap(obj['__cmap__'])
+        except ValueError:
+            warnings.warn('Cannot restore colormap %s; using the default.' % (obj['__cmap__']))
+            return None
+    return obj
+
+
+def _loadNpy(filename, mmapMode):
+    """Load a .npy file, memory-mapped if possible (empty arrays cannot be memory-mapped)."""
+    try:
+        return np.load(filename, mmap_mode=mmapMode)
+    except ValueError:
+        return np.load(filename)
+
+
+def _writeObjectValues(outDir, data, mask):
+    """Write object metric values (one dict or array per slicePoint) as columns, if possible.
+
+    The keys of the dicts (or the arrays themselves) become columns: values with the same shape
+    at every (unmasked) slicePoint are fields of one structured array, while one dimensional values
+    with varying lengths are concatenated into a single array, plus an array of offsets.
+
+    Returns
+    -------
+    dict
+        The layout of the files written, to save in the header, or None if the values
+        do not fit in columns (e.g. nested dicts or strings).
+    """
+    flatData = data.ravel()
+    valid = np.ones(len(flatData), bool) if np.ndim(mask) == 0 else ~np.ravel(mask)
+    values = flatData[valid]
+    isDict = len(values) > 0 and isinstance(values[0], dict)
+    keys = list(values[0].keys()) if isDict else [None]
+    if not all(isinstance(v, dict) == isDict for v in values):
+        return None
+    # The keys are saved in the (JSON) header, so must be strings.
+    if isDict and not all(isinstance(key, str) for key in keys):
+        return None
+    if isDict and not all(list(v.keys()) == keys for v in values):
+        return None
+    fields = []
+    ragged = []
+    for i, key in enumerate(keys):
+        items = [np.asarray(v[key] if isDict else v) for v in values]
+        shapes = set(item.shape for item in items)
+        if len(shapes) <= 1:
+            column = np.array(items)
+            if column.dtype.kind not in 'biuf':
+                return None
+            fields.append((i, column))
+        elif all(len(shape) == 1 for shape in shapes):
+            column = np.concatenate(items)
+            if column.dtype.kind not in 'biuf':
+                return None
+            offsets = np.zeros(len(flatData) + 1, int)
+            offsets[1:][valid] = [len(item) for item in items]
+            ragged.append((i, column, np.cumsum(offsets)))
+        else:
+            return None
+    struct = np.zeros(len(flatData), dtype=[('f%d' % i, column.dtype, column.shape[1:])
+                                            for i, column in fields])
+    for i, column in fields:
+        struct['f%d' % i][valid] = column
+    np.save(os.path.join(outDir, 'metricValues.npy'), struct)
+    for i, column, offsets in ragged:
+        np.save(os.path.join(outDir, 'metricValues_f%d.npy' % i), column)
+        np.save(os.path.join(outDir, 'metricValues_f%d_offsets.npy' % i), offsets)
+    return {'kind': 'columns', 'keys': keys if isDict else None, 'shape': data.shape,
+            'ragged': [i for i, column, offsets in ragged]}
+
+
+def _readObjectValues(inDir, layout, mask, mmapMode):
+    """Rebuild the object metric values written by _writeObjectValues."""
+    struct = _loadNpy(os.path.join(inDir, 'metricValues.npy'), mmapMode)
+    ragged = {}
+    for i in layout['ragged']:
+        ragged[i] = (_loadNpy(os.path.join(inDir, 'metricValues_f%d.npy' % i), mmapMode),
+                     np.load(os.path.join(inDir, 'metricValues_f%d_offsets.npy' % i)))
+    keys = layout['keys']
+    nKeys = 1 if keys is None else len(keys)
+    values = np.empty(len(struct), object)
+    valid = np.ones(len(struct), bool) if mask is None or np.ndim(mask) == 0 else ~np.ravel(mask)
+    for idx in np.where(valid)[0]:
+        value = []
+        for i in range(nKeys):
+            if i in ragged:
+                column, offsets = ragged[i]
+                value.append(column[offsets[idx]:offsets[idx + 1]])
+            else:
+                value.append(struct['f%d' % i][idx])
+        values[idx] = value[0] if keys is None else dict(zip(keys, value))
+    return values.reshape(layout['shape'])
+
 class SlicerRegistry(type):
     """
     Meta class for slicers, to build a registry of slicer classes.
@@ -70,9 +187,9 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
         self.verbose = verbose
         self.badval = badval
         # Set cacheSize : each slicer will be able to override if appropriate.
-        # Currently only the healpixSlice actually uses the cache: this is set in 'useCache' flag.
-        #  If other slicers have the ability to use the cache, they should add this flag and set the
-        #  cacheSize in their __init__ methods.
+        # This is the size of the metric result cache used by the MetricBundleGroup (which can also
+        #  override it for any slicer). The healpix slicers set it with their 'useCache' flag;
+        #  other slicers that are likely to repeat sets of visits could add this flag as well.
         self.cacheSize = 0
         # Set length of Slicer.
         self.nslice = None
@@ -174,16 +291,24 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
         raise NotImplementedError('This method is set up by "setupSlicer" - run that first.')
 
     def writeData(self, outfilename, metricValues, metricName='',
-                  simDataName ='', constraint=None, metadata='', plotDict=None, displayDict=None):
+                  simDataName ='', constraint=None, metadata='', plotDict=None, displayDict=None,
+                  fileFormat='npz'):
         """
         Save metric values along with the information required to re-build the slicer.
 
         Parameters
         -----------
         outfilename : str
-            The output file name.
+            The output file name (or directory name, for the 'npy' fileFormat).
         metricValues : np.ma.MaskedArray or np.ndarray
             The metric values to save to disk.
+        fileFormat : {'npz', 'npy'}, opt
+            'npz' (default) saves everything in a single numpy npz file, pickling the header, slicer
+            information and any object metric values.
+            'npy' saves a directory holding the header and slicer information as JSON, with the metric
+            values, mask and slicePoint arrays as separate (uncompressed) .npy files, which readData
+            memory-maps. Object metric values (such as dicts of values) are saved as columns of
+            structured arrays, falling back to a pickled array only if they do not fit into columns.
         """
         header = {}
         header['metricName']=metricName
@@ -206,6 +331,11 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
             data = metricValues
             mask = None
             fill = None
+        if fileFormat == 'npy':
+            self._writeDataNpy(outfilename, header, data, mask, fill)
+            return
+        elif fileFormat != 'npz':
+            raise ValueError('Unknown metric data fileFormat %s' % (fileFormat))
         # npz file acts like dictionary: each keyword/value pair below acts as a dictionary in loaded NPZ file.
         np.savez(outfilename,
                  header = header,  # header saved as dictionary
@@ -218,6 +348,48 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
                  slicerNSlice = self.nslice,
                  slicerShape = self.shape)
 
+    def _writeDataNpy(self, outDir, header, data, mask, fill):
+        """Save the metric values and slicer information as a directory of .npy files and a JSON header."""
+        if not os.path.isdir(outDir):
+            os.makedirs(outDir)
+        contents = {'header': header, 'slicer_init': self.slicer_init, 'slicerName': self.slicerName,
+                    'slicerNSlice': self.nslice, 'slicerShape': self.shape, 'fill': fill}
+        # Save the slicePoint arrays (which can be as large as the metric values) separately.
+        slicePoints = {}
+        contents['slicePointFiles'] = {}
+        for i, (key, value) in enumerate(self.slicePoints.items()):
+            if isinstance(value, pd.DataFrame):
+                # Strings (object columns) cannot be memory-mapped, so store them as fixed length strings.
+                value = np.array(value.to_records(index=False).tolist(),
+                                 dtype=[(name, value[name].values.astype(str).dtype
+                                         if value[name].dtype == object else value[name].dtype)
+                                        for name in value.columns])
+                contents['slicePointFiles'][key] = ('slicePoints_%d.npy' % i, 'DataFrame')
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                contents['slicePointFiles'][key] = ('slicePoints_%d.npy' % i, 'ndarray')
+            else:
+                slicePoints[key] = value
+                continue
+            np.save(os.path.join(outDir, 'slicePoints_%d.npy' % i), value)
+        contents['slicePoints'] = slicePoints
+        data = np.asarray(data)
+        contents['metricValues'] = None
+        if data.dtype == object:
+            contents['metricValues'] = _writeObjectValues(outDir, data, mask)
+            if contents['metricValues'] is None:
+                np.save(os.path.join(outDir, 'metricValues.npy'), data, allow_pickle=True)
+                contents['metricValues'] = {'kind': 'pickle'}
+        else:
+            np.save(os.path.join(outDir, 'metricValues.npy'), data)
+            contents['metricValues'] = {'kind': 'array'}
+        if mask is not None and np.ndim(mask) > 0:
+            np.save(os.path.join(outDir, 'mask.npy'), np.asarray(mask, bool))
+            contents['mask'] = 'mask.npy'
+        else:
+            contents['mask'] = None if mask is None else bool(mask)
+        with open(os.path.join(outDir, 'header.json'), 'w') as f:
+            json.dump(contents, f, cls=_HeaderEncoder)
+
     def outputJSON(self, metricValues, metricName='',
                   simDataName ='', metadata='', plotDict=None):
         """
@@ -340,7 +512,9 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
         Parameters
         -----------
         infilename: str
-            The filename containing the metric data.
+            The filename containing the metric data (or the directory, for data saved in the 'npy'
+            fileFormat, in which case the metric values, mask and slicePoint arrays are memory-mapped
+            copy-on-write, so that they are only read from disk when used).
 
         Returns
         -------
@@ -349,13 +523,22 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
             containing header information (runName, metadata, etc.).
         """
         import lsst.sims.maf.slicers as slicers
-        # Allowing pickles here is required, because otherwise we cannot restore data saved as objects.
-        restored = np.load(infilename, allow_pickle=True)
+        if os.path.isdir(infilename):
+            restored = self._readDataNpy(infilename)
+        else:
+            # Allowing pickles here is required, because otherwise we cannot restore data saved as objects.
+            npz = np.load(infilename, allow_pickle=True)
+            restored = {}
+            for key in ('header', 'slicer_init', 'slicePoints', 'mask', 'fill'):
+                restored[key] = npz[key][()]
+            restored['slicerName'] = str(npz['slicerName'])
+            for key in ('slicerNSlice', 'slicerShape', 'metricValues'):
+                restored[key] = npz[key]
         # Get metadata and other simData info.
-        header = restored['header'][()]
-        slicer_init = restored['slicer_init'][()]
-        slicerName = str(restored['slicerName'])
-        slicePoints = restored['slicePoints'][()]
+        header = restored['header']
+        slicer_init = restored['slicer_init']
+        slicerName = restored['slicerName']
+        slicePoints = restored['slicePoints']
         # Backwards compatibility issue - map 'spatialkey1/spatialkey2' to 'lonCol/latCol'.
         if 'spatialkey1' in slicer_init:
             slicer_init['lonCol'] = slicer_init['spatialkey1']
@@ -373,10 +556,29 @@ class BaseSlicer(with_metaclass(SlicerRegistry, object)):
         slicer.slicePoints = slicePoints
         slicer.shape = restored['slicerShape']
         # Get metric data set
-        if restored['mask'][()] is None:
+        if restored['mask'] is None:
             metricValues = ma.MaskedArray(data=restored['metricValues'])
         else:
             metricValues = ma.MaskedArray(data=restored['metricValues'],
                                           mask=restored['mask'],
                                           fill_value=restored['fill'])
         return metricValues, slicer, header
+
+    def _readDataNpy(self, inDir, mmapMode='c'):
+        """Read the contents of a metric data directory written in the 'npy' fileFormat."""
+        with open(os.path.join(inDir, 'header.json')) as f:
+            restored = json.load(f, object_hook=_decodeHeader)
+        for key, (filename, kind) in restored['slicePointFiles'].items():
+            value = _loadNpy(os.path.join(inDir, filename), mmapMode)
+            restored['slicePoints'][key] = pd.DataFrame(value) if kind == 'DataFrame' else value
+        if restored['mask'] == 'mask.npy':
+            restored['mask'] = _loadNpy(os.path.join(inDir, 'mask.npy'), mmapMode)
+        layout = restored['metricValues']
+        filename = os.path.join(inDir, 'metricValues.npy')
+        if layout['kind'] == 'array':
+            restored['metricValues'] = _loadNpy(filename, mmapMode)
+        elif layout['kind'] == 'pickle':
+            restored['metricValues'] = np.load(filename, allow_pickle=True)
+        else:
+            restored['metricValues'] = _readObjectValues(inDir, layout, restored['mask'], mmapMode)
+        return restored
@@ -1,4 +1,3 @@
-from builtins import zip
 from builtins import range
 # The base class for all spatial slicers.
 # Slicers are 'data slicers' at heart; spatial slicers slice data by RA/Dec and
@@ -6,17 +5,20 @@ from builtins import range
 # The primary things added here are the methods to slice the data (for any spatial slicer)
 #  as this uses a KD-tree built on spatial (RA/Dec type) indexes.
 
+import os
+import hashlib
 import warnings
 import numpy as np
 from functools import wraps
+from itertools import chain
 from lsst.sims.maf.plots.spatialPlotters import BaseHistogram, BaseSkyMap
 
 # For the footprint generation and conversion between galactic/equatorial coordinates.
 from lsst.obs.lsst import LsstCamMapper
-from lsst.sims.coordUtils import _chipNameFromRaDec
 import lsst.sims.utils as simsUtils
 
 from .baseSlicer import BaseSlicer
+from .cameraFootprint import CameraFootprint
 
 __all__ = ['BaseSpatialSlicer']
 
@@ -61,11 +63,24 @@ class BaseSpatialSlicer(BaseSlicer):
         Default 'all' - this uses all chips in the camera.
     scienceChips : bool (True)
         Do not include wavefront sensors when checking if a point landed on a chip.
+    batchSize : int, optional
+        Number of slicePoints to query against the kdtree at once. The matching simData indexes for
+        each batch are stored as a compressed (offsets + flat index array) lookup, so that stepping
+        through the slicePoints is just array slicing. Default 2048.
+    lookupCacheDir : str, optional
+        Directory in which to save the slicePoint to simData index lookup (and the chipNames, if
+        useCamera is True). The lookup file is keyed by a hash of the pointing data, the slicePoints and
+        the matching options, so later slicers set up on the same data can read the lookup
+        instead of recalculating it. Default None (do not save or reuse the lookup).
+    nProcs : int, optional
+        Number of processes to use when matching the visits against the camera footprint.
+        Only used if useCamera is True. Default 1.
     """
     def __init__(self, lonCol='fieldRA', latCol='fieldDec', latLonDeg=True,
                  verbose=True, badval=-666, leafsize=100, radius=1.75,
                  useCamera=False, rotSkyPosColName='rotSkyPos', mjdColName='observationStartMJD',
-                 chipNames='all', scienceChips=True):
+                 chipNames='all', scienceChips=True, batchSize=2048, lookupCacheDir=None,
+                 nProcs=1):
         super(BaseSpatialSlicer, self).__init__(verbose=verbose, badval=badval)
         self.lonCol = lonCol
         self.latCol = latCol
@@ -85,6 +100,11 @@ class BaseSpatialSlicer(BaseSlicer):
         self.useCamera = useCamera
         self.chipsToUse = chipNames
         self.scienceChips = scienceChips
+        self.batchSize = max(int(batchSize), 1)
+        self.lookupCacheDir = lookupCacheDir
+        self.nProcs = nProcs
+        # Whether the lookup for all slicePoints is held as the current batch (see _setLookup).
+        self._fullLookup = False
         # RA and Dec are required slicePoint info for any spatial slicer. Slicepoint RA/Dec are in radians.
         self.slicePoints['sid'] = None
         self.slicePoints['ra'] = None
@@ -111,105 +131,219 @@ class BaseSpatialSlicer(BaseSlicer):
                               'Should probably set useCache=False in slicer.')
             self._runMaps(maps)
         self._setRad(self.radius)
-        if self.useCamera:
-            self._setupLSSTCamera()
-            self._presliceFootprint(simData)
-        else:
-            if self.latLonDeg:
-                self._buildTree(np.radians(simData[self.lonCol]),
-                                np.radians(simData[self.latCol]), self.leafsize)
+        # Reset the currently cached batch of kdtree results.
+        self._batchStart = 0
+        self._batchStop = 0
+        self._batchChipNames = None
+        self._fullLookup = False
+        lookupFile = None
+        if self.lookupCacheDir is not None:
+            lookupFile = self._lookupCacheFile(simData)
+            if os.path.isfile(lookupFile):
+                self._readLookup(lookupFile)
+        if not self._fullLookup:
+            if self.useCamera:
+                self._setupLSSTCamera()
+                self._presliceFootprint(simData)
             else:
-                self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
+                if self.latLonDeg:
+                    self._buildTree(np.radians(simData[self.lonCol]),
+                                    np.radians(simData[self.latCol]), self.leafsize)
+                else:
+                    self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
+            if lookupFile is not None:
+                self._writeLookup(lookupFile)
+
+        self._setupSlicePointKeys()
 
         @wraps(self._sliceSimData)
         def _sliceSimData(islice):
             """Return indexes for relevant opsim data at slicepoint
             (slicepoint=lonCol/latCol value .. usually ra/dec)."""
-
-            # Build dict for slicePoint info
-            slicePoint = {}
-            if self.useCamera:
-                indices = self.sliceLookup[islice]
-                slicePoint['chipNames'] = self.chipNames[islice]
-            else:
-                sx, sy, sz = simsUtils._xyz_from_ra_dec(self.slicePoints['ra'][islice],
-                                                        self.slicePoints['dec'][islice])
-                # Query against tree.
-                indices = self.opsimtree.query_ball_point((sx, sy, sz), self.rad)
-
-            # Loop through all the slicePoint keys. If the first dimension of slicepoint[key] has
-            # the same shape as the slicer, assume it is information per slicepoint.
-            # Otherwise, pass the whole slicePoint[key] information. Useful for stellar LF maps
-            # where we want to pass only the relevant LF and the bins that go with it.
-            for key in self.slicePoints:
-                if len(np.shape(self.slicePoints[key])) == 0:
-                    keyShape = 0
-                else:
-                    keyShape = np.shape(self.slicePoints[key])[0]
-                if (keyShape == self.nslice):
-                    slicePoint[key] = self.slicePoints[key][islice]
-                else:
-                    slicePoint[key] = self.slicePoints[key]
+            # Query the tree for the whole batch containing islice, if not already done.
+            if not (self._batchStart <= islice < self._batchStop):
+                self._batchStart = (islice // self.batchSize) * self.batchSize
+                self._batchStop = min(self._batchStart + self.batchSize, self.nslice)
+                self._batchOffsets, self._batchIndices = self.sliceIndexBatch(self._batchStart,
+                                                                              self._batchStop)
+            i = islice - self._batchStart
+            indices = self._batchIndices[self._batchOffsets[i]:self._batchOffsets[i + 1]]
+            slicePoint = self._slicePointInfo(islice)
             return {'idxs': indices, 'slicePoint': slicePoint}
         setattr(self, '_sliceSimData', _sliceSimData)
 
+    def _setupSlicePointKeys(self):
+        """Identify which slicePoint keys hold information per slicePoint.
+
+        If the first dimension of slicepoint[key] has the same shape as the slicer, assume it is
+        information per slicepoint. Otherwise, pass the whole slicePoint[key] information. Useful for
+        stellar LF maps where we want to pass only the relevant LF and the bins that go with it.
+        """
+        self._perSliceKeys = []
+        self._wholeKeys = []
+        for key in self.slicePoints:
+            if len(np.shape(self.slicePoints[key])) == 0:
+                keyShape = 0
+            else:
+                keyShape = np.shape(self.slicePoints[key])[0]
+            if (keyShape == self.nslice):
+                self._perSliceKeys.append(key)
+            else:
+                self._wholeKeys.append(key)
+
+    def _slicePointInfo(self, islice):
+        """Build the slicePoint metadata dictionary for slicePoint islice."""
+        slicePoint = {}
+        if self.useCamera:
+            slicePoint['chipNames'] = self._batchChipNames[self._batchOffsets[islice]:
+                                                           self._batchOffsets[islice + 1]]
+        for key in self._perSliceKeys:
+            slicePoint[key] = self.slicePoints[key][islice]
+        for key in self._wholeKeys:
+            slicePoint[key] = self.slicePoints[key]
+        return slicePoint
+
+    def canSliceBatch(self):
+        """Return True if the slicer can find the simData indexes of its slicePoints with sliceIndexBatch.
+
+        This is only the case if the slicer selects its visits with the _sliceSimData set up by
+        BaseSpatialSlicer.setupSlicer. Subclasses which set up their own _sliceSimData (such as the
+        HealpixSubsetSlicer or HealpixComCamSlicer) select visits which sliceIndexBatch would not match.
+        """
+        mro = type(self).__mro__
+        return not any('setupSlicer' in c.__dict__ or '_sliceSimData' in c.__dict__
+                       for c in mro[:mro.index(BaseSpatialSlicer)])
+
+    def sliceIndexBatch(self, start, stop):
+        """Find the simData indexes relevant for each of slicePoints start:stop.
+
+        All of these slicePoints are matched against the kdtree in a single query (the camera
+        footprint lookup is always calculated for all slicePoints at once, in _presliceFootprint).
+        The results are returned in a compressed (CSR-style) form.
+        Only available for slicers which use the base slicing of visits (see canSliceBatch).
+
+        Parameters
+        ----------
+        start : int
+            The first slicePoint of the batch.
+        stop : int
+            One past the last slicePoint of the batch.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The offsets (length stop - start + 1) and the flat array of simData indexes.
+            The indexes for slicePoint start + i are indices[offsets[i]:offsets[i + 1]].
+        """
+        if not self.canSliceBatch():
+            raise NotImplementedError('%s selects its own visits for each slicePoint, which sliceIndexBatch '
+                                      'does not match.' % (self.__class__.__name__))
+        if self._fullLookup:
+            offsets = self._batchOffsets[start:stop + 1]
+            return offsets - offsets[0], self._batchIndices[offsets[0]:offsets[-1]]
+        sx, sy, sz = simsUtils._xyz_from_ra_dec(self.slicePoints['ra'][start:stop],
+                                                self.slicePoints['dec'][start:stop])
+        lookups = self.opsimtree.query_ball_point(np.array([sx, sy, sz]).T, self.rad)
+        counts = np.fromiter(map(len, lookups), dtype=int, count=len(lookups))
+        offsets = np.zeros(len(lookups) + 1, dtype=int)
+        np.cumsum(counts, out=offsets[1:])
+        indices = np.fromiter(chain.from_iterable(lookups), dtype=int, count=offsets[-1])
+        # Return the indexes within each slicePoint in simData order.
+        sliceIds = np.repeat(np.arange(len(lookups)), counts)
+        indices = indices[np.lexsort((indices, sliceIds))]
+        return offsets, indices
+
+    def _lookupCacheFile(self, simData):
+        """Return the name of the lookup cache file for this slicer configuration and simData.
+
+        The file name is a hash of the pointing columns (and rotSkyPos/MJD if using the camera),
+        the slicePoint locations, the matching radius and the camera options.
+        """
+        cols = [self.lonCol, self.latCol]
+        if self.useCamera:
+            cols += [self.rotSkyPosColName, self.mjdColName]
+        lookupHash = hashlib.sha1()
+        for col in cols:
+            lookupHash.update(np.ascontiguousarray(simData[col], dtype=float).tobytes())
+        for key in ('ra', 'dec'):
+            lookupHash.update(np.ascontiguousarray(self.slicePoints[key], dtype=float).tobytes())
+        options = (self.radius, self.latLonDeg, self.useCamera, self.chipsToUse, self.scienceChips)
+        lookupHash.update(repr(options).encode())
+        return os.path.join(self.lookupCacheDir, 'sliceLookup_%s.npz' % (lookupHash.hexdigest()))
+
+    def _writeLookup(self, lookupFile):
+        """Calculate the lookup for all slicePoints and save it to lookupFile."""
+        offsets = [np.zeros(1, dtype=int)]
+        indices = []
+        for start in range(0, self.nslice, self.batchSize):
+            stop = min(start + self.batchSize, self.nslice)
+            batchOffsets, batchIndices = self.sliceIndexBatch(start, stop)
+            offsets.append(batchOffsets[1:] + offsets[-1][-1])
+            indices.append(batchIndices)
+        lookup = {'offsets': np.concatenate(offsets), 'indices': np.concatenate(indices)}
+        if self.useCamera:
+            lookup['chipNames'] = self._batchChipNames
+        if not os.path.isdir(self.lookupCacheDir):
+            os.makedirs(self.lookupCacheDir)
+        # Write to a temporary file first, so an interrupted write does not leave a bad cache file.
+        tmpFile = lookupFile.replace('.npz', '.%d.tmp.npz' % (os.getpid()))
+        np.savez(tmpFile, **lookup)
+        os.replace(tmpFile, lookupFile)
+        self._setLookup(lookup)
+
+    def _readLookup(self, lookupFile):
+        """Read the lookup for all slicePoints from lookupFile."""
+        if self.verbose:
+            print('Reading slicePoint lookup from %s' % (lookupFile))
+        restored = np.load(lookupFile)
+        self._setLookup({key: restored[key] for key in restored.files})
+
+    def _setLookup(self, lookup):
+        """Use the lookup for all slicePoints as the (single) current batch."""
+        self._fullLookup = True
+        self._batchStart = 0
+        self._batchStop = self.nslice
+        self._batchOffsets = lookup['offsets']
+        self._batchIndices = lookup['indices']
+        if self.useCamera:
+            self._batchChipNames = lookup['chipNames']
+            # Lists of (views into) the simData indexes and chipNames, one entry per slicePoint.
+            self.sliceLookup = np.split(self._batchIndices, self._batchOffsets[1:-1])
+            self.chipNames = np.split(self._batchChipNames, self._batchOffsets[1:-1])
+
     def _setupLSSTCamera(self):
         """If we want to include the camera chip gaps, etc"""
         mapper = LsstCamMapper()
         self.camera = mapper.camera
         self.epoch = 2000.0
+        self.footprint = CameraFootprint.fromCamera(self.camera, chipsToUse=self.chipsToUse,
+                                                    scienceChips=self.scienceChips, epoch=self.epoch)
 
     def _presliceFootprint(self, simData):
-        """Loop over each pointing and find which sky points are observed """
-        # Now to make a list of lists for looking up the relevant observations at each slicepoint
-        self.sliceLookup = [[] for dummy in range(self.nslice)]
-        self.chipNames = [[] for dummy in range(self.nslice)]
+        """Find which sky points land on a chip, for all of the pointings at once.
+
+        Visits are matched in blocks: the slicePoints within the field of view of each visit
+        come from a single kdtree query, then are projected into the focal plane and tested against
+        the chip outlines of self.footprint. The lookup for slicePoint i is then self.sliceLookup[i]
+        (the simData indexes, in simData order) and self.chipNames[i] (the matching chip names).
+        """
         # Make a kdtree for the _slicepoints_
-        # Using scipy 0.16 or later
         self._buildTree(self.slicePoints['ra'], self.slicePoints['dec'], leafsize=self.leafsize)
-
-        # Loop over each unique pointing position
         if self.latLonDeg:
             lat = np.radians(simData[self.latCol])
             lon = np.radians(simData[self.lonCol])
         else:
             lat = simData[self.latCol]
             lon = simData[self.lonCol]
-        for ind, ra, dec, rotSkyPos, mjd in zip(np.arange(simData.size), lon, lat,
-                                                simData[self.rotSkyPosColName], simData[self.mjdColName]):
-            dx, dy, dz = simsUtils._xyz_from_ra_dec(ra, dec)
-            # Find healpixels inside the FoV
-            hpIndices = np.array(self.opsimtree.query_ball_point((dx, dy, dz), self.rad))
-            if hpIndices.size > 0:
-                obs_metadata = simsUtils.ObservationMetaData(pointingRA=np.degrees(ra),
-                                                             pointingDec=np.degrees(dec),
-                                                             rotSkyPos=np.degrees(rotSkyPos),
-                                                             mjd=mjd)
-
-                chipNames = _chipNameFromRaDec(self.slicePoints['ra'][hpIndices],
-                                               self.slicePoints['dec'][hpIndices],
-                                               epoch=self.epoch,
-                                               camera=self.camera, obs_metadata=obs_metadata)
-                if self.scienceChips:
-                    # I think it's W for wavefront sensor
-                    good = np.flatnonzero(np.core.defchararray.find(chipNames.astype(str), 'W') == -1)
-                    chipNames = chipNames[good]
-                    hpIndices = hpIndices[good]
-                # If we are using only a subset of chips
-                if self.chipsToUse != 'all':
-                    checkedChipNames = [chipName in self.chipsToUse for chipName in chipNames]
-                    good = np.where(checkedChipNames)[0]
-                    chipNames = chipNames[good]
-                    hpIndices = hpIndices[good]
-                # Find the healpixels that fell on a chip for this pointing
-                good = np.where(chipNames != [None])[0]
-                hpOnChip = hpIndices[good]
-                for i, chipName in zip(hpOnChip, chipNames[good]):
-                    self.sliceLookup[i].append(ind)
-                    self.chipNames[i].append(chipName)
-
+        offsets, indices, chips = self.footprint.matchVisits(self.opsimtree, self.rad,
+                                                             self.slicePoints['ra'],
+                                                             self.slicePoints['dec'],
+                                                             lon, lat, simData[self.rotSkyPosColName],
+                                                             nProcs=self.nProcs)
+        lookup = {'offsets': offsets, 'indices': indices, 'chipNames': self.footprint.chipNames[chips]}
+        self._setLookup(lookup)
         if self.verbose:
-            "Created lookup table after checking for chip gaps."
+            print("Created lookup table after checking for chip gaps.")
 
     def _buildTree(self, simDataRa, simDataDec, leafsize=100):
         """Build KD tree on simDataRA/Dec using utility function from mafUtils.
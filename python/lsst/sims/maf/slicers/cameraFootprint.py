@@ -0,0 +1,252 @@
+"""Vectorized camera footprint, used to find which slicePoints land on which chip for each visit."""
+
+import multiprocessing
+from itertools import chain
+import numpy as np
+import lsst.sims.utils as simsUtils
+from lsst.sims.maf.utils.mafUtils import gnomonic_project_toxy
+
+__all__ = ['CameraFootprint', 'rotateXY']
+
+
+def rotateXY(x, y, angle):
+    """Rotate x/y positions counter-clockwise by angle (radians).
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The x values.
+    y : numpy.ndarray
+        The y values.
+    angle : float or numpy.ndarray
+        The rotation angle(s), in radians.
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        The rotated x/y values.
+    """
+    cosA = np.cos(angle)
+    sinA = np.sin(angle)
+    return x * cosA - y * sinA, x * sinA + y * cosA
+
+
+# Module level state for the worker processes of CameraFootprint.matchVisits.
+# Set just before the (forked) pool is created, so the kdtree and pointing arrays are not pickled.
+_matchState = None
+
+
+def _matchBlock(bounds):
+    footprint, args = _matchState
+    return footprint._matchBlock(bounds[0], bounds[1], *args)
+
+
+class CameraFootprint(object):
+    """The outline of each chip in the focal plane, as convex polygons in a gnomonic projection.
+
+    The focal plane x/y coordinates are the gnomonic (tangent plane) projection of the sky
+    around the boresight, for a visit with rotSkyPos=0. Sky positions for a visit with another
+    rotSkyPos are rotated into this frame by rotSign * rotSkyPos before testing against the chips.
+
+    Parameters
+    ----------
+    chipNames : list of str
+        The names of the chips.
+    corners : numpy.ndarray
+        The corners of each chip in focal plane coordinates (radians), with shape
+        (nchips, ncorners, 2). Each chip must be a convex polygon; the corners may be in any order.
+    rotSign : int, optional
+        The direction that rotSkyPos rotates the focal plane on the sky (+1 or -1). Default 1.
+    """
+    def __init__(self, chipNames, corners, rotSign=1):
+        self.chipNames = np.array(chipNames, dtype=str)
+        corners = np.array(corners, dtype=float)
+        # Order the corners of each chip counter-clockwise around the chip center.
+        center = corners.mean(axis=1)
+        angle = np.arctan2(corners[:, :, 1] - center[:, 1, np.newaxis],
+                           corners[:, :, 0] - center[:, 0, np.newaxis])
+        order = np.argsort(angle, axis=1)
+        self.corners = np.take_along_axis(corners, order[:, :, np.newaxis], axis=1)
+        self.xmin = self.corners[:, :, 0].min(axis=1)
+        self.xmax = self.corners[:, :, 0].max(axis=1)
+        self.ymin = self.corners[:, :, 1].min(axis=1)
+        self.ymax = self.corners[:, :, 1].max(axis=1)
+        self.rotSign = rotSign
+
+    @classmethod
+    def fromCamera(cls, camera, chipsToUse='all', scienceChips=True, epoch=2000.0, mjd=59580.0):
+        """Build the footprint from the corners of each detector of an afw camera.
+
+        The detector corners are placed on the sky for a reference pointing with
+        lsst.sims.coordUtils (including the optical distortion), then projected back into the
+        focal plane frame. A second reference pointing determines the direction of rotSkyPos.
+        Because only the chip corners are mapped, and differential refraction and aberration across
+        the field of view are not included, the chip assigned to a point may differ from that
+        given by lsst.sims.coordUtils._chipNameFromRaDec within a few arcseconds of a chip edge.
+
+        Parameters
+        ----------
+        camera : lsst.afw.cameraGeom.Camera
+            The camera.
+        chipsToUse : list of str or 'all', optional
+            The chips to include. Default 'all'.
+        scienceChips : bool, optional
+            Do not include the wavefront sensors. Default True.
+        epoch : float, optional
+            The epoch of the RA/Dec coordinates. Default 2000.0.
+        mjd : float, optional
+            The MJD of the reference pointing. Default 59580.0.
+
+        Returns
+        -------
+        CameraFootprint
+        """
+        from lsst.sims.coordUtils import getCornerPixels, _raDecFromPixelCoords
+        chipNames = []
+        for detector in camera:
+            name = detector.getName()
+            # I think it's W for wavefront sensor
+            if scienceChips and 'W' in name:
+                continue
+            if chipsToUse != 'all' and name not in chipsToUse:
+                continue
+            chipNames.append(name)
+
+        def _projectedCorners(rotSkyPos):
+            obs_metadata = simsUtils.ObservationMetaData(pointingRA=0., pointingDec=0.,
+                                                         rotSkyPos=rotSkyPos, mjd=mjd)
+            corners = []
+            for name in chipNames:
+                pix = np.array(getCornerPixels(name, camera), dtype=float)
+                ra, dec = _raDecFromPixelCoords(pix[:, 0], pix[:, 1], [name] * len(pix),
+                                                camera=camera, obs_metadata=obs_metadata, epoch=epoch)
+                corners.append(np.array(gnomonic_project_toxy(ra, dec, 0., 0.)).T)
+            return np.array(corners)
+
+        corners = _projectedCorners(0.)
+        rotated = _projectedCorners(90.)
+        rotSign = 1
+        if (np.abs(np.array(rotateXY(*corners.T, -np.pi / 2.)).T - rotated).sum() <
+                np.abs(np.array(rotateXY(*corners.T, np.pi / 2.)).T - rotated).sum()):
+            rotSign = -1
+        return cls(chipNames, corners, rotSign=rotSign)
+
+    def chipIndex(self, x, y):
+        """Find the chip (if any) containing each focal plane position.
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            The focal plane x values (radians).
+        y : numpy.ndarray
+            The focal plane y values (radians).
+
+        Returns
+        -------
+        numpy.ndarray
+            The index into self.chipNames of the chip containing each point, or -1 for points
+            which do not land on a chip.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        result = np.zeros(len(x), dtype=int) - 1
+        # Sort on x once, so each chip only has to test the points within its x range.
+        order = np.argsort(x)
+        xSorted = x[order]
+        lo = np.searchsorted(xSorted, self.xmin, side='left')
+        hi = np.searchsorted(xSorted, self.xmax, side='right')
+        for i, corners in enumerate(self.corners):
+            candidates = order[lo[i]:hi[i]]
+            candidates = candidates[(y[candidates] >= self.ymin[i]) & (y[candidates] <= self.ymax[i])]
+            inside = np.ones(len(candidates), dtype=bool)
+            for (x0, y0), (x1, y1) in zip(corners, np.roll(corners, -1, axis=0)):
+                inside &= ((x1 - x0) * (y[candidates] - y0) - (y1 - y0) * (x[candidates] - x0)) >= 0
+            result[candidates[inside]] = i
+        return result
+
+    def focalPlaneXY(self, ra, dec, pointingRa, pointingDec, rotSkyPos):
+        """Project sky positions into the focal plane of each matching visit.
+
+        All arguments are in radians and are broadcast against each other, so this can
+        be used with one visit per sky position.
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            The focal plane x/y values.
+        """
+        x, y = gnomonic_project_toxy(ra, dec, pointingRa, pointingDec)
+        return rotateXY(x, y, -self.rotSign * rotSkyPos)
+
+    def _matchBlock(self, start, stop, tree, rad, slicePointRa, slicePointDec,
+                    pointingRa, pointingDec, rotSkyPos):
+        """Match visits start:stop against the slicePoints."""
+        x, y, z = simsUtils._xyz_from_ra_dec(pointingRa[start:stop], pointingDec[start:stop])
+        # Find the slicePoints within the field of view of each visit.
+        lookups = tree.query_ball_point(np.array([x, y, z]).T, rad)
+        counts = np.fromiter(map(len, lookups), dtype=int, count=len(lookups))
+        visitIdx = np.repeat(np.arange(start, stop), counts)
+        sliceIdx = np.fromiter(chain.from_iterable(lookups), dtype=int, count=counts.sum())
+        # Then find the chip (if any) each slicePoint lands on.
+        fx, fy = self.focalPlaneXY(slicePointRa[sliceIdx], slicePointDec[sliceIdx], pointingRa[visitIdx],
+                                   pointingDec[visitIdx], rotSkyPos[visitIdx])
+        chipIdx = self.chipIndex(fx, fy)
+        good = np.where(chipIdx >= 0)[0]
+        return sliceIdx[good], visitIdx[good], chipIdx[good]
+
+    def matchVisits(self, tree, rad, slicePointRa, slicePointDec, pointingRa, pointingDec, rotSkyPos,
+                    blockSize=10000, nProcs=1):
+        """Find which visits put each slicePoint onto a chip.
+
+        Parameters
+        ----------
+        tree : scipy.spatial.cKDTree
+            A kdtree built on the slicePoint positions (x/y/z on the unit sphere).
+        rad : float
+            The kdtree search radius, covering the whole camera.
+        slicePointRa : numpy.ndarray
+            The RA of each slicePoint (radians).
+        slicePointDec : numpy.ndarray
+            The Dec of each slicePoint (radians).
+        pointingRa : numpy.ndarray
+            The RA of each visit (radians).
+        pointingDec : numpy.ndarray
+            The Dec of each visit (radians).
+        rotSkyPos : numpy.ndarray
+            The rotSkyPos of each visit (radians).
+        blockSize : int, optional
+            The number of visits to match at once. Default 10000.
+        nProcs : int, optional
+            The number of processes to spread the blocks of visits over. Default 1.
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray, numpy.ndarray
+            The offsets (length nslicePoints + 1), the visit indexes and the chip indexes.
+            The visits (in increasing order) for slicePoint i are visits[offsets[i]:offsets[i + 1]],
+            landing on the chips self.chipNames[chips[offsets[i]:offsets[i + 1]]].
+        """
+        global _matchState
+        args = (tree, rad, slicePointRa, slicePointDec, pointingRa, pointingDec, rotSkyPos)
+        nvisits = len(pointingRa)
+        blockSize = max(int(blockSize), 1)
+        if nProcs > 1:
+            # Make sure there are enough blocks to keep all of the processes busy.
+            blockSize = max(min(blockSize, -(-nvisits // nProcs)), 1)
+        blocks = [(start, min(start + blockSize, nvisits)) for start in range(0, nvisits, blockSize)]
+        if nProcs > 1 and len(blocks) > 1:
+            _matchState = (self, args)
+            try:
+                with multiprocessing.get_context('fork').Pool(min(nProcs, len(blocks))) as pool:
+                    results = pool.map(_matchBlock, blocks)
+            finally:
+                _matchState = None
+        else:
+            results = [self._matchBlock(start, stop, *args) for start, stop in blocks]
+        if len(results) == 0:
+            results = [(np.zeros(0, dtype=int),) * 3]
+        sliceIdx, visitIdx, chipIdx = [np.concatenate(r) for r in zip(*results)]
+        order = np.lexsort((visitIdx, sliceIdx))
+        offsets = np.zeros(len(slicePointRa) + 1, dtype=int)
+        np.cumsum(np.bincount(sliceIdx, minlength=len(slicePointRa)), out=offsets[1:])
+        return offsets, visitIdx[order], chipIdx[order]
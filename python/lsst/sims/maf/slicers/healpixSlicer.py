@@ -78,18 +78,29 @@ class HealpixSlicer(BaseSpatialSlicer):
     chipNames : array-like, optional
         List of chips to accept, if useCamera is True. This lets users turn 'on' only a subset of chips.
         Default 'all' - this uses all chips in the camera.
+    batchSize : int, optional
+        Number of slicePoints to query against the kdtree at once. Default 2048.
+    lookupCacheDir : str, optional
+        Directory in which to save (and look for) the slicePoint to simData index lookup, so that
+        repeated runs on the same pointings can skip recalculating it. Default None.
+    nProcs : int, optional
+        Number of processes to use when matching the visits against the camera footprint.
+        Only used if useCamera is True. Default 1.
     """
     def __init__(self, nside=128, lonCol ='fieldRA',
                  latCol='fieldDec', latLonDeg=True, verbose=True, badval=hp.UNSEEN,
                  useCache=True, leafsize=100, radius=1.75,
                  useCamera=False, rotSkyPosColName='rotSkyPos',
-                 mjdColName='observationStartMJD', chipNames='all'):
+                 mjdColName='observationStartMJD', chipNames='all', batchSize=2048,
+                 lookupCacheDir=None, nProcs=1):
         """Instantiate and set up healpix slicer object."""
         super(HealpixSlicer, self).__init__(verbose=verbose,
                                             lonCol=lonCol, latCol=latCol,
                                             badval=badval, radius=radius, leafsize=leafsize,
                                             useCamera=useCamera, rotSkyPosColName=rotSkyPosColName,
-                                            mjdColName=mjdColName, chipNames=chipNames, latLonDeg=latLonDeg)
+                                            mjdColName=mjdColName, chipNames=chipNames, latLonDeg=latLonDeg,
+                                            batchSize=batchSize, lookupCacheDir=lookupCacheDir,
+                                            nProcs=nProcs)
         # Valid values of nside are powers of 2.
         # nside=64 gives about 1 deg resolution
         # nside=256 gives about 13' resolution (~1 CCD)
@@ -1,3 +1,5 @@
+import os
+import glob
 import numpy as np
 import pandas as pd
 
@@ -6,7 +8,89 @@ from lsst.sims.maf.plots.moPlotters import MetricVsH, MetricVsOrbit
 
 from .orbits import Orbits
 
-__all__ = ['MoObjSlicer']
+__all__ = ['MoObjSlicer', 'readObsChunks', 'convertObsFile']
+
+
+def readObsChunks(obsFile, chunkSize=100000):
+    """Read a moving object observation file in chunks which each hold all the observations of their objects.
+
+    A text observation file must hold the observations of each object in one contiguous block of
+    lines (as written by sims_movingObjects); each chunk then holds about chunkSize observations.
+    A directory written by convertObsFile is read one (binary) file at a time.
+
+    Parameters
+    ----------
+    obsFile : str
+        The observation file (or the directory written by convertObsFile).
+    chunkSize : int, optional
+        The approximate number of observations in each chunk of a text file
+        (the files in a directory are read as they were written). Default 100000.
+
+    Returns
+    -------
+    generator of pandas.DataFrame
+        The observations of consecutive objects. The index of each dataframe continues
+        from the previous one, as if the whole file had been read at once.
+
+    Raises
+    ------
+    ValueError
+        If the observations of an object in a text file are not in one contiguous block.
+    """
+    if os.path.isdir(obsFile):
+        offset = 0
+        for chunkFile in sorted(glob.glob(os.path.join(obsFile, 'obs_*.npy'))):
+            chunk = pd.DataFrame(np.load(chunkFile))
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+        return
+    reader = pd.read_csv(obsFile, delim_whitespace=True, comment='#', chunksize=chunkSize)
+    carry = None
+    finishedIds = set()
+    for chunk in reader:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        objIds = chunk[chunk.columns[0]].values
+        # The first row of each block of observations of one object.
+        starts = np.concatenate([[0], np.where(objIds[1:] != objIds[:-1])[0] + 1])
+        blockIds = objIds[starts]
+        if len(set(blockIds)) != len(blockIds) or not finishedIds.isdisjoint(blockIds):
+            raise ValueError('The observations in %s are not grouped by object; '
+                             'please read the whole file with readObs instead.' % (obsFile))
+        # The last object may continue in the next chunk, so keep it back.
+        carry = chunk.iloc[starts[-1]:]
+        if starts[-1] > 0:
+            finishedIds.update(blockIds[:-1])
+            yield chunk.iloc[:starts[-1]].copy()
+    if carry is not None and len(carry) > 0:
+        yield carry.copy()
+
+
+def convertObsFile(obsFile, outDir, chunkSize=100000):
+    """Convert a (text) moving object observation file into a directory of binary numpy files.
+
+    Each file holds a structured array with the observations of a block of objects
+    (see readObsChunks), so the observations can be re-read much faster, all at once or in chunks.
+    Pass outDir to MoObjSlicer.setupSlicer or readObs in place of the text file.
+
+    Parameters
+    ----------
+    obsFile : str
+        The text observation file.
+    outDir : str
+        The directory for the binary files (created if necessary).
+    chunkSize : int, optional
+        The approximate number of observations in each file. Default 100000.
+    """
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    for i, chunk in enumerate(readObsChunks(obsFile, chunkSize=chunkSize)):
+        # Store strings (such as objIds) as fixed-width unicode, rather than python objects.
+        colTypes = {col: 'U%d' % (max(chunk[col].astype(str).str.len().max(), 1))
+                    for col in chunk.columns if chunk[col].dtype == 'object'}
+        np.save(os.path.join(outDir, 'obs_%05d.npy' % (i)),
+                chunk.to_records(index=False, column_dtypes=colTypes))
 
 
 class MoObjSlicer(BaseSlicer):
@@ -20,17 +104,21 @@ class MoObjSlicer(BaseSlicer):
     ----------
     Hrange : numpy.ndarray or None
         The H values to clone the orbital parameters over. If Hrange is None, will not clone orbits.
+
+    The observations can be read all at once (in setupSlicer) or, for very large populations,
+    streamed in chunks of whole objects (set chunkSize in setupSlicer and use iterObsChunks).
     """
     def __init__(self, Hrange=None, verbose=True, badval=0):
         super(MoObjSlicer, self).__init__(verbose=verbose, badval=badval)
         self.Hrange = Hrange
+        self.chunkSize = None
         self.slicer_init = {'Hrange': Hrange, 'badval': badval}
         # Set default plotFuncs.
         self.plotFuncs = [MetricVsH(),
                           MetricVsOrbit(xaxis='q', yaxis='e'),
                           MetricVsOrbit(xaxis='q', yaxis='inc')]
 
-    def setupSlicer(self, orbitFile, delim=None, skiprows=None, obsFile=None):
+    def setupSlicer(self, orbitFile, delim=None, skiprows=None, obsFile=None, chunkSize=None):
         """Set up the slicer and read orbitFile and obsFile from disk.
 
         Sets self.orbits (with orbit parameters), self.allObs, and self.obs
@@ -44,9 +132,19 @@ class MoObjSlicer(BaseSlicer):
         obsFile : str, optional
             The file containing the observations of each object, optional.
             If not provided (default, None), then the slicer will not be able to 'slice', but can still plot.
+            This can also be a directory of binary files written by convertObsFile.
+        chunkSize : int, optional
+            If set, the observations are not read now, but streamed in chunks of whole objects
+            (of about chunkSize observations) by iterObsChunks (as MoMetricBundleGroup does).
+            Default None (read all of the observations now).
         """
         self.readOrbits(orbitFile, delim=delim, skiprows=skiprows)
-        if obsFile is not None:
+        self.chunkSize = chunkSize
+        if obsFile is not None and chunkSize is not None:
+            self.obsFile = obsFile
+            self.allObs = None
+            self.obs = None
+        elif obsFile is not None:
             self.readObs(obsFile)
         else:
             self.obsFile = None
@@ -82,11 +180,40 @@ class MoObjSlicer(BaseSlicer):
         Parameters
         ----------
         obsFile: str
-            The file containing the observation information.
+            The file containing the observation information
+            (or a directory of binary files written by convertObsFile).
         """
-        # For now, just read all the observations (should be able to chunk this though).
-        self.allObs = pd.read_csv(obsFile, delim_whitespace=True, comment='#')
+        # Read all the observations (see iterObsChunks to read them in chunks).
+        if os.path.isdir(obsFile):
+            allObs = pd.concat(list(readObsChunks(obsFile)))
+        else:
+            allObs = pd.read_csv(obsFile, delim_whitespace=True, comment='#')
         self.obsFile = obsFile
+        self._setObs(allObs)
+
+    def iterObsChunks(self):
+        """Read the observations of self.obsFile in chunks of whole objects (see readObsChunks).
+
+        For each chunk, sets self.allObs (and self.obs) to the observations in the chunk.
+
+        Returns
+        -------
+        generator of numpy.ndarray
+            The indexes (in self.orbits) of the objects with observations in each chunk.
+        """
+        chunkSize = self.chunkSize if self.chunkSize is not None else 100000
+        orbitIds = self.orbits['objId'].values
+        for chunk in readObsChunks(self.obsFile, chunkSize=chunkSize):
+            self._setObs(chunk)
+            chunkIds = self.allObs['objId'].values
+            if chunkIds.dtype == 'object':
+                yield np.where(np.isin(orbitIds.astype(str), chunkIds.astype(str)))[0]
+            else:
+                yield np.where(np.isin(orbitIds, chunkIds))[0]
+
+    def _setObs(self, allObs):
+        """Set self.allObs (adding any missing default columns) and then self.obs."""
+        self.allObs = allObs
         # We may have to rename the first column from '#objId' to 'objId'.
         if self.allObs.columns.values[0].startswith('#'):
             newcols = self.allObs.columns.values
@@ -110,6 +237,20 @@ class MoObjSlicer(BaseSlicer):
             self.obs = self.allObs
         else:
             self.obs = self.allObs.query(pandasConstraint)
+        self._indexObs()
+
+    def _indexObs(self):
+        """Build the per-object view of self.obs used by _sliceObs.
+
+        The observations are converted to a recarray once and (stably) sorted by objId, so that
+        the observations of each object are a contiguous block of rows. self._obsIds holds the
+        sorted unique objIds, and self._obsStart/self._obsStop the range of rows of each object.
+        """
+        records = self.obs.to_records()
+        self._obsRecords = records[np.argsort(records['objId'], kind='mergesort')]
+        self._obsIds, self._obsStart, counts = np.unique(self._obsRecords['objId'], return_index=True,
+                                                         return_counts=True)
+        self._obsStop = self._obsStart + counts
 
     def _sliceObs(self, idx):
         """Return the observations of a given ssoId.
@@ -124,11 +265,16 @@ class MoObjSlicer(BaseSlicer):
         """
         # Find the matching orbit.
         orb = self.orbits.iloc[idx]
-        # Find the matching observations.
-        if self.obs['objId'].dtype == 'object':
-            obs = self.obs.query('objId == "%s"' %(orb['objId']))
+        # Find the matching observations (the contiguous block of rows for this object).
+        objId = orb['objId']
+        if self._obsIds.dtype == 'object':
+            objId = str(objId)
+        i = np.searchsorted(self._obsIds, objId)
+        if i < len(self._obsIds) and self._obsIds[i] == objId:
+            # Return a copy, as stackers and metrics may modify the observations in place.
+            obs = self._obsRecords[self._obsStart[i]:self._obsStop[i]].copy()
         else:
-            obs = self.obs.query('objId == %d' %(orb['objId']))
+            obs = self._obsRecords[0:0]
         # Return the values for H to consider for metric.
         if self.Hrange is not None:
             Hvals = self.Hrange
@@ -136,7 +282,7 @@ class MoObjSlicer(BaseSlicer):
             Hvals = np.array([orb['H']], float)
         # Note that ssoObs / obs is a recarray not Dataframe!
         # But that the orbit IS a Dataframe.
-        return {'obs': obs.to_records(),
+        return {'obs': obs,
                 'orbit': orb,
                 'Hvals': Hvals}
 
@@ -4,6 +4,7 @@ import numpy as np
 from functools import wraps
 import warnings
 from lsst.sims.maf.plots.spatialPlotters import OpsimHistogram, BaseSkyMap
+from lsst.sims.maf.stackers import getOpSimFields
 
 from .baseSpatialSlicer import BaseSpatialSlicer
 
@@ -76,17 +77,19 @@ class OpsimFieldSlicer(BaseSpatialSlicer):
         self.plotFuncs = [BaseSkyMap, OpsimHistogram]
         self.needsFields = True
 
-    def setupSlicer(self, simData, fieldData, maps=None):
+    def setupSlicer(self, simData, fieldData=None, maps=None):
         """Set up opsim field slicer object.
 
         Parameters
         -----------
         simData : numpy.recarray
             Contains the simulation pointing history.
-        fieldData : numpy.recarray
+        fieldData : numpy.recarray, optional
             Contains the field information (ID, Ra, Dec) about how to slice the simData.
             For example, only fields in the fieldData table will be matched against the simData.
             RA and Dec should be in degrees.
+            If None, the standard OpSim fields are used (these are read once per process, and shared
+            with the OpSimFieldStacker, which can provide the fieldIds for the simData). Default None.
         maps : list of lsst.sims.maf.maps objects, optional
             Maps to run and provide additional metadata at each slicePoint. Default None.
         """
@@ -95,16 +98,23 @@ class OpsimFieldSlicer(BaseSpatialSlicer):
             warning_msg += 'Re-setting up an OpsimFieldSlicer can change the field information. '
             warning_msg += 'Rerun metrics if this was intentional. '
             warnings.warn(warning_msg)
-        # Set basic properties for tracking field information, in sorted order.
-        idxs = np.argsort(fieldData[self.fieldIdColName])
-        # Set needed values for slice metadata.
-        self.slicePoints['sid'] = fieldData[self.fieldIdColName][idxs]
-        if self.latLonDeg:
-            self.slicePoints['ra'] = np.radians(fieldData[self.fieldRaColName][idxs])
-            self.slicePoints['dec'] = np.radians(fieldData[self.fieldDecColName][idxs])
+        if fieldData is None:
+            # The OpSim fields are already sorted, with RA/Dec in radians.
+            fields = getOpSimFields()[0]
+            self.slicePoints['sid'] = fields['fieldId']
+            self.slicePoints['ra'] = fields['fieldRA']
+            self.slicePoints['dec'] = fields['fieldDec']
         else:
-            self.slicePoints['ra'] = fieldData[self.fieldRaColName][idxs]
-            self.slicePoints['dec'] = fieldData[self.fieldDecColName][idxs]
+            # Set basic properties for tracking field information, in sorted order.
+            idxs = np.argsort(fieldData[self.fieldIdColName])
+            # Set needed values for slice metadata.
+            self.slicePoints['sid'] = fieldData[self.fieldIdColName][idxs]
+            if self.latLonDeg:
+                self.slicePoints['ra'] = np.radians(fieldData[self.fieldRaColName][idxs])
+                self.slicePoints['dec'] = np.radians(fieldData[self.fieldDecColName][idxs])
+            else:
+                self.slicePoints['ra'] = fieldData[self.fieldRaColName][idxs]
+                self.slicePoints['dec'] = fieldData[self.fieldDecColName][idxs]
         self.nslice = len(self.slicePoints['sid'])
         self._runMaps(maps)
         # Set up data slicing.
@@ -5,8 +5,9 @@ import inspect
 import warnings
 import numpy as np
 from future.utils import with_metaclass
+from lsst.sims.maf.utils.columnarSimData import ColumnarSimData
 
-__all__ = ['StackerRegistry', 'BaseStacker']
+__all__ = ['StackerRegistry', 'BaseStacker', 'orderStackers']
 
 
 class StackerRegistry(type):
@@ -87,6 +88,9 @@ class BaseStacker(with_metaclass(StackerRegistry, object)):
         stateNow = dir(self)
         for key in stateNow:
             if not key.startswith('_') and key != 'registry' and key != 'run' and key != 'next':
+                # Methods are bound to each instance, so only compare the attributes.
+                if inspect.ismethod(getattr(self, key)):
+                    continue
                 if not hasattr(otherStacker, key):
                     return False
                 # If the attribute is from numpy, assume it's an array and test it
@@ -112,9 +116,22 @@ class BaseStacker(with_metaclass(StackerRegistry, object)):
         Add the new Stacker columns to the simData array.
         If columns already present in simData, just allows 'run' method to overwrite.
         Returns simData array with these columns added (so 'run' method can set their values).
+        If simData is a ColumnarSimData object, the new columns are added in place (without copying
+        the existing columns) and the same object is returned.
         """
         if not hasattr(self, 'colsAddedDtypes') or self.colsAddedDtypes is None:
             self.colsAddedDtypes = [float for col in self.colsAdded]
+        if isinstance(simData, ColumnarSimData):
+            cols_present = True
+            for col, dtype in zip(self.colsAdded, self.colsAddedDtypes):
+                if col in simData and simData[col][0] is not None:
+                    warnings.warn('Warning - column %s already present in simData, may be overwritten '
+                                  '(depending on stacker).'
+                                  % (col))
+                else:
+                    cols_present = False
+                    simData.addColumn(col, dtype)
+            return simData, cols_present
         # Create description of new recarray.
         newdtype = simData.dtype.descr
         cols_present = [False] * len(self.colsAdded)
@@ -166,3 +183,44 @@ class BaseStacker(with_metaclass(StackerRegistry, object)):
         #  _run methods are quite likely to (depending on their details), as they are just populating columns.
         raise NotImplementedError('Not Implemented: '
                                   'the child stackers should implement their own _run methods')
+
+
+def orderStackers(stackerList):
+    """Order a list of stackers so that each stacker runs after the stackers which add its required columns.
+
+    The order is found from the dependency graph of each stacker's colsReq on the colsAdded of
+    the other stackers (the original order is kept wherever the dependencies allow).
+
+    Parameters
+    ----------
+    stackerList : list of BaseStacker
+        The stackers to order.
+
+    Returns
+    -------
+    list of BaseStacker
+        The stackers, in an order in which they can be run.
+    """
+    # For each stacker, find the (indexes of the) other stackers which add the columns it requires.
+    producers = {}
+    for i, stacker in enumerate(stackerList):
+        for col in stacker.colsAdded:
+            producers.setdefault(col, []).append(i)
+    requires = []
+    for i, stacker in enumerate(stackerList):
+        requires.append(set([j for col in getattr(stacker, 'colsReq', []) for j in producers.get(col, [])
+                             if j != i]))
+    ordered = []
+    done = set()
+    while len(ordered) < len(stackerList):
+        ready = [i for i in range(len(stackerList)) if i not in done and requires[i].issubset(done)]
+        if len(ready) == 0:
+            # Circular dependency: just run the remaining stackers in their original order.
+            remaining = [i for i in range(len(stackerList)) if i not in done]
+            warnings.warn('Circular dependency between stackers %s; running them in the order given.'
+                          % ([stackerList[i].__class__.__name__ for i in remaining]))
+            ready = remaining
+        # Take the first ready stacker, to keep the original order where possible.
+        ordered.append(ready[0])
+        done.add(ready[0])
+    return [stackerList[i] for i in ordered]
@@ -1,11 +1,17 @@
+from contextlib import contextmanager
 import numpy as np
 import ephem
+from scipy import interpolate
 from lsst.sims.utils import _galacticFromEquatorial, calcLmstLast
 
 from .baseStacker import BaseStacker
 from .ditherStackers import wrapRA
 
-__all__ = ['mjd2djd', 'raDec2AltAz', 'GalacticStacker', 'EclipticStacker']
+__all__ = ['mjd2djd', 'raDec2AltAz', 'RaDecCoords', 'sharedRaDecCoords', 'getRaDecCoords',
+           'equatorialToEcliptic', 'sunEclipticLon', 'GalacticStacker', 'EclipticStacker']
+
+# The (mean) obliquity of the ecliptic at J2000, in radians.
+obliquityJ2000 = np.radians(23.4392911)
 
 
 def mjd2djd(mjd):
@@ -25,10 +31,250 @@ def mjd2djd(mjd):
     return djd
 
 
+def _broadcastShape(*arrays):
+    """The shape of the (not None) arrays, broadcast against each other."""
+    return np.broadcast(*[np.asarray(a) for a in arrays if a is not None]).shape
+
+
+class RaDecCoords(object):
+    """Coordinate transformations of a set of RA/Dec positions (such as the visits in simData).
+
+    The trigonometric functions of RA and Dec, and the local mean sidereal times at each
+    offset from the visit times, are calculated once and kept, so that transforming the same
+    positions for several sites, times or stackers does not repeat them. Use getRaDecCoords
+    (within sharedRaDecCoords) to share a RaDecCoords between callers.
+    This uses simple equations and ignores aberation, precession, nutation, etc.
+
+    The positions and times are broadcast against each other (for example, a single position
+    at several times).
+
+    Parameters
+    ----------
+    ra : float or numpy.ndarray
+        RA, in radians.
+    dec : float or numpy.ndarray, optional
+        Dec, in radians. Default None (for hour angles only).
+    mjd : float or numpy.ndarray, optional
+        Modified Julian Date of each position. Default None (for transformations which do not need
+        the sidereal time).
+    """
+    # The number of positions x sites to evaluate at once in countVisible (this bounds the memory used).
+    blockSize = 1000000
+
+    def __init__(self, ra, dec=None, mjd=None):
+        shape = _broadcastShape(ra, dec, mjd)
+        self.ra = np.broadcast_to(np.array(ra, dtype=float), shape)
+        self.dec = None if dec is None else np.broadcast_to(np.array(dec, dtype=float), shape)
+        # The sidereal times are calculated for the mjd values given (and then broadcast to the positions).
+        self.mjd = None if mjd is None else np.array(mjd, dtype=float)
+        self._trig = {}
+        self._lmst = {}
+
+    def _reuse(self, ra, dec, mjd):
+        """Check if these are the same positions (and times), adding dec or mjd if they were not set."""
+        try:
+            shape = _broadcastShape(ra, dec, mjd)
+        except ValueError:
+            return False
+        if shape != self.ra.shape or not np.array_equal(self.ra, np.broadcast_to(ra, shape)):
+            return False
+        if dec is not None and self.dec is not None:
+            if not np.array_equal(self.dec, np.broadcast_to(dec, shape)):
+                return False
+        if mjd is not None and self.mjd is not None:
+            if np.shape(self.mjd) != np.shape(mjd) or not np.array_equal(self.mjd, mjd):
+                return False
+        if self.dec is None and dec is not None:
+            self.dec = np.broadcast_to(np.array(dec, dtype=float), shape)
+        if self.mjd is None and mjd is not None:
+            self.mjd = np.array(mjd, dtype=float)
+        return True
+
+    def _trigFunc(self, name):
+        if name not in self._trig:
+            func, coord = name[:3], name[3:]
+            values = self.ra if coord == 'Ra' else self.dec
+            self._trig[name] = np.sin(values) if func == 'sin' else np.cos(values)
+        return self._trig[name]
+
+    @property
+    def sinRa(self):
+        return self._trigFunc('sinRa')
+
+    @property
+    def cosRa(self):
+        return self._trigFunc('cosRa')
+
+    @property
+    def sinDec(self):
+        return self._trigFunc('sinDec')
+
+    @property
+    def cosDec(self):
+        return self._trigFunc('cosDec')
+
+    def lmst(self, lon=0., mjdOffset=0.):
+        """The local mean sidereal time at longitude lon (radians), mjdOffset days after each mjd.
+
+        Returns
+        -------
+        numpy.ndarray
+            The LMST, in radians (0 - 2pi).
+        """
+        if mjdOffset not in self._lmst:
+            # The LMST at any other longitude just adds the longitude.
+            lmst, last = calcLmstLast(self.mjd + mjdOffset, 0.)
+            self._lmst[mjdOffset] = np.broadcast_to(lmst / 12. * np.pi, self.ra.shape)
+        return (self._lmst[mjdOffset] + lon) % (2. * np.pi)
+
+    def hourAngle(self, lst):
+        """The hour angle (radians, -pi to pi) of each position, given the local sidereal time (radians)."""
+        ha = lst - self.ra
+        # Wrap the results so HA between -pi and pi
+        ha = np.where(ha < -np.pi, ha + 2. * np.pi, ha)
+        ha = np.where(ha > np.pi, ha - 2. * np.pi, ha)
+        return ha
+
+    def parallacticAngle(self, ha, lat):
+        """The parallactic angle (radians) of each position, given its hour angle (radians)
+        and the latitude of the site (radians)."""
+        return np.arctan2(np.sin(ha), self.cosDec * np.tan(lat) - self.sinDec * np.cos(ha))
+
+    def altAz(self, lat, lon, mjdOffset=0., altonly=False):
+        """The altitude and azimuth of each position, at the site lat/lon (radians),
+        mjdOffset days after each mjd.
+
+        Returns
+        -------
+        alt : numpy.array
+            Altitude, same length as `ra` and `dec`. Radians.
+        az : numpy.array
+            Azimuth, same length as `ra` and `dec`. Radians. None if altonly.
+        """
+        ha = self.lmst(lon, mjdOffset) - self.ra
+        sinlat = np.sin(lat)
+        coslat = np.cos(lat)
+        sinalt = self.sinDec * sinlat + self.cosDec * coslat * np.cos(ha)
+        # make sure sinalt is in the expected range.
+        sinalt = np.where(sinalt < -1, -1, sinalt)
+        sinalt = np.where(sinalt > 1, 1, sinalt)
+        alt = np.arcsin(sinalt)
+        if altonly:
+            az = None
+        else:
+            cosaz = (self.sinDec-np.sin(alt)*sinlat)/(np.cos(alt)*coslat)
+            cosaz = np.where(cosaz < -1, -1, cosaz)
+            cosaz = np.where(cosaz > 1, 1, cosaz)
+            az = np.arccos(cosaz)
+            signflip = np.where(np.sin(ha) > 0)
+            az[signflip] = 2.*np.pi-az[signflip]
+        return alt, az
+
+    def countVisible(self, lat, lon, mjdOffsets, minAlt, weights=None):
+        """Count the sites where each position is above minAlt at (any of) the times mjdOffsets
+        days after its mjd.
+
+        All of the sites and times are evaluated together, in blocks of positions.
+
+        Parameters
+        ----------
+        lat : numpy.ndarray
+            The latitude of each site, in radians.
+        lon : numpy.ndarray
+            The longitude of each site, in radians.
+        mjdOffsets : numpy.ndarray
+            The offsets from mjd, in days.
+        minAlt : float
+            The minimum altitude, in radians.
+        weights : numpy.ndarray, optional
+            The weight of each site in the count (e.g. the number of telescopes).
+            Default None (each site counts once).
+
+        Returns
+        -------
+        numpy.ndarray
+            The (weighted) number of sites where each position is visible.
+        """
+        lat = np.atleast_1d(lat)[:, np.newaxis]
+        lon = np.atleast_1d(lon)[:, np.newaxis]
+        if weights is None:
+            weights = np.ones(len(lat), int)
+        sinMinAlt = np.sin(minAlt)
+        # sin(alt) = sin(dec)sin(lat) + cos(dec)cos(lat)cos(lmst0 + lon - ra), with the lmst at lon=0
+        #  (the same for all sites) and cos(a + lon) = cos(a)cos(lon) - sin(a)sin(lon).
+        sinLat = np.sin(lat)
+        cosLatCosLon = np.cos(lat) * np.cos(lon)
+        cosLatSinLon = np.cos(lat) * np.sin(lon)
+        counts = np.zeros(len(self.ra), dtype=np.asarray(weights).dtype)
+        nRows = max(1, self.blockSize // len(lat))
+        for start in range(0, len(self.ra), nRows):
+            block = slice(start, start + nRows)
+            visible = np.zeros((len(lat), len(self.ra[block])), bool)
+            for mjdOffset in mjdOffsets:
+                ha0 = self.lmst(0., mjdOffset)[block] - self.ra[block]
+                sinalt = self.sinDec[block] * sinLat + self.cosDec[block] * (np.cos(ha0) * cosLatCosLon -
+                                                                             np.sin(ha0) * cosLatSinLon)
+                visible |= sinalt >= sinMinAlt
+            counts[block] = np.dot(weights, visible)
+        return counts
+
+
+# The most recently used RaDecCoords, and the number of open sharedRaDecCoords blocks.
+_raDecCoordsCache = {'coords': None, 'depth': 0}
+
+
+@contextmanager
+def sharedRaDecCoords():
+    """Share the RaDecCoords made by getRaDecCoords between the calls within this block
+    (such as the stackers run for one set of simData).
+
+    The shared RaDecCoords is released when the (outermost) block ends, so that its cached arrays
+    (several times the size of the positions) are not kept alive afterwards.
+    """
+    _raDecCoordsCache['depth'] += 1
+    try:
+        yield
+    finally:
+        _raDecCoordsCache['depth'] -= 1
+        if _raDecCoordsCache['depth'] == 0:
+            _raDecCoordsCache['coords'] = None
+
+
+def getRaDecCoords(ra, dec=None, mjd=None):
+    """Return a RaDecCoords for these positions (and times).
+
+    Within sharedRaDecCoords, this reuses the most recent one (with its cached trigonometry and
+    sidereal times) if it was made for the same values (a dec or mjd which it did not have yet is
+    added to it). Otherwise a new RaDecCoords is returned each time.
+
+    Parameters
+    ----------
+    ra : numpy.ndarray
+        RA, in radians.
+    dec : numpy.ndarray, optional
+        Dec, in radians. Default None.
+    mjd : float or numpy.ndarray, optional
+        Modified Julian Date. Default None.
+
+    Returns
+    -------
+    RaDecCoords
+    """
+    if _raDecCoordsCache['depth'] == 0:
+        return RaDecCoords(ra, dec, mjd)
+    coords = _raDecCoordsCache['coords']
+    if coords is None or not coords._reuse(ra, dec, mjd):
+        coords = RaDecCoords(ra, dec, mjd)
+        _raDecCoordsCache['coords'] = coords
+    return coords
+
+
 def raDec2AltAz(ra, dec, lat, lon, mjd, altonly=False):
     """Convert RA/Dec (and telescope site lat/lon) to alt/az.
 
     This uses simple equations and ignores aberation, precession, nutation, etc.
+    The trigonometry of RA/Dec and the sidereal times are shared between calls for the same
+    positions and times within sharedRaDecCoords (see getRaDecCoords).
 
     Parameters
     ----------
@@ -52,27 +298,65 @@ def raDec2AltAz(ra, dec, lat, lon, mjd, altonly=False):
     az : numpy.array
         Azimuth, same length as `ra` and `dec`. Radians.
     """
-    lmst, last = calcLmstLast(mjd, lon)
-    lmst = lmst / 12. * np.pi  # convert to rad
-    ha = lmst - ra
-    sindec = np.sin(dec)
-    sinlat = np.sin(lat)
-    coslat = np.cos(lat)
-    sinalt = sindec * sinlat + np.cos(dec) * coslat * np.cos(ha)
-    # make sure sinalt is in the expected range.
-    sinalt = np.where(sinalt < -1, -1, sinalt)
-    sinalt = np.where(sinalt > 1, 1, sinalt)
-    alt = np.arcsin(sinalt)
-    if altonly:
-        az = None
-    else:
-        cosaz = (sindec-np.sin(alt)*sinlat)/(np.cos(alt)*coslat)
-        cosaz = np.where(cosaz < -1, -1, cosaz)
-        cosaz = np.where(cosaz > 1, 1, cosaz)
-        az = np.arccos(cosaz)
-        signflip = np.where(np.sin(ha) > 0)
-        az[signflip] = 2.*np.pi-az[signflip]
-    return alt, az
+    return getRaDecCoords(ra, dec, mjd).altAz(lat, lon, altonly=altonly)
+
+
+def equatorialToEcliptic(ra, dec):
+    """Convert J2000 RA/Dec to J2000 ecliptic longitude and latitude (as ephem.Ecliptic does).
+
+    Parameters
+    ----------
+    ra : array_like
+        RA, in radians.
+    dec : array_like
+        Dec, in radians. Must be same length as `ra`.
+
+    Returns
+    -------
+    lon : numpy.array
+        Ecliptic longitude, in radians (0 - 2pi).
+    lat : numpy.array
+        Ecliptic latitude, in radians.
+    """
+    cosdec = np.cos(dec)
+    x = cosdec * np.cos(ra)
+    y = cosdec * np.sin(ra)
+    z = np.sin(dec)
+    # Rotate about the x axis by the obliquity.
+    yp = np.cos(obliquityJ2000) * y + np.sin(obliquityJ2000) * z
+    zp = -np.sin(obliquityJ2000) * y + np.cos(obliquityJ2000) * z
+    lon = np.arctan2(yp, x) % (2. * np.pi)
+    lat = np.arcsin(np.clip(zp, -1, 1))
+    return lon, lat
+
+
+def sunEclipticLon(mjd):
+    """Calculate the J2000 ecliptic longitude of the (geocentric, astrometric) sun.
+
+    The sun's longitude is calculated with ephem once per day over the range of mjd,
+    and interpolated with a cubic spline; this matches calling ephem for each mjd
+    to better than 0.01 arcseconds.
+
+    Parameters
+    ----------
+    mjd : array_like
+        Modified Julian Date.
+
+    Returns
+    -------
+    numpy.array
+        The ecliptic longitude of the sun, in radians (0 - 2pi).
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    if mjd.size == 0:
+        return np.zeros(mjd.shape, float)
+    mjdGrid = np.arange(np.floor(mjd.min()) - 2., np.ceil(mjd.max()) + 3.)
+    sunLon = np.zeros(len(mjdGrid), float)
+    for i, djd in enumerate(mjd2djd(mjdGrid)):
+        sunLon[i] = ephem.Ecliptic(ephem.Sun(djd)).lon
+    # Remove the wraps at 2pi, to interpolate a smooth function.
+    sunLon = interpolate.CubicSpline(mjdGrid, np.unwrap(sunLon))
+    return sunLon(mjd) % (2. * np.pi)
 
 
 class GalacticStacker(BaseStacker):
@@ -115,6 +399,10 @@ class EclipticStacker(BaseStacker):
     """Add the ecliptic coordinates of each RA/Dec pointing: eclipLat, eclipLon
     Optionally subtract off the sun's ecliptic longitude and wrap.
 
+    The RA/Dec are treated as J2000 coordinates (see equatorialToEcliptic).
+    Note that earlier versions used ephem with epoch=2000, which ephem reads as the date 1905/6/23,
+    not J2000; their eclipLat/eclipLon differ from these values by up to about 45 arcseconds.
+
     Parameters
     ----------
     mjdCol : str, opt
@@ -146,24 +434,17 @@ class EclipticStacker(BaseStacker):
         if cols_present:
             # Column already present in data; assume it is correct and does not need recalculating.
             return simData
-        for i in np.arange(simData.size):
-            if self.degrees:
-                coord = ephem.Equatorial(np.radians(simData[self.raCol][i]),
-                                         np.radians(simData[self.decCol][i]), epoch=2000)
-            else:
-                coord = ephem.Equatorial(simData[self.raCol][i],
-                                         simData[self.decCol][i], epoch=2000)
-            ecl = ephem.Ecliptic(coord)
-            simData['eclipLat'][i] = ecl.lat
-            if self.subtractSunLon:
-                djd = mjd2djd(simData[self.mjdCol][i])
-                sun = ephem.Sun(djd)
-                sunEcl = ephem.Ecliptic(sun)
-                lon = wrapRA(ecl.lon - sunEcl.lon)
-                simData['eclipLon'][i] = lon
-            else:
-                simData['eclipLon'][i] = ecl.lon
+        ra = simData[self.raCol]
+        dec = simData[self.decCol]
+        if self.degrees:
+            ra = np.radians(ra)
+            dec = np.radians(dec)
+        lon, lat = equatorialToEcliptic(ra, dec)
+        if self.subtractSunLon:
+            lon = wrapRA(lon - sunEclipticLon(simData[self.mjdCol]))
         if self.degrees:
-            simData['eclipLon'] = np.degrees(simData['eclipLon'])
-            simData['eclipLat'] = np.degrees(simData['eclipLat'])
+            lon = np.degrees(lon)
+            lat = np.degrees(lat)
+        simData['eclipLat'] = lat
+        simData['eclipLon'] = lon
         return simData
@@ -187,6 +187,47 @@ class BaseDitherStacker(BaseStacker):
         # Values required for framework operation: this specifies the data columns required from the database.
         self.colsReq = [self.raCol, self.decCol]
 
+    def _groupIndices(self, groups, sequence=None):
+        """Number the visits sequentially within each group (e.g. each field).
+
+        The visits are sorted once, rather than searching for the visits of each group in turn.
+
+        Parameters
+        ----------
+        groups : numpy.ndarray
+            The group (e.g. fieldId) of each visit.
+        sequence : numpy.ndarray, optional
+            The values (e.g. night) which set the sequence within each group; visits in the same group
+            with the same value get the same index, increasing with the value.
+            If None, each visit gets the next index, in the order of the visits in the data.
+            Default None.
+
+        Returns
+        -------
+        numpy.ndarray
+            The index (starting from 0) of each visit within its group.
+        """
+        if sequence is None:
+            order = np.argsort(groups, kind='mergesort')
+        else:
+            order = np.lexsort((sequence, groups))
+        sortedGroups = groups[order]
+        newGroup = np.ones(len(order), bool)
+        newGroup[1:] = sortedGroups[1:] != sortedGroups[:-1]
+        if sequence is None:
+            newIndex = np.ones(len(order), bool)
+        else:
+            sortedSequence = sequence[order]
+            newIndex = newGroup.copy()
+            newIndex[1:] |= sortedSequence[1:] != sortedSequence[:-1]
+        # Count the indices from the start of each group.
+        counts = np.cumsum(newIndex)
+        groupStarts = np.flatnonzero(newGroup)
+        groupSizes = np.diff(np.append(groupStarts, len(order)))
+        indices = np.empty(len(order), int)
+        indices[order] = counts - np.repeat(counts[groupStarts], groupSizes)
+        return indices
+
 
 class RandomDitherFieldPerVisitStacker(BaseDitherStacker):
     """
@@ -342,32 +383,18 @@ class RandomDitherFieldPerNightStacker(RandomDitherFieldPerVisitStacker):
             else:
                 self._rng = np.random.RandomState(872453)
 
-        # Generate the random dither values, one per night per field.
-        fields = np.unique(simData[self.fieldIdCol])
-        nights = np.unique(simData[self.nightCol])
-        self._generateRandomOffsets(len(fields) * len(nights))
+        # Apply dithers, increasing each night the field is observed.
+        vertexIdxs = self._groupIndices(simData[self.fieldIdCol], simData[self.nightCol])
+        # Generate the random dither values, one per night a field is observed.
+        self._generateRandomOffsets(vertexIdxs.max() + 1 if len(vertexIdxs) > 0 else 0)
         if self.degrees:
             ra = np.radians(simData[self.raCol])
             dec = np.radians(simData[self.decCol])
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        # counter to ensure new random numbers are chosen every time
-        delta = 0
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply dithers, increasing each night.
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % len(self.xOff)
-            # ensure that the same xOff/yOff entries are not chosen
-            delta = delta + len(vertexIdxs)
-            simData['randomDitherFieldPerNightRa'][match] = (ra[match] +
-                                                             self.xOff[vertexIdxs] /
-                                                             np.cos(dec[match]))
-            simData['randomDitherFieldPerNightDec'][match] = (dec[match] +
-                                                              self.yOff[vertexIdxs])
+        simData['randomDitherFieldPerNightRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['randomDitherFieldPerNightDec'] = dec + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['randomDitherFieldPerNightRa'], simData['randomDitherFieldPerNightDec'] = \
             wrapRADec(simData['randomDitherFieldPerNightRa'], simData['randomDitherFieldPerNightDec'])
@@ -442,11 +469,9 @@ class RandomDitherPerNightStacker(RandomDitherFieldPerVisitStacker):
             ra = simData[self.raCol]
             dec = simData[self.decCol]
         # Add to RA and dec values.
-        for n, x, y in zip(nights, self.xOff, self.yOff):
-            match = np.where(simData[self.nightCol] == n)[0]
-            simData['randomDitherPerNightRa'][match] = (ra[match] +
-                                                        x / np.cos(dec[match]))
-            simData['randomDitherPerNightDec'][match] = dec[match] + y
+        vertexIdxs = np.searchsorted(nights, simData[self.nightCol])
+        simData['randomDitherPerNightRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['randomDitherPerNightDec'] = dec + self.yOff[vertexIdxs]
         # Wrap RA/Dec into expected range.
         simData['randomDitherPerNightRa'], simData['randomDitherPerNightDec'] = \
             wrapRADec(simData['randomDitherPerNightRa'], simData['randomDitherPerNightDec'])
@@ -540,16 +565,11 @@ class SpiralDitherFieldPerVisitStacker(BaseDitherStacker):
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply sequential dithers, increasing with each visit.
-            vertexIdxs = np.arange(0, len(match), 1)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['spiralDitherFieldPerVisitRa'][match] = (ra[match] +
-                                                             self.xOff[vertexIdxs] /
-                                                             np.cos(dec[match]))
-            simData['spiralDitherFieldPerVisitDec'][match] = (dec[match] +
-                                                              self.yOff[vertexIdxs])
+        # Apply sequential dithers, increasing with each visit to the field.
+        vertexIdxs = self._groupIndices(simData[self.fieldIdCol])
+        vertexIdxs = vertexIdxs % self.numPoints
+        simData['spiralDitherFieldPerVisitRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['spiralDitherFieldPerVisitDec'] = dec + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['spiralDitherFieldPerVisitRa'], simData['spiralDitherFieldPerVisitDec'] = \
             wrapRADec(simData['spiralDitherFieldPerVisitRa'], simData['spiralDitherFieldPerVisitDec'])
@@ -619,18 +639,11 @@ class SpiralDitherFieldPerNightStacker(SpiralDitherFieldPerVisitStacker):
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply a sequential dither, increasing each night.
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['spiralDitherFieldPerNightRa'][match] = (ra[match] +
-                                                             self.xOff[vertexIdxs] /
-                                                             np.cos(dec[match]))
-            simData['spiralDitherFieldPerNightDec'][match] = (dec[match] +
-                                                              self.yOff[vertexIdxs])
+        # Apply a sequential dither, increasing each night the field is observed.
+        vertexIdxs = self._groupIndices(simData[self.fieldIdCol], simData[self.nightCol])
+        vertexIdxs = vertexIdxs % self.numPoints
+        simData['spiralDitherFieldPerNightRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['spiralDitherFieldPerNightDec'] = dec + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['spiralDitherFieldPerNightRa'], simData['spiralDitherFieldPerNightDec'] = \
             wrapRADec(simData['spiralDitherFieldPerNightRa'], simData['spiralDitherFieldPerNightDec'])
@@ -797,16 +810,11 @@ class HexDitherFieldPerVisitStacker(BaseDitherStacker):
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply sequential dithers, increasing with each visit.
-            vertexIdxs = np.arange(0, len(match), 1)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['hexDitherFieldPerVisitRa'][match] = (ra[match] +
-                                                          self.xOff[vertexIdxs] /
-                                                          np.cos(dec[match]))
-            simData['hexDitherFieldPerVisitDec'][match] = dec[match] + self.yOff[vertexIdxs]
+        # Apply sequential dithers, increasing with each visit to the field.
+        vertexIdxs = self._groupIndices(simData[self.fieldIdCol])
+        vertexIdxs = vertexIdxs % self.numPoints
+        simData['hexDitherFieldPerVisitRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['hexDitherFieldPerVisitDec'] = dec + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['hexDitherFieldPerVisitRa'], simData['hexDitherFieldPerVisitDec'] = \
             wrapRADec(simData['hexDitherFieldPerVisitRa'], simData['hexDitherFieldPerVisitDec'])
@@ -871,19 +879,11 @@ class HexDitherFieldPerNightStacker(HexDitherFieldPerVisitStacker):
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply a sequential dither, increasing each night.
-            vertexIdxs = np.arange(0, len(match), 1)
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['hexDitherFieldPerNightRa'][match] = (ra[match] +
-                                                          self.xOff[vertexIdxs] /
-                                                          np.cos(dec[match]))
-            simData['hexDitherFieldPerNightDec'][match] = (dec[match] +
-                                                           self.yOff[vertexIdxs])
+        # Apply a sequential dither, increasing each night the field is observed.
+        vertexIdxs = self._groupIndices(simData[self.fieldIdCol], simData[self.nightCol])
+        vertexIdxs = vertexIdxs % self.numPoints
+        simData['hexDitherFieldPerNightRa'] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData['hexDitherFieldPerNightDec'] = dec + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['hexDitherFieldPerNightRa'], simData['hexDitherFieldPerNightDec'] = \
             wrapRADec(simData['hexDitherFieldPerNightRa'], simData['hexDitherFieldPerNightDec'])
@@ -951,14 +951,11 @@ class HexDitherPerNightStacker(HexDitherFieldPerVisitStacker):
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        # Add to RA and dec values.
-        vertexID = 0
-        for n in nights:
-            match = np.where(simData[self.nightCol] == n)[0]
-            vertexID = vertexID % self.numPoints
-            simData[self.addedRA][match] = (ra[match] + self.xOff[vertexID] / np.cos(dec[match]))
-            simData[self.addedDec][match] = dec[match] + self.yOff[vertexID]
-            vertexID += 1
+        # Add to RA and dec values, stepping to the next vertex each night.
+        vertexIdxs = np.searchsorted(nights, simData[self.nightCol])
+        vertexIdxs = vertexIdxs % self.numPoints
+        simData[self.addedRA] = ra + self.xOff[vertexIdxs] / np.cos(dec)
+        simData[self.addedDec] = dec + self.yOff[vertexIdxs]
         # Wrap RA/Dec into expected range.
         simData[self.addedRA], simData[self.addedDec] = \
             wrapRADec(simData[self.addedRA], simData[self.addedDec])
@@ -1,14 +1,16 @@
 import warnings
 import numpy as np
+from scipy import interpolate
 import palpy
 from lsst.sims.utils import Site, m5_flat_sed, xyz_from_ra_dec, xyz_angular_radius, \
     _buildTree, _xyz_from_ra_dec
 from lsst.sims.survey.fields import FieldsDatabase
 from .baseStacker import BaseStacker
+from .coordStackers import getRaDecCoords
 
 __all__ = ['NormAirmassStacker', 'ParallaxFactorStacker', 'HourAngleStacker',
            'FilterColorStacker', 'ZenithDistStacker', 'ParallacticAngleStacker',
-           'DcrStacker', 'FiveSigmaStacker', 'OpSimFieldStacker',
+           'DcrStacker', 'FiveSigmaStacker', 'OpSimFieldStacker', 'getOpSimFields',
            'SaturationStacker']
 
 # Original stackers by Peter Yoachim (yoachim@uw.edu)
@@ -183,8 +185,16 @@ class ZenithDistStacker(BaseStacker):
 
 class ParallaxFactorStacker(BaseStacker):
     """Calculate the parallax factors for each opsim pointing.  Output parallax factor in arcseconds.
+
+    The geocentric apparent places of a star with and without a 1 arcsecond parallax are calculated
+    for all visits at once: the star-independent parameters (palpy.mappa) are tabulated once per day
+    over the range of visit times and interpolated with a cubic spline, and the apparent places are
+    then calculated as palpy.mapqk does, using array math. The parallax factors match those from
+    calling palpy.mappa and palpy.mapqk for each visit to better than 1e-6 arcseconds.
     """
     colsAdded = ['ra_pi_amp', 'dec_pi_amp']
+    # The number of visits to calculate at once (this bounds the memory used).
+    blockSize = 100000
 
     def __init__(self, raCol='fieldRA', decCol='fieldDec', dateCol='observationStartMJD', degrees=True):
         self.raCol = raCol
@@ -204,36 +214,79 @@ class ParallaxFactorStacker(BaseStacker):
         y = (np.cos(Deccen)*np.sin(Dec1) - np.sin(Deccen)*np.cos(Dec1)*np.cos(RA1-RAcen)) / cosc
         return x, y
 
+    def _mappaSpline(self, mjd):
+        """Tabulate palpy.mappa (for J2000) each day over the range of mjd, and return a cubic spline
+        interpolating the 21 star-independent parameters as a function of mjd."""
+        mjdGrid = np.arange(np.floor(mjd.min()) - 2., np.ceil(mjd.max()) + 3.)
+        amprms = np.array([palpy.mappa(2000., m) for m in mjdGrid])
+        return interpolate.CubicSpline(mjdGrid, amprms, axis=0)
+
+    def _mapqk(self, ra, dec, px, amprms):
+        """Vectorized palpy.mapqk, for stars without proper motion or radial velocity.
+
+        Parameters
+        ----------
+        ra, dec : numpy.ndarray
+            The mean (J2000) RA and Dec of each star (radians).
+        px : float
+            The parallax (arcseconds).
+        amprms : numpy.ndarray
+            The star-independent parameters (as from palpy.mappa), with a row for each star.
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            The geocentric apparent RA and Dec (radians).
+        """
+        eb = amprms[:, 1:4]
+        ehn = amprms[:, 4:7]
+        gr2e = amprms[:, 7]
+        abv = amprms[:, 8:11]
+        ab1 = amprms[:, 11]
+        # Geocentric direction of the star (normalized).
+        p = np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+        p -= np.radians(px / 3600.) * eb
+        p /= np.sqrt(np.sum(p**2, axis=1))[:, np.newaxis]
+        # Light deflection (restrained within the Sun's disc).
+        pde = np.sum(p * ehn, axis=1)
+        w = gr2e / np.maximum(pde + 1., 1e-5)
+        p1 = p + w[:, np.newaxis] * (ehn - pde[:, np.newaxis] * p)
+        # Aberration.
+        w = 1. + np.sum(p1 * abv, axis=1) / (ab1 + 1.)
+        p2 = ab1[:, np.newaxis] * p1 + w[:, np.newaxis] * abv
+        # Precession and nutation.
+        p3 = np.einsum('nij,nj->ni', amprms[:, 12:21].reshape(-1, 3, 3), p2)
+        raApp = np.arctan2(p3[:, 1], p3[:, 0]) % (2. * np.pi)
+        decApp = np.arctan2(p3[:, 2], np.sqrt(p3[:, 0]**2 + p3[:, 1]**2))
+        return raApp, decApp
+
     def _run(self, simData, cols_present=False):
         if cols_present:
             # Column already present in data; assume it is correct and does not need recalculating.
             return simData
-        ra_pi_amp = np.zeros(np.size(simData), dtype=[('ra_pi_amp', 'float')])
-        dec_pi_amp = np.zeros(np.size(simData), dtype=[('dec_pi_amp', 'float')])
-        ra_geo1 = np.zeros(np.size(simData), dtype='float')
-        dec_geo1 = np.zeros(np.size(simData), dtype='float')
-        ra_geo = np.zeros(np.size(simData), dtype='float')
-        dec_geo = np.zeros(np.size(simData), dtype='float')
+        if len(simData) == 0:
+            return simData
         ra = simData[self.raCol]
         dec = simData[self.decCol]
         if self.degrees:
             ra = np.radians(ra)
             dec = np.radians(dec)
-
-        for i, ack in enumerate(simData):
-            mtoa_params = palpy.mappa(2000., simData[self.dateCol][i])
+        mjd = simData[self.dateCol]
+        mappa = self._mappaSpline(mjd)
+        ra_pi_amp = np.empty(len(mjd), float)
+        dec_pi_amp = np.empty(len(mjd), float)
+        for start in range(0, len(mjd), self.blockSize):
+            block = slice(start, start + self.blockSize)
+            amprms = mappa(mjd[block])
             # Object with a 1 arcsec parallax
-            ra_geo1[i], dec_geo1[i] = palpy.mapqk(ra[i], dec[i],
-                                                  0., 0., 1., 0., mtoa_params)
+            ra_geo1, dec_geo1 = self._mapqk(ra[block], dec[block], 1., amprms)
             # Object with no parallax
-            ra_geo[i], dec_geo[i] = palpy.mapqk(ra[i], dec[i],
-                                                0., 0., 0., 0., mtoa_params)
-        x_geo1, y_geo1 = self._gnomonic_project_toxy(ra_geo1, dec_geo1,
-                                                     ra, dec)
-        x_geo, y_geo = self._gnomonic_project_toxy(ra_geo, dec_geo, ra, dec)
-        # Return ra_pi_amp and dec_pi_amp in arcseconds.
-        ra_pi_amp[:] = np.degrees(x_geo1-x_geo)*3600.
-        dec_pi_amp[:] = np.degrees(y_geo1-y_geo)*3600.
+            ra_geo, dec_geo = self._mapqk(ra[block], dec[block], 0., amprms)
+            x_geo1, y_geo1 = self._gnomonic_project_toxy(ra_geo1, dec_geo1, ra[block], dec[block])
+            x_geo, y_geo = self._gnomonic_project_toxy(ra_geo, dec_geo, ra[block], dec[block])
+            # Return ra_pi_amp and dec_pi_amp in arcseconds.
+            ra_pi_amp[block] = np.degrees(x_geo1-x_geo)*3600.
+            dec_pi_amp[block] = np.degrees(y_geo1-y_geo)*3600.
         simData['ra_pi_amp'] = ra_pi_amp
         simData['dec_pi_amp'] = dec_pi_amp
         return simData
@@ -358,10 +411,9 @@ class HourAngleStacker(BaseStacker):
         # Check that RA is reasonable
         if (np.min(ra) < 0) | (np.max(ra) > 2.*np.pi):
             warnings.warn('RA values are not between 0 and 2 pi')
-        ha = lst - ra
-        # Wrap the results so HA between -pi and pi
-        ha = np.where(ha < -np.pi, ha + 2. * np.pi, ha)
-        ha = np.where(ha > np.pi, ha - 2. * np.pi, ha)
+        # HA = LST - RA, wrapped to between -pi and pi. Within sharedRaDecCoords, this reuses (rather than
+        #  replaces) the coordinates of the same visits, as it does not need their Dec or MJD.
+        ha = getRaDecCoords(ra).hourAngle(lst)
         # Convert radians to hours
         simData['HA'] = ha*12/np.pi
         return simData
@@ -397,12 +449,14 @@ class ParallacticAngleStacker(BaseStacker):
         # Using the run method (not _run) means that if HA is present, it will not be recalculated.
         simData = self.haStacker.run(simData)
         if self.degrees:
+            ra = np.radians(simData[self.raCol])
             dec = np.radians(simData[self.decCol])
         else:
+            ra = simData[self.raCol]
             dec = simData[self.decCol]
-        simData['PA'] = np.arctan2(np.sin(simData['HA']*np.pi/12.), (np.cos(dec) *
-                                   np.tan(self.site.latitude_rad) - np.sin(dec) *
-                                   np.cos(simData['HA']*np.pi/12.)))
+        # Share the trigonometry of RA/Dec with the hour angle stacker and other coordinate transforms.
+        coords = getRaDecCoords(ra, dec)
+        simData['PA'] = coords.parallacticAngle(simData['HA']*np.pi/12., self.site.latitude_rad)
         if self.degrees:
             simData['PA'] = np.degrees(simData['PA'])
         return simData
@@ -444,31 +498,61 @@ class FilterColorStacker(BaseStacker):
         return simData
 
 
+_opsimFieldsCache = [None]
+
+
+def getOpSimFields():
+    """Return the OpSim field centers, and a kdtree of their positions.
+
+    The fields are read from the OpSim fields database (and the tree built) only once per process;
+    they are shared by the OpSimFieldStacker and the OpsimFieldSlicer.
+
+    Returns
+    -------
+    numpy.ndarray, scipy.spatial.cKDTree
+        The fields (fieldId, fieldRA and fieldDec, in radians), sorted by fieldId,
+        and the tree of their x/y/z positions.
+    """
+    if _opsimFieldsCache[0] is None:
+        fields_db = FieldsDatabase()
+        # Returned RA/Dec coordinates in degrees
+        fieldid, ra, dec = fields_db.get_id_ra_dec_arrays("select * from Field;")
+        asort = np.argsort(fieldid)
+        fields = np.zeros(len(fieldid), dtype=list(zip(['fieldId', 'fieldRA', 'fieldDec'],
+                                                       [int, float, float])))
+        fields['fieldId'] = fieldid[asort]
+        fields['fieldRA'] = np.radians(ra[asort])
+        fields['fieldDec'] = np.radians(dec[asort])
+        _opsimFieldsCache[0] = (fields, _buildTree(fields['fieldRA'], fields['fieldDec']))
+    return _opsimFieldsCache[0]
+
+
 class OpSimFieldStacker(BaseStacker):
     """Add the fieldId of the closest OpSim field for each RA/Dec pointing.
 
+    Pointings which are further than the field radius (1.75 degrees) from every field
+    are given a fieldId of badval.
+
     Parameters
     ----------
     raCol : str, opt
         Name of the RA column. Default fieldRA.
     decCol : str, opt
         Name of the Dec column. Default fieldDec.
-
+    badval : int, opt
+        The fieldId for pointings which are not in any field. Default -666.
     """
     colsAdded = ['opsimFieldId']
 
-    def __init__(self, raCol='fieldRA', decCol='fieldDec', degrees=True):
+    def __init__(self, raCol='fieldRA', decCol='fieldDec', degrees=True, badval=-666):
         self.colsReq = [raCol, decCol]
         self.units = ['#']
+        self.colsAddedDtypes = [int]
         self.raCol = raCol
         self.decCol = decCol
         self.degrees = degrees
-        fields_db = FieldsDatabase()
-        # Returned RA/Dec coordinates in degrees
-        fieldid, ra, dec = fields_db.get_id_ra_dec_arrays("select * from Field;")
-        asort = np.argsort(fieldid)
-        self.tree = _buildTree(np.radians(ra[asort]),
-                               np.radians(dec[asort]))
+        self.badval = badval
+        self.fields, self.tree = getOpSimFields()
 
     def _run(self, simData, cols_present=False):
         if cols_present:
@@ -476,17 +560,16 @@ class OpSimFieldStacker(BaseStacker):
             return simData
 
         if self.degrees:
-            coord_x, coord_y, coord_z = xyz_from_ra_dec(simData[self.raCol],
-                                                        simData[self.decCol])
-            field_ids = self.tree.query_ball_point(list(zip(coord_x, coord_y, coord_z)),
-                                                   xyz_angular_radius())
-
+            coords = xyz_from_ra_dec(simData[self.raCol], simData[self.decCol])
         else:
             # use _xyz private method (sending radians)
-            coord_x, coord_y, coord_z = _xyz_from_ra_dec(simData[self.raCol],
-                                                         simData[self.decCol])
-            field_ids = self.tree.query_ball_point(list(zip(coord_x, coord_y, coord_z)),
-                                                   xyz_angular_radius())
-
-        simData['opsimFieldId'] = np.array([ids[0] for ids in field_ids]) + 1
+            coords = _xyz_from_ra_dec(simData[self.raCol], simData[self.decCol])
+        # Find the closest field to each pointing, within the field radius.
+        dist, idx = self.tree.query(np.column_stack(coords), k=1,
+                                    distance_upper_bound=xyz_angular_radius())
+        # Pointings without a field within the radius get idx = the number of fields.
+        found = idx < len(self.fields)
+        fieldIds = np.full(len(idx), self.badval, dtype=int)
+        fieldIds[found] = self.fields['fieldId'][idx[found]]
+        simData['opsimFieldId'] = fieldIds
         return simData
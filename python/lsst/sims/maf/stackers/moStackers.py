@@ -23,6 +23,50 @@ class BaseMoStacker(BaseStacker):
         # columns anymore (for different H values).
         return self._run(ssoObs, Href, Hval)
 
+    def runH(self, ssoObs, Href, Hvals):
+        """Add the stacker columns for all of the H values at once.
+
+        Parameters
+        ----------
+        ssoObs : np.ndarray
+            The observations of a single object.
+        Href : float
+            The reference H value of the object (from the orbit).
+        Hvals : np.ndarray
+            The H values for which to calculate the columns.
+
+        Returns
+        -------
+        np.ndarray, dict
+            The observations with the stacker columns added, and a dictionary of the columns
+            which depend on H, each as a 2-d array of shape (len(Hvals), len(ssoObs)).
+        """
+        if len(ssoObs) == 0:
+            return ssoObs, {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            ssoObs, cols_present = self._addStackerCols(ssoObs)
+        return self._runH(ssoObs, Href, np.asarray(Hvals))
+
+    def _runH(self, ssoObs, Href, Hvals):
+        raise NotImplementedError('This stacker does not calculate its columns for all H values at once.')
+
+    def skipRandom(self, nObs):
+        """Advance any random number generator used by the stacker as if the stacker had been run
+        for nObs observations (summed over all H values). Most stackers do not use random numbers."""
+        pass
+
+    def canRunH(self):
+        """Return True if the stacker can calculate its columns for all H values at once, with runH.
+
+        As for BaseMetric.canRunBatch, _runH must be implemented by the same class as _run
+        (or a subclass of it).
+        """
+        mro = type(self).__mro__
+        runClass = next(c for c in mro if '_run' in c.__dict__)
+        runHClass = next(c for c in mro if '_runH' in c.__dict__)
+        return runHClass is not BaseMoStacker and issubclass(runHClass, runClass)
+
 
 class MoMagStacker(BaseMoStacker):
     """Add columns relevant to SSobject apparent magnitudes and visibility to the slicer ssoObs
@@ -71,6 +115,22 @@ class MoMagStacker(BaseMoStacker):
         self.colsReq = [self.m5Col, self.vMagCol, self.colorCol, self.lossCol]
         self.units = ['mag', 'mag', 'SNR', '']
 
+    def _setupRng(self):
+        if not hasattr(self, '_rng'):
+            if self.randomSeed is not None:
+                self._rng = np.random.RandomState(self.randomSeed)
+            else:
+                self._rng = np.random.RandomState(734421)
+
+    def skipRandom(self, nObs):
+        """Advance the random number generator as if the visibility of nObs observations
+        (summed over all H values) had been calculated."""
+        self._setupRng()
+        blockSize = 1000000
+        while nObs > 0:
+            self._rng.random_sample(min(nObs, blockSize))
+            nObs -= blockSize
+
     def _run(self, ssoObs, Href, Hval):
         # Hval = current H value (useful if cloning over H range), Href = reference H value from orbit.
         # Without cloning, Href = Hval.
@@ -79,16 +139,28 @@ class MoMagStacker(BaseMoStacker):
         xval = np.power(10, 0.5 * (ssoObs['appMag'] - ssoObs[self.m5Col]))
         ssoObs['SNR'] = 1.0 / np.sqrt((0.04 - self.gamma) * xval + self.gamma * xval * xval)
         completeness = 1.0 / (1 + np.exp((ssoObs['appMag'] - ssoObs[self.m5Col])/self.sigma))
-        if not hasattr(self, '_rng'):
-            if self.randomSeed is not None:
-                self._rng = np.random.RandomState(self.randomSeed)
-            else:
-                self._rng = np.random.RandomState(734421)
+        self._setupRng()
 
         probability = self._rng.random_sample(len(ssoObs['appMag']))
         ssoObs['vis'] = np.where(probability <= completeness, 1, 0)
         return ssoObs
 
+    def _runH(self, ssoObs, Href, Hvals):
+        # Changing H only shifts the magnitudes, so calculate all H values in one (nH, nObs) array.
+        # The additions follow the same order as _run, so the values are identical.
+        Hvals = Hvals[:, np.newaxis]
+        appMagV = ssoObs[self.vMagCol] + ssoObs[self.lossCol] + Hvals - Href
+        appMag = ssoObs[self.vMagCol] + ssoObs[self.colorCol] + ssoObs[self.lossCol] + Hvals - Href
+        xval = np.power(10, 0.5 * (appMag - ssoObs[self.m5Col]))
+        snr = 1.0 / np.sqrt((0.04 - self.gamma) * xval + self.gamma * xval * xval)
+        completeness = 1.0 / (1 + np.exp((appMag - ssoObs[self.m5Col])/self.sigma))
+        self._setupRng()
+        # Drawing all of the random values at once uses the random sequence in the same order as
+        # running each H value in turn.
+        probability = self._rng.random_sample(appMag.shape)
+        vis = np.where(probability <= completeness, 1, 0)
+        return ssoObs, {'appMagV': appMagV, 'appMag': appMag, 'SNR': snr, 'vis': vis}
+
 
 class CometMagVStacker(BaseMoStacker):
     """Add an base V magnitude using a cometary magnitude model.
@@ -124,6 +196,10 @@ class CometMagVStacker(BaseMoStacker):
                            + (5 + self.k) * np.log10(ssObs[self.rhCol]))
         return ssObs
 
+    def _runH(self, ssObs, Href, Hvals):
+        # cometV does not depend on Hval.
+        return self._run(ssObs, Href, Href), {}
+
 
 class EclStacker(BaseMoStacker):
     """
@@ -165,3 +241,7 @@ class EclStacker(BaseMoStacker):
         ssoObs['ecLon'] = np.degrees(np.arctan2(yp, xp))
         ssoObs['ecLon'] = ssoObs['ecLon'] % 360
         return ssoObs
+
+    def _runH(self, ssoObs, Href, Hvals):
+        # The ecliptic coordinates do not depend on Hval.
+        return self._run(ssoObs, Href, Href), {}
@@ -1,7 +1,7 @@
 from builtins import zip
 import numpy as np
 from .baseStacker import BaseStacker
-from .coordStackers import raDec2AltAz
+from .coordStackers import getRaDecCoords
 
 __all__ = ['findTelescopes', 'NFollowStacker']
 
@@ -138,26 +138,20 @@ class NFollowStacker(BaseStacker):
     def _run(self, simData, cols_present=False):
         if cols_present:
             return simData
-        simData['nObservatories'] = 0
         if self.degrees:
             ra = np.radians(simData[self.raCol])
             dec = np.radians(simData[self.decCol])
         else:
             ra = simData[self.raCol]
             dec = simData[self.decCol]
-        for obs in self.telescopes:
-            obsGotIt = np.zeros(len(simData[self.raCol]), int)
-            obsLon = np.radians(obs['lon'])
-            obsLat = np.radians(obs['lat'])
-            for step in self.timeSteps:
-                alt, az = raDec2AltAz(ra, dec, obsLon, obsLat,
-                                      simData[self.mjdCol] + step / 24.0,
-                                      altonly=True)
-                airmass = 1. / (np.cos(np.pi / 2. - alt))
-                followed = np.where((airmass <= self.airmassLimit) & (airmass >= 1.))
-                # If the observatory got an observation, save this into obsGotIt.
-                # obsGotIt will be 1 if ANY of the times got an observation.
-                obsGotIt[followed] = 1
-            # If an observatory got an observation, count it in nObservatories.
-            simData['nObservatories'] += obsGotIt
+        # Telescopes at the same site see the same sky, so evaluate each site once,
+        #  counting the number of telescopes there.
+        sites, nTelescopes = np.unique(np.column_stack([self.telescopes['lat'], self.telescopes['lon']]),
+                                       axis=0, return_counts=True)
+        # The airmass (1/sin(alt)) is at most airmassLimit where sin(alt) >= 1/airmassLimit.
+        minAlt = np.arcsin(1. / self.airmassLimit)
+        coords = getRaDecCoords(ra, dec, simData[self.mjdCol])
+        simData['nObservatories'] = coords.countVisible(np.radians(sites[:, 0]), np.radians(sites[:, 1]),
+                                                        np.asarray(self.timeSteps) / 24.0, minAlt,
+                                                        weights=nTelescopes)
         return simData
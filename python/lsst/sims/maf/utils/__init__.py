@@ -3,3 +3,4 @@ from .getDateVersion import *
 from .outputUtils import *
 from .opsimUtils import *
 from .astrometryUtils import *
+from .columnarSimData import *
@@ -0,0 +1,153 @@
+from builtins import object
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['ColumnarSimData']
+
+
+class ColumnarSimData(object):
+    """Simulated survey (visit) data, held as a set of contiguous column arrays.
+
+    Columns can be added (e.g. by stackers) without copying the existing columns, unlike
+    adding a field to a numpy structured array. Indexing follows numpy structured arrays:
+    a column name returns that column (which can be modified in place), while a list of
+    column names, an index array, a boolean mask or a slice returns a structured array
+    of the selected columns or rows. This means that simData[idxs] presents the usual
+    record-style data to metrics.
+
+    Parameters
+    ----------
+    data : numpy.ndarray or dict of numpy.ndarray, optional
+        A structured array or a dictionary of (equal length) column arrays.
+        The columns are copied into new contiguous arrays. Default None (no columns).
+    """
+    def __init__(self, data=None):
+        self._columns = OrderedDict()
+        self._dtype = None
+        self._nrows = 0
+        if data is None:
+            return
+        if isinstance(data, ColumnarSimData):
+            names = data.names
+        elif isinstance(data, dict):
+            names = list(data.keys())
+        else:
+            names = data.dtype.names
+        for name in names:
+            self[name] = data[name]
+
+    @property
+    def names(self):
+        """The names of the columns, in the order they were added."""
+        return list(self._columns.keys())
+
+    @property
+    def dtype(self):
+        """The dtype of the equivalent structured array."""
+        if self._dtype is None:
+            self._dtype = np.dtype([(name, col.dtype, col.shape[1:]) for name, col in self._columns.items()])
+        return self._dtype
+
+    @property
+    def size(self):
+        return self._nrows
+
+    @property
+    def shape(self):
+        return (self._nrows,)
+
+    def __len__(self):
+        return self._nrows
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def addColumn(self, name, dtype=float):
+        """Add a new (uninitialized) column, without copying any of the existing columns.
+
+        Parameters
+        ----------
+        name : str
+            The name of the column. If the column is already present, it is left unchanged.
+        dtype : numpy.dtype, optional
+            The dtype of the new column. Default float.
+
+        Returns
+        -------
+        numpy.ndarray
+            The column array.
+        """
+        if name not in self._columns:
+            self._columns[name] = np.empty(self._nrows, dtype=dtype)
+            self._dtype = None
+        return self._columns[name]
+
+    def setColumn(self, name, values):
+        """Set (or replace) a column with the values array itself, without copying it.
+
+        Parameters
+        ----------
+        name : str
+            The name of the column.
+        values : numpy.ndarray
+            The new column, which must have one row for each row of the data.
+        """
+        if len(values) != self._nrows:
+            raise ValueError('Column %s has %d rows, but the data has %d rows.'
+                             % (name, len(values), self._nrows))
+        self._columns[name] = values
+        self._dtype = None
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key]
+        if isinstance(key, list) and len(key) > 0 and all(isinstance(k, str) for k in key):
+            return self._records(slice(None), key)
+        return self._records(key, self.names)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError('ColumnarSimData only supports setting whole columns (by column name).')
+        if key in self._columns:
+            self._columns[key][...] = value
+            return
+        if len(self._columns) == 0:
+            self._nrows = len(value)
+        # Always store a new contiguous copy, so that the column does not share memory with the input.
+        self._columns[key] = np.array(np.broadcast_to(value, (self._nrows,) + np.shape(value)[1:]))
+        self._dtype = None
+
+    def _records(self, rows, names):
+        """Return the selected rows and columns as a structured array."""
+        columns = [self._columns[name][rows] for name in names]
+        dtype = np.dtype([(name, self._columns[name].dtype, self._columns[name].shape[1:]) for name in names])
+        # The number of row dimensions selected (0 for a single row).
+        ndim = np.ndim(columns[0]) - self._columns[names[0]].ndim + 1
+        records = np.empty(np.shape(columns[0])[:ndim], dtype=dtype)
+        for name, column in zip(names, columns):
+            records[name] = column
+        if ndim == 0:
+            return records[()]
+        return records
+
+    def select(self, rows):
+        """Return a new ColumnarSimData holding only the selected rows.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray or slice
+            An index array, boolean mask or slice selecting the rows.
+
+        Returns
+        -------
+        ColumnarSimData
+        """
+        subset = ColumnarSimData()
+        for name, column in self._columns.items():
+            subset._columns[name] = column[rows]
+            subset._nrows = len(subset._columns[name])
+        return subset
+
+    def toRecArray(self):
+        """Return all of the data as a numpy structured array."""
+        return self._records(slice(None), self.names)
@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+"""Benchmarks of the MAF hot paths, run on reproducible synthetic opsim data.
+
+Times (and optionally measures the peak python memory of) HealpixSlicer setup and iteration,
+MetricBundleGroup.runAll for a glance-style set of metric bundles, the stackers,
+MoMetricBundleGroup on synthetic orbits, resultsDb writes and plotting, and writes the results
+as json so that they can be compared between versions of MAF.
+
+Run with (for example)::
+
+    python mafBenchmarks.py --nvisits 1000000 --output new.json --compare old.json
+
+The functions here can also be imported (see testMafBenchmarks.py).
+"""
+from __future__ import print_function
+import matplotlib
+matplotlib.use('Agg')
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import lsst.sims.maf.db as db
+import lsst.sims.maf.metrics as metrics
+import lsst.sims.maf.slicers as slicers
+import lsst.sims.maf.stackers as stackers
+import lsst.sims.maf.metricBundles as metricBundles
+import lsst.sims.maf.utils as utils
+
+filterNames = ('u', 'g', 'r', 'i', 'z', 'y')
+# The fraction of visits in each filter, and the typical (zenith, dark sky) five sigma depth.
+filterFractions = (0.07, 0.09, 0.22, 0.22, 0.20, 0.20)
+filterM5 = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3, 'y': 22.1}
+filterSky = {'u': 22.9, 'g': 22.3, 'r': 21.2, 'i': 20.5, 'z': 19.6, 'y': 18.6}
+siteLatitude = -30.2446388
+siteLongitude = -70.7494167
+
+benchmarkNames = ('healpixSetupSlicer', 'healpixIteration', 'runAll', 'stackers', 'moSlicerSetup',
+                  'moRunAll', 'resultsDbWrites', 'plotAll', 'plotAllUnchanged')
+
+
+def makeSimData(nvisits=100000, nfields=5000, seed=42):
+    """Generate a reproducible synthetic opsim visit table.
+
+    The visits are spread over ten years of nights, with each visit taken on one of nfields
+    fields (spread uniformly over the sky south of dec=+10) close to the meridian,
+    so that the RA, Dec, altitude, airmass and observation times are consistent.
+    The filters, seeing, sky brightness and five sigma depths follow typical LSST values.
+
+    Parameters
+    ----------
+    nvisits : int, optional
+        The number of visits. Default 100000.
+    nfields : int, optional
+        The number of fields. Default 5000.
+    seed : int, optional
+        The random seed. Default 42.
+
+    Returns
+    -------
+    numpy.ndarray
+        The visits, as a structured array with opsim v4 column names, sorted by observationStartMJD.
+    """
+    rng = np.random.RandomState(seed)
+    # The field centers.
+    fieldRA = rng.rand(nfields) * 360.
+    fieldDec = np.degrees(np.arcsin(rng.rand(nfields) * (1. + np.sin(np.radians(10.))) - 1.))
+    fieldXyz = np.column_stack(_xyz(np.radians(fieldRA), np.radians(fieldDec)))
+    # The visit times: about eight hours on each night, over ten years.
+    night = np.sort(rng.randint(1, 3653, nvisits))
+    mjd = 59853.5 + night + 0.1 + rng.rand(nvisits) * 0.35
+    lst = _lst(mjd)
+    # Observe the field closest to a pointing near the meridian.
+    ha = rng.normal(0., 20., nvisits)
+    dec = np.degrees(np.arcsin(rng.rand(nvisits) * (1. + np.sin(np.radians(10.))) - 1.))
+    _, fieldIdx = cKDTree(fieldXyz).query(np.column_stack(_xyz(np.radians(lst - ha), np.radians(dec))))
+    ra = fieldRA[fieldIdx]
+    dec = fieldDec[fieldIdx]
+    alt, az = _altAz(np.radians(lst - ra), np.radians(dec))
+    airmass = 1. / np.cos(np.pi / 2. - np.maximum(alt, np.radians(15.)))
+    filterIdx = rng.choice(len(filterNames), nvisits, p=filterFractions)
+    filters = np.array(filterNames)[filterIdx]
+    seeingEff = rng.lognormal(np.log(0.8), 0.2, nvisits) * airmass ** 0.6
+    skyBrightness = np.array([filterSky[f] for f in filterNames])[filterIdx] - rng.exponential(0.4, nvisits)
+    m5 = np.array([filterM5[f] for f in filterNames])[filterIdx]
+    m5 = m5 - 0.25 * (airmass - 1.) - 1.25 * np.log10(seeingEff / 0.7) + rng.normal(0., 0.1, nvisits)
+    slewDistance = rng.exponential(5., nvisits)
+    columns = OrderedDict([('observationId', np.arange(nvisits)),
+                           ('night', night),
+                           ('observationStartMJD', mjd),
+                           ('observationStartLST', lst),
+                           ('fieldId', fieldIdx + 1),
+                           ('fieldRA', ra),
+                           ('fieldDec', dec),
+                           ('altitude', np.degrees(alt)),
+                           ('azimuth', np.degrees(az)),
+                           ('airmass', airmass),
+                           ('filter', filters),
+                           ('visitExposureTime', np.full(nvisits, 30.)),
+                           ('visitTime', np.full(nvisits, 34.)),
+                           ('numExposures', np.full(nvisits, 2)),
+                           ('slewTime', 4.5 + slewDistance * 1.2),
+                           ('slewDistance', slewDistance),
+                           ('seeingFwhmEff', seeingEff),
+                           ('seeingFwhmGeom', 0.822 * seeingEff + 0.052),
+                           ('skyBrightness', skyBrightness),
+                           ('fiveSigmaDepth', m5),
+                           ('moonDistance', rng.rand(nvisits) * 180.),
+                           ('rotSkyPos', rng.rand(nvisits) * 360.),
+                           ('rotTelPos', rng.rand(nvisits) * 180. - 90.),
+                           ('proposalId', np.where(rng.rand(nvisits) < 0.85, 1, 2))])
+    simData = np.empty(nvisits, dtype=[(name, col.dtype) for name, col in columns.items()])
+    for name, col in columns.items():
+        simData[name] = col
+    return simData
+
+
+def _xyz(ra, dec):
+    return np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)
+
+
+def _lst(mjd):
+    """The (approximate) local sidereal time at the site, in degrees."""
+    gmst = 280.46061837 + 360.98564736629 * (mjd - 51544.5)
+    return (gmst + siteLongitude) % 360.
+
+
+def _altAz(ha, dec):
+    """The altitude and azimuth (radians) of hour angle and dec (radians), at the site."""
+    lat = np.radians(siteLatitude)
+    sinAlt = np.sin(dec) * np.sin(lat) + np.cos(dec) * np.cos(lat) * np.cos(ha)
+    alt = np.arcsin(sinAlt)
+    az = np.arctan2(-np.cos(dec) * np.sin(ha),
+                    np.sin(dec) * np.cos(lat) - np.cos(dec) * np.sin(lat) * np.cos(ha))
+    return alt, az % (2. * np.pi)
+
+
+def writeSimDatabase(simData, dbFile, tableName='SummaryAllProps'):
+    """Write the visits to a sqlite database, which can be read with lsst.sims.maf.db.Database."""
+    conn = sqlite3.connect(dbFile)
+    try:
+        pd.DataFrame(simData).to_sql(tableName, conn, index=False)
+    finally:
+        conn.close()
+    return dbFile
+
+
+def writeMoFiles(outDir, nobj=1000, nobsPerObj=50, seed=42):
+    """Write a reproducible synthetic orbit file and moving object observation file.
+
+    The observations of each object come in pairs, on randomly chosen nights over ten years,
+    as written by sims_movingObjects (grouped by object).
+
+    Returns
+    -------
+    str, str
+        The orbit file and observation file names.
+    """
+    rng = np.random.RandomState(seed)
+    orbits = pd.DataFrame(OrderedDict([('objId', np.arange(nobj)),
+                                       ('q', 1. + rng.rand(nobj) * 2.),
+                                       ('e', rng.rand(nobj) * 0.3),
+                                       ('inc', rng.rand(nobj) * 30.),
+                                       ('Omega', rng.rand(nobj) * 360.),
+                                       ('argPeri', rng.rand(nobj) * 360.),
+                                       ('tPeri', 59853. + rng.rand(nobj) * 1500.),
+                                       ('epoch', np.full(nobj, 59853.)),
+                                       ('H', 14. + rng.rand(nobj) * 8.),
+                                       ('g', np.full(nobj, 0.15)),
+                                       ('sed_filename', np.where(rng.rand(nobj) < 0.5, 'C.dat', 'S.dat'))]))
+    orbitFile = os.path.join(outDir, 'orbits.txt')
+    orbits.to_csv(orbitFile, sep=' ', index=False)
+    npairs = nobsPerObj // 2
+    objId = np.repeat(orbits['objId'].values, npairs * 2)
+    night = np.sort(rng.randint(1, 3653, (nobj, npairs)), axis=1)
+    mjd = 59853.5 + night + rng.rand(nobj, npairs) * 0.3
+    # Two visits, about 30 minutes apart, on each night.
+    mjd = np.stack([mjd, mjd + 0.02], axis=2).ravel()
+    night = np.repeat(night.ravel(), 2)
+    nobs = len(objId)
+    obs = pd.DataFrame(OrderedDict([('objId', objId),
+                                    ('observationStartMJD', mjd),
+                                    ('night', night),
+                                    ('ra', rng.rand(nobs) * 360.),
+                                    ('dec', rng.rand(nobs) * 100. - 90.),
+                                    ('dradt', rng.normal(0., 0.5, nobs)),
+                                    ('ddecdt', rng.normal(0., 0.5, nobs)),
+                                    ('velocity', rng.rand(nobs)),
+                                    ('geo_dist', 0.5 + rng.rand(nobs) * 2.),
+                                    ('solarElong', 60. + rng.rand(nobs) * 120.),
+                                    ('magV', 19. + rng.rand(nobs) * 5.),
+                                    ('dmagColor', rng.rand(nobs) * 0.2),
+                                    ('dmagDetect', rng.rand(nobs) * 0.1),
+                                    ('fiveSigmaDepth', rng.normal(24., 0.4, nobs))]))
+    obsFile = os.path.join(outDir, 'obs.txt')
+    obs.to_csv(obsFile, sep=' ', index=False, float_format='%.6f')
+    return orbitFile, obsFile
+
+
+def glanceBundles(nside=64, runName='bench'):
+    """A glance-style set of metric bundles: per-filter and all-visit depth and visit count maps,
+    plus some survey-wide summaries (without the batches' dependence on the full opsim schema)."""
+    bundleList = []
+    for f in ('',) + filterNames:
+        constraint = '' if f == '' else "filter = '%s'" % f
+        metadata = 'all bands' if f == '' else '%s band' % f
+        metricList = [metrics.CountMetric(col='observationStartMJD', metricName='NVisits'),
+                      metrics.Coaddm5Metric(),
+                      metrics.MedianMetric(col='seeingFwhmEff'),
+                      metrics.MedianMetric(col='airmass')]
+        for metric in metricList:
+            slicer = slicers.HealpixSlicer(nside=nside, verbose=False)
+            bundleList.append(metricBundles.MetricBundle(metric, slicer, constraint, runName=runName,
+                                                         metadata=metadata,
+                                                         summaryMetrics=[metrics.MeanMetric(),
+                                                                         metrics.MedianMetric(),
+                                                                         metrics.RmsMetric()]))
+        metricList = [metrics.CountMetric(col='observationStartMJD', metricName='NVisits'),
+                      metrics.SumMetric(col='visitExposureTime'),
+                      metrics.MeanMetric(col='slewTime'),
+                      metrics.MedianMetric(col='fiveSigmaDepth')]
+        for metric in metricList:
+            bundleList.append(metricBundles.MetricBundle(metric, slicers.UniSlicer(), constraint,
+                                                         runName=runName, metadata=metadata))
+    for bundle in bundleList:
+        bundle.stackerList = []
+    return metricBundles.makeBundlesDictFromList(bundleList)
+
+
+def benchmarkStackers():
+    """The stackers to time, keyed by name."""
+    return OrderedDict([('NormAirmassStacker', stackers.NormAirmassStacker()),
+                        ('ZenithDistStacker', stackers.ZenithDistStacker()),
+                        ('HourAngleStacker', stackers.HourAngleStacker()),
+                        ('ParallaxFactorStacker', stackers.ParallaxFactorStacker()),
+                        ('EclipticStacker', stackers.EclipticStacker()),
+                        ('GalacticStacker', stackers.GalacticStacker()),
+                        ('OpSimFieldStacker', stackers.OpSimFieldStacker()),
+                        ('RandomDitherFieldPerVisitStacker',
+                         stackers.RandomDitherFieldPerVisitStacker(randomSeed=42)),
+                        ('RandomDitherFieldPerNightStacker',
+                         stackers.RandomDitherFieldPerNightStacker(randomSeed=42)),
+                        ('SpiralDitherFieldPerNightStacker', stackers.SpiralDitherFieldPerNightStacker()),
+                        ('HexDitherFieldPerNightStacker', stackers.HexDitherFieldPerNightStacker()),
+                        ('RandomRotDitherPerFilterChangeStacker',
+                         stackers.RandomRotDitherPerFilterChangeStacker(randomSeed=42))])
+
+
+def timeBenchmark(name, setup, run, repeat=3, memory=True, params=None):
+    """Time run(setup()), repeat times, and optionally measure its peak python memory use.
+
+    The peak memory is measured (with tracemalloc, which includes numpy arrays) in one extra run,
+    so that the memory tracing does not slow down the timed runs. It does not include any
+    memory used in other processes.
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark.
+    setup : callable
+        Returns the (fresh) input for run. Not timed.
+    run : callable
+        The function to time.
+    repeat : int, optional
+        The number of timed runs. Default 3.
+    memory : bool, optional
+        Measure the peak memory. Default True.
+    params : dict, optional
+        The parameters of the benchmark, which are recorded with its results.
+
+    Returns
+    -------
+    dict
+        The benchmark results: name, params, times (seconds), best, median and
+        peakMemoryMB (or error, if the benchmark raised an exception).
+    """
+    result = OrderedDict([('name', name), ('params', params or {})])
+    try:
+        times = []
+        for i in range(repeat):
+            state = setup()
+            gc.collect()
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+            del state
+        result['times'] = times
+        result['best'] = min(times)
+        result['median'] = float(np.median(times))
+        if memory:
+            state = setup()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                run(state)
+                result['peakMemoryMB'] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+            finally:
+                tracemalloc.stop()
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+
+def runBenchmarks(nvisits=100000, nside=64, nobj=1000, nobsPerObj=50, nmetrics=500, nProcs=1,
+                  repeat=3, memory=True, benchmarks=None, seed=42, verbose=False):
+    """Run the benchmarks.
+
+    Parameters
+    ----------
+    nvisits : int, optional
+        The number of synthetic visits. Default 100000.
+    nside : int, optional
+        The nside of the healpix slicers. Default 64.
+    nobj : int, optional
+        The number of synthetic moving objects. Default 1000.
+    nobsPerObj : int, optional
+        The number of observations of each moving object. Default 50.
+    nmetrics : int, optional
+        The number of metrics to write to the resultsDb. Default 500.
+    nProcs : int, optional
+        The number of processes for runAll and plotAll. Default 1.
+    repeat : int, optional
+        The number of timed runs of each benchmark. Default 3.
+    memory : bool, optional
+        Measure the peak memory of each benchmark. Default True.
+    benchmarks : list of str, optional
+        The benchmarks to run (see benchmarkNames). Default None (all of them).
+    seed : int, optional
+        The random seed for the synthetic data. Default 42.
+    verbose : bool, optional
+        Print the results of each benchmark as it finishes. Default False.
+
+    Returns
+    -------
+    dict
+        The metadata (versions and parameters) and the list of benchmark results.
+    """
+    if benchmarks is None:
+        benchmarks = benchmarkNames
+    for name in benchmarks:
+        if name not in benchmarkNames:
+            raise ValueError('Unknown benchmark %s (choose from %s)' % (name, benchmarkNames))
+    params = OrderedDict([('nvisits', nvisits), ('nside', nside), ('nobj', nobj),
+                          ('nobsPerObj', nobsPerObj), ('nmetrics', nmetrics), ('nProcs', nProcs),
+                          ('repeat', repeat), ('seed', seed)])
+    results = []
+
+    def add(name, setup, run, **kwargs):
+        result = timeBenchmark(name, setup, run, repeat=repeat, memory=memory, params=kwargs)
+        if verbose:
+            print(formatResult(result))
+        results.append(result)
+
+    workDir = tempfile.mkdtemp(prefix='mafBenchmarks')
+    try:
+        simData = makeSimData(nvisits, seed=seed)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            if 'healpixSetupSlicer' in benchmarks:
+                add('healpixSetupSlicer', lambda: slicers.HealpixSlicer(nside=nside, verbose=False,
+                                                                        useCache=False),
+                    lambda slicer: slicer.setupSlicer(simData), nside=nside, nvisits=nvisits)
+            if 'healpixIteration' in benchmarks:
+                slicer = slicers.HealpixSlicer(nside=nside, verbose=False, useCache=False)
+                slicer.setupSlicer(simData)
+                add('healpixIteration', lambda: slicer,
+                    lambda slicer: sum(len(s['idxs']) for s in slicer), nside=nside, nvisits=nvisits)
+            if set(benchmarks) & set(['runAll', 'plotAll', 'plotAllUnchanged']):
+                dbFile = writeSimDatabase(simData, os.path.join(workDir, 'opsim.db'))
+                groups = []
+
+                def runAllSetup():
+                    outDir = os.path.join(workDir, 'runAll%d' % len(groups))
+                    os.mkdir(outDir)
+                    database = db.Database(dbFile, defaultTable='SummaryAllProps')
+                    group = metricBundles.MetricBundleGroup(glanceBundles(nside), database, outDir=outDir,
+                                                            resultsDb=db.ResultsDb(outDir=outDir),
+                                                            saveEarly=False, verbose=False, nProcs=nProcs)
+                    groups.append(group)
+                    return group
+            if 'runAll' in benchmarks:
+                add('runAll', runAllSetup, lambda group: group.runAll(), nside=nside, nvisits=nvisits,
+                    nProcs=nProcs)
+            if 'stackers' in benchmarks:
+                for name, stacker in benchmarkStackers().items():
+                    add('stacker.%s' % name, lambda: utils.ColumnarSimData(simData), stacker.run,
+                        nvisits=nvisits)
+            if set(benchmarks) & set(['moSlicerSetup', 'moRunAll']):
+                orbitFile, obsFile = writeMoFiles(workDir, nobj=nobj, nobsPerObj=nobsPerObj, seed=seed)
+
+                def moSlicer():
+                    slicer = slicers.MoObjSlicer(Hrange=np.arange(13, 23, 0.5), verbose=False)
+                    slicer.setupSlicer(orbitFile, obsFile=obsFile)
+                    return slicer
+            if 'moSlicerSetup' in benchmarks:
+                add('moSlicerSetup', lambda: None, lambda state: moSlicer(), nobj=nobj,
+                    nobsPerObj=nobsPerObj)
+            if 'moRunAll' in benchmarks:
+                def moRunAllSetup():
+                    slicer = moSlicer()
+                    discovery = metrics.DiscoveryMetric(nNightsPerWindow=2, tWindow=15)
+                    bundles = {'nobs': metricBundles.MoMetricBundle(metrics.NObsMetric(), slicer,
+                                                                   runName='bench'),
+                               'arc': metricBundles.MoMetricBundle(metrics.ObsArcMetric(), slicer,
+                                                                  runName='bench'),
+                               'discovery': metricBundles.MoMetricBundle(
+                                   discovery, slicer, runName='bench', stackerList=[stackers.EclStacker()],
+                                   childMetrics=discovery.childMetrics)}
+                    return metricBundles.MoMetricBundleGroup(bundles, outDir=os.path.join(workDir, 'mo'),
+                                                             verbose=False, nProcs=nProcs)
+                add('moRunAll', moRunAllSetup, lambda group: group.runAll(), nobj=nobj,
+                    nobsPerObj=nobsPerObj, nProcs=nProcs)
+            if 'resultsDbWrites' in benchmarks:
+                def resultsDbSetup():
+                    outDir = tempfile.mkdtemp(dir=workDir)
+                    return db.ResultsDb(outDir=outDir)
+                add('resultsDbWrites', resultsDbSetup, lambda resultsDb: writeResults(resultsDb, nmetrics),
+                    nmetrics=nmetrics)
+            if set(benchmarks) & set(['plotAll', 'plotAllUnchanged']):
+                # Plot the all-visit healpix metric bundles.
+                group = runAllSetup()
+                group.runAll()
+                plotBundles = OrderedDict((k, b) for k, b in group.bundleDict.items()
+                                          if b.constraint == '' and b.slicer.slicerName == 'HealpixSlicer')
+                group = metricBundles.MetricBundleGroup(plotBundles, None, outDir=group.outDir,
+                                                        resultsDb=group.resultsDb, verbose=False)
+                plotKwargs = dict(figformat='png', dpi=72, closefigs=True, nProcs=nProcs)
+            if 'plotAll' in benchmarks:
+                add('plotAll', lambda: group, lambda group: group.plotAll(skipUnchanged=False, **plotKwargs),
+                    nside=nside, nplots=3 * len(group.bundleDict), nProcs=nProcs)
+            if 'plotAllUnchanged' in benchmarks:
+                def plotUnchangedSetup():
+                    group.plotAll(**plotKwargs)
+                    return group
+                add('plotAllUnchanged', plotUnchangedSetup, lambda group: group.plotAll(**plotKwargs),
+                    nside=nside, nplots=3 * len(group.bundleDict), nProcs=nProcs)
+    finally:
+        shutil.rmtree(workDir)
+    return OrderedDict([('metadata', benchmarkMetadata(params)), ('results', results)])
+
+
+def writeResults(resultsDb, nmetrics):
+    """Write nmetrics metrics, with their displays, plots and summary statistics, to resultsDb."""
+    with resultsDb.batchWrites():
+        for i in range(nmetrics):
+            metricId = resultsDb.updateMetric('Metric%d' % i, 'HealpixSlicer', 'bench', "filter = 'r'",
+                                              'r band', 'bench_Metric%d.npz' % i)
+            resultsDb.updateDisplay(metricId, {'group': 'Group%d' % (i % 10), 'subgroup': 'All',
+                                               'order': i, 'caption': 'Metric %d' % i})
+            for plotType in ('SkyMap', 'Histogram', 'PowerSpectrum'):
+                resultsDb.updatePlot(metricId, plotType, 'bench_Metric%d_%s.png' % (i, plotType))
+            for summaryName in ('Mean', 'Median', 'Rms', 'Min', 'Max'):
+                resultsDb.updateSummaryStat(metricId, summaryName, float(i))
+
+
+def benchmarkMetadata(params):
+    """The versions of python, numpy and MAF, the machine and the benchmark parameters."""
+    try:
+        date, versionInfo = utils.getDateVersion()
+        mafVersion = versionInfo['__version__']
+    except (AttributeError, ImportError):
+        date, mafVersion = time.strftime('%Y-%m-%d'), None
+    return OrderedDict([('date', date), ('mafVersion', mafVersion),
+                        ('python', platform.python_version()), ('numpy', np.__version__),
+                        ('platform', platform.platform()), ('processor', platform.processor()),
+                        ('cpuCount', os.cpu_count()), ('params', params)])
+
+
+def formatResult(result, reference=None):
+    """Format a benchmark result (and its speedup over the reference result) as a line of text."""
+    if 'error' in result:
+        return '%-45s  failed (%s)' % (result['name'], result['error'])
+    line = '%-45s  %10.4f s' % (result['name'], result['best'])
+    if 'peakMemoryMB' in result:
+        line += '  %10.1f MB' % (result['peakMemoryMB'])
+    if reference is not None and 'best' in reference:
+        line += '  x%.2f' % (reference['best'] / result['best'] if result['best'] > 0 else np.inf)
+    return line
+
+
+def compareResults(results, reference):
+    """Return lines comparing the benchmark results to the reference results (from another version).
+
+    The speedup is the ratio of the best reference time to the best time.
+    """
+    referenceResults = dict((r['name'], r) for r in reference['results'])
+    if reference['metadata']['params'] != results['metadata']['params']:
+        warnings.warn('The benchmark parameters differ from those of the reference results.')
+    return [formatResult(r, referenceResults.get(r['name'])) for r in results['results']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the MAF hot paths on synthetic opsim data.')
+    parser.add_argument('--nvisits', type=int, default=100000, help='Number of synthetic visits.')
+    parser.add_argument('--nside', type=int, default=64, help='Nside of the healpix slicers.')
+    parser.add_argument('--nobj', type=int, default=1000, help='Number of synthetic moving objects.')
+    parser.add_argument('--nobsPerObj', type=int, default=50,
+                        help='Number of observations of each moving object.')
+    parser.add_argument('--nmetrics', type=int, default=500, help='Number of metrics written to resultsDb.')
+    parser.add_argument('--nProcs', type=int, default=1, help='Number of processes for runAll and plotAll.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each benchmark.')
+    parser.add_argument('--noMemory', dest='memory', action='store_false',
+                        help='Do not measure the peak memory of each benchmark.')
+    parser.add_argument('--benchmarks', nargs='+', default=None, choices=benchmarkNames,
+                        help='The benchmarks to run (default all).')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the synthetic data.')
+    parser.add_argument('--output', type=str, default=None, help='Write the results to this json file.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare the results to those in this json file (from another version).')
+    args = parser.parse_args()
+
+    results = runBenchmarks(nvisits=args.nvisits, nside=args.nside, nobj=args.nobj,
+                            nobsPerObj=args.nobsPerObj, nmetrics=args.nmetrics, nProcs=args.nProcs,
+                            repeat=args.repeat, memory=args.memory, benchmarks=args.benchmarks,
+                            seed=args.seed, verbose=args.compare is None)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print('\n'.join(compareResults(results, json.load(f))))
+    sys.exit(1 if any('error' in r for r in results['results']) else 0)
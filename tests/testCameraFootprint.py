@@ -0,0 +1,113 @@
+from builtins import zip
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import unittest
+import lsst.sims.maf.slicers as slicers
+import lsst.utils.tests
+
+
+def makeFootprint(nside=3, chipSize=0.4, gap=0.05):
+    """Make a square grid of square chips (sizes in degrees), plus a wavefront sensor."""
+    chipNames = []
+    corners = []
+    step = chipSize + gap
+    for i in range(nside):
+        for j in range(nside):
+            x0 = (i - (nside - 1) / 2.) * step - chipSize / 2.
+            y0 = (j - (nside - 1) / 2.) * step - chipSize / 2.
+            chipNames.append('R:2,2 S:%d,%d' % (i, j))
+            corners.append([[x0, y0], [x0, y0 + chipSize], [x0 + chipSize, y0 + chipSize],
+                            [x0 + chipSize, y0]])
+    return slicers.CameraFootprint(chipNames, np.radians(corners))
+
+
+def makeSimData(nvisits=300, random=63):
+    names = ['fieldRA', 'fieldDec', 'rotSkyPos', 'observationStartMJD']
+    types = [float, float, float, float]
+    rng = np.random.RandomState(random)
+    simData = np.zeros(nvisits, dtype=list(zip(names, types)))
+    simData['fieldRA'] = 10. + rng.rand(nvisits) * 10.
+    simData['fieldDec'] = -30. + rng.rand(nvisits) * 10.
+    simData['rotSkyPos'] = rng.rand(nvisits) * 2. * np.pi
+    simData['observationStartMJD'] = 59853. + np.arange(nvisits)
+    return simData
+
+
+class TestCameraFootprint(unittest.TestCase):
+
+    def setUp(self):
+        self.footprint = makeFootprint()
+
+    def testChipIndex(self):
+        """Test points are assigned to the chip they fall in, or -1 in the gaps."""
+        rng = np.random.RandomState(42)
+        x = np.radians(rng.rand(5000) * 1.6 - 0.8)
+        y = np.radians(rng.rand(5000) * 1.6 - 0.8)
+        chips = self.footprint.chipIndex(x, y)
+        expected = np.zeros(len(x), dtype=int) - 1
+        for i, corners in enumerate(self.footprint.corners):
+            inside = ((x >= corners[:, 0].min()) & (x <= corners[:, 0].max()) &
+                      (y >= corners[:, 1].min()) & (y <= corners[:, 1].max()))
+            expected[inside] = i
+        np.testing.assert_array_equal(chips, expected)
+        self.assertTrue((chips == -1).sum() > 0)
+
+    def testRotation(self):
+        """Test rotSkyPos rotates the focal plane on the sky."""
+        dec = np.radians(0.45)
+        x, y = self.footprint.focalPlaneXY(0., dec, 0., 0., 0.)
+        self.assertEqual(self.footprint.chipNames[self.footprint.chipIndex([x], [y])[0]], 'R:2,2 S:1,2')
+        x, y = self.footprint.focalPlaneXY(0., dec, 0., 0., np.pi / 2.)
+        self.assertEqual(self.footprint.chipNames[self.footprint.chipIndex([x], [y])[0]], 'R:2,2 S:2,1')
+
+    def _setupSlicer(self, simData, nProcs=1, chipNames='all'):
+        slicer = slicers.HealpixSlicer(nside=64, verbose=False, useCamera=True, radius=1.,
+                                       nProcs=nProcs, chipNames=chipNames)
+        # Use the synthetic footprint in place of the LSST camera.
+        slicer._setupLSSTCamera = lambda: None
+        slicer.footprint = self.footprint
+        slicer.setupSlicer(simData)
+        return slicer
+
+    def testPreslice(self):
+        """Test the camera lookup matches checking each visit separately."""
+        simData = makeSimData()
+        slicer = self._setupSlicer(simData)
+        ra = np.radians(simData['fieldRA'])
+        dec = np.radians(simData['fieldDec'])
+        expected = [[] for i in range(slicer.nslice)]
+        expectedChips = [[] for i in range(slicer.nslice)]
+        cosRad = np.cos(np.radians(slicer.radius))
+        for i in range(len(simData)):
+            cosDist = (np.sin(dec[i]) * np.sin(slicer.slicePoints['dec']) + np.cos(dec[i]) *
+                       np.cos(slicer.slicePoints['dec']) * np.cos(slicer.slicePoints['ra'] - ra[i]))
+            near = np.where(cosDist > cosRad)[0]
+            x, y = self.footprint.focalPlaneXY(slicer.slicePoints['ra'][near], slicer.slicePoints['dec'][near],
+                                               ra[i], dec[i], simData['rotSkyPos'][i])
+            chips = self.footprint.chipIndex(x, y)
+            for hp, chip in zip(near[chips >= 0], chips[chips >= 0]):
+                expected[hp].append(i)
+                expectedChips[hp].append(self.footprint.chipNames[chip])
+        self.assertTrue(sum(len(e) for e in expected) > 0)
+        for i, s in enumerate(slicer):
+            np.testing.assert_array_equal(s['idxs'], expected[i])
+            np.testing.assert_array_equal(s['slicePoint']['chipNames'], expectedChips[i])
+            np.testing.assert_array_equal(slicer.sliceLookup[i], expected[i])
+        # Running the visits in several processes should give the same lookup.
+        parallel = self._setupSlicer(simData, nProcs=3)
+        for a, b in zip(slicer.sliceLookup, parallel.sliceLookup):
+            np.testing.assert_array_equal(a, b)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -1,7 +1,11 @@
 import matplotlib
 matplotlib.use("Agg")
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+import numpy as np
 import lsst.sims.maf.db as db
 import lsst.utils.tests
 from lsst.sims.utils.CodeUtilities import sims_clean_up
@@ -49,6 +53,35 @@ class TestDb(unittest.TestCase):
         self.assertRaises(IOError, db.Database, 'thisdatabasedoesntexist_sqlite.db')
 
 
+class TestDatabaseChunks(unittest.TestCase):
+
+    def testQueryColumnsChunks(self):
+        """Test that fetching the results in chunks gives the same data as fetching them all at once."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            dbFile = os.path.join(tmpDir, 'chunks.db')
+            conn = sqlite3.connect(dbFile)
+            conn.execute('create table visits (obsId INTEGER, night INTEGER, airmass REAL, filter TEXT)')
+            rng = np.random.RandomState(1)
+            rows = [(i, i // 10, 1. + rng.rand(), 'ugrizy'[i % 6]) for i in range(95)]
+            conn.executemany('insert into visits values (?, ?, ?, ?)', rows)
+            conn.commit()
+            conn.close()
+            basedb = db.Database(database=dbFile, driver='sqlite')
+            cols = ['obsId', 'night', 'airmass', 'filter']
+            for kwargs in ({}, {'sqlconstraint': 'filter = "r"'}, {'sqlconstraint': 'night > 100'},
+                           {'groupBy': 'night'}, {'numLimit': 12}):
+                allAtOnce = basedb.query_columns('visits', colnames=cols, chunksize=0, **kwargs)
+                for chunksize in (7, 95, 1000):
+                    chunked = basedb.query_columns('visits', colnames=cols, chunksize=chunksize, **kwargs)
+                    self.assertEqual(chunked.dtype, allAtOnce.dtype)
+                    np.testing.assert_array_equal(chunked, allAtOnce)
+            self.assertEqual(len(basedb.query_columns('visits', colnames=cols, chunksize=7)), 95)
+            basedb.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
+
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
 
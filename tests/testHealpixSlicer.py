@@ -5,8 +5,13 @@ import numpy as np
 import numpy.lib.recfunctions as rfn
 import numpy.ma as ma
 import unittest
+import os
+import glob
+import shutil
+import tempfile
 import healpy as hp
 from lsst.sims.maf.slicers.healpixSlicer import HealpixSlicer
+from lsst.sims.maf.slicers.healpixSubsetSlicer import HealpixSubsetSlicer
 import lsst.utils.tests
 
 
@@ -190,6 +195,54 @@ class TestHealpixSlicerSlicing(unittest.TestCase):
                 sidxs = np.sort(sidxs)
                 np.testing.assert_equal(self.dv['testdata'][didxs], self.dv['testdata'][sidxs])
 
+    def testBatchSize(self):
+        """Test that slicing in batches of slicePoints does not depend on the batch size."""
+        self.testslicer.setupSlicer(self.dv)
+        offsets, indices = self.testslicer.sliceIndexBatch(0, self.testslicer.nslice)
+        self.assertEqual(len(offsets), self.testslicer.nslice + 1)
+        for batchSize in [1, 7, 1000]:
+            testslicer = HealpixSlicer(nside=self.nside, verbose=False,
+                                       lonCol='ra', latCol='dec', latLonDeg=False,
+                                       radius=self.radius, batchSize=batchSize)
+            testslicer.setupSlicer(self.dv)
+            for i, s in enumerate(testslicer):
+                np.testing.assert_equal(s['idxs'], indices[offsets[i]:offsets[i+1]])
+
+    def testCanSliceBatch(self):
+        """Test that sliceIndexBatch is only used by slicers which use the base slicing."""
+        self.assertTrue(self.testslicer.canSliceBatch())
+        subsetslicer = HealpixSubsetSlicer(nside=self.nside, hpid=np.arange(10), verbose=False,
+                                           lonCol='ra', latCol='dec', latLonDeg=False, radius=self.radius)
+        self.assertFalse(subsetslicer.canSliceBatch())
+        subsetslicer.setupSlicer(self.dv)
+        self.assertRaises(NotImplementedError, subsetslicer.sliceIndexBatch, 0, 10)
+
+    def testLookupCache(self):
+        """Test that the slicePoint lookup is saved to disk and reused for the same data."""
+        cacheDir = tempfile.mkdtemp(prefix='TLC')
+        try:
+            self.testslicer.setupSlicer(self.dv)
+            expected = [s['idxs'] for s in self.testslicer]
+            slicer1 = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                    latLonDeg=False, radius=self.radius, lookupCacheDir=cacheDir)
+            slicer1.setupSlicer(self.dv)
+            self.assertEqual(len(glob.glob(os.path.join(cacheDir, '*.npz'))), 1)
+            slicer2 = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                    latLonDeg=False, radius=self.radius, lookupCacheDir=cacheDir)
+            slicer2.setupSlicer(self.dv)
+            # The second slicer should have read the lookup, rather than building its own tree.
+            self.assertFalse(hasattr(slicer2, 'opsimtree'))
+            for slicer in (slicer1, slicer2):
+                for i, s in enumerate(slicer):
+                    np.testing.assert_equal(s['idxs'], expected[i])
+            # A different radius should not reuse the same lookup.
+            slicer3 = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                    latLonDeg=False, radius=self.radius / 2., lookupCacheDir=cacheDir)
+            slicer3.setupSlicer(self.dv)
+            self.assertEqual(len(glob.glob(os.path.join(cacheDir, '*.npz'))), 2)
+        finally:
+            shutil.rmtree(cacheDir)
+
 
 class TestHealpixChipGap(unittest.TestCase):
     # Note that this is really testing baseSpatialSlicer, as slicing is done there for healpix grid
@@ -0,0 +1,89 @@
+import matplotlib
+matplotlib.use("Agg")
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import lsst.utils.tests
+import mafBenchmarks
+
+
+class TestMafBenchmarks(unittest.TestCase):
+
+    def testMakeSimData(self):
+        """Test the synthetic visits are reproducible and have sensible values."""
+        simData = mafBenchmarks.makeSimData(nvisits=20000, seed=3)
+        np.testing.assert_array_equal(simData, mafBenchmarks.makeSimData(nvisits=20000, seed=3))
+        other = mafBenchmarks.makeSimData(nvisits=20000, seed=4)
+        self.assertFalse(np.array_equal(simData['fieldRA'], other['fieldRA']))
+        self.assertTrue(np.all(np.diff(simData['observationStartMJD']) > -1))
+        self.assertTrue(np.all(simData['fieldDec'] <= 10.))
+        # The visits are close to the meridian, so mostly at low airmass.
+        self.assertGreater(np.median(simData['altitude']), 50.)
+        self.assertTrue(np.all(simData['airmass'] >= 1.))
+        fractions = [np.mean(simData['filter'] == f) for f in mafBenchmarks.filterNames]
+        np.testing.assert_allclose(fractions, mafBenchmarks.filterFractions, atol=0.01)
+        # Each field is always at the same position.
+        for fieldId in simData['fieldId'][:20]:
+            match = simData['fieldId'] == fieldId
+            self.assertEqual(len(np.unique(simData['fieldRA'][match])), 1)
+
+    def testRunBenchmarks(self):
+        """Test running (small versions of) the benchmarks, and writing and comparing their results."""
+        # The stackers are left out (some need the full LSST stack), and the (slow) plotting benchmarks
+        #  are only run once.
+        benchmarks = [b for b in mafBenchmarks.benchmarkNames if b != 'stackers' and not b.startswith('plot')]
+        results = mafBenchmarks.runBenchmarks(nvisits=2000, nside=8, nobj=10, nobsPerObj=10, nmetrics=10,
+                                              repeat=2, benchmarks=benchmarks)
+        self.assertEqual([r['name'] for r in results['results']], benchmarks)
+        for result in results['results']:
+            self.assertNotIn('error', result)
+            self.assertEqual(len(result['times']), 2)
+            self.assertEqual(result['best'], min(result['times']))
+            self.assertGreaterEqual(result['peakMemoryMB'], 0)
+        plotResults = mafBenchmarks.runBenchmarks(nvisits=2000, nside=8, repeat=1, memory=False,
+                                                  benchmarks=['plotAll', 'plotAllUnchanged'])
+        for result in plotResults['results']:
+            self.assertNotIn('error', result)
+            self.assertEqual(result['params']['nplots'], 12)
+        # Skipping the unchanged plots is faster than making them.
+        self.assertLess(plotResults['results'][1]['best'], plotResults['results'][0]['best'])
+        self.assertEqual(results['metadata']['params']['nvisits'], 2000)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            outfile = os.path.join(tmpDir, 'results.json')
+            with open(outfile, 'w') as f:
+                json.dump(results, f)
+            with open(outfile) as f:
+                reference = json.load(f)
+        finally:
+            shutil.rmtree(tmpDir)
+        lines = mafBenchmarks.compareResults(results, reference)
+        self.assertEqual(len(lines), len(benchmarks))
+        self.assertTrue(all(line.endswith('x1.00') for line in lines))
+        with self.assertRaises(ValueError):
+            mafBenchmarks.runBenchmarks(benchmarks=['noSuchBenchmark'])
+
+    def testTimeBenchmark(self):
+        """Test a failing benchmark records its error."""
+        result = mafBenchmarks.timeBenchmark('fail', lambda: None, lambda state: 1 / 0, params={'a': 1})
+        self.assertEqual(result['params'], {'a': 1})
+        self.assertTrue(result['error'].startswith('ZeroDivisionError'))
+        result = mafBenchmarks.timeBenchmark('sum', lambda: np.arange(1000), np.sum, repeat=4, memory=False)
+        self.assertEqual(len(result['times']), 4)
+        self.assertNotIn('peakMemoryMB', result)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
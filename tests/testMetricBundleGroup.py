@@ -0,0 +1,382 @@
+from builtins import zip
+import matplotlib
+matplotlib.use("Agg")
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+import unittest
+import lsst.sims.maf.db as db
+import lsst.sims.maf.metrics as metrics
+import lsst.sims.maf.slicers as slicers
+import lsst.sims.maf.metricBundles as metricBundles
+import lsst.sims.maf.stackers as stackers
+import lsst.utils.tests
+
+
+def makeSimData(nvisits=5000, random=442):
+    """Generate a set of visits scattered over the southern sky."""
+    names = ['night', 'fieldRA', 'fieldDec', 'fiveSigmaDepth', 'airmass', 'observationStartMJD']
+    types = [int, float, float, float, float, float]
+    rng = np.random.RandomState(random)
+    simData = np.zeros(nvisits, dtype=list(zip(names, types)))
+    simData['night'] = rng.randint(0, 3650, nvisits)
+    simData['fieldRA'] = rng.rand(nvisits) * 360.
+    simData['fieldDec'] = np.degrees(np.arcsin(rng.rand(nvisits) - 1.))
+    simData['fiveSigmaDepth'] = rng.normal(24., 0.5, nvisits)
+    simData['airmass'] = 1. + rng.rand(nvisits)
+    simData['observationStartMJD'] = 59853. + simData['night'] + rng.rand(nvisits)
+    return simData
+
+
+# Record each time the ScaleStacker actually runs.
+stackerRuns = []
+
+
+class ScaleStacker(stackers.BaseStacker):
+    """Add a scaled copy of the airmass column."""
+    colsAdded = ['scaledAirmass']
+
+    def __init__(self, scale=1.):
+        self.colsReq = ['airmass']
+        self.units = [None]
+        self.scale = scale
+
+    def _run(self, simData, cols_present=False):
+        stackerRuns.append(self.scale)
+        simData['scaledAirmass'] = simData['airmass'] * self.scale
+        return simData
+
+
+class TestMetricBundleGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.simData = makeSimData()
+
+    def _makeBundles(self, useCache=True, nside=8):
+        bundleList = []
+        metricList = [metrics.CountMetric(col='night'), metrics.MeanMetric(col='airmass'),
+                      metrics.Coaddm5Metric(), metrics.PassMetric(cols=['night'])]
+        for metric in metricList:
+            slicer = slicers.HealpixSlicer(nside=nside, verbose=False, useCache=useCache)
+            bundle = metricBundles.MetricBundle(metric, slicer, '')
+            bundle.stackerList = []
+            bundleList.append(bundle)
+        return bundleList
+
+    def _runBundles(self, bundleList, nProcs, cacheSize=None, batchSize=10000):
+        bd = metricBundles.makeBundlesDictFromList(bundleList)
+        mbg = metricBundles.MetricBundleGroup(bd, None, saveEarly=False, verbose=False, nProcs=nProcs,
+                                              cacheSize=cacheSize, batchSize=batchSize)
+        mbg.setCurrent('')
+        mbg.runCurrent('', simData=self.simData)
+        return mbg
+
+    def _assertSameValues(self, bundlesA, bundlesB):
+        for ba, bb in zip(bundlesA, bundlesB):
+            np.testing.assert_array_equal(ba.metricValues.mask, bb.metricValues.mask)
+            if ba.metricValues.dtype.name == 'object':
+                for va, vb, m in zip(ba.metricValues.data, bb.metricValues.data, ba.metricValues.mask):
+                    if not m:
+                        np.testing.assert_array_equal(va, vb)
+            else:
+                np.testing.assert_array_equal(ba.metricValues.compressed(), bb.metricValues.compressed())
+
+    def testParallelMatchesSerial(self):
+        """Test that running the slicePoints in multiple processes gives identical metric values."""
+        for useCache in (True, False):
+            serial = self._makeBundles(useCache=useCache)
+            self._runBundles(serial, nProcs=1)
+            parallel = self._makeBundles(useCache=useCache)
+            self._runBundles(parallel, nProcs=3)
+            self._assertSameValues(serial, parallel)
+
+    def testResultCache(self):
+        """Test that reusing cached metric results gives the same metric values."""
+        # Repeat visits on a small set of fields, so that neighboring healpixels see the same visits.
+        rng = np.random.RandomState(8)
+        fields = rng.randint(0, 40, len(self.simData))
+        self.simData['fieldRA'] = (rng.rand(40) * 360.)[fields]
+        self.simData['fieldDec'] = np.degrees(np.arcsin(rng.rand(40) - 1.))[fields]
+        uncached = self._makeBundles(useCache=False, nside=32)
+        mbg = self._runBundles(uncached, nProcs=1)
+        self.assertEqual(mbg.cacheHits + mbg.cacheMisses, 0)
+        cached = self._makeBundles(useCache=True, nside=32)
+        mbg = self._runBundles(cached, nProcs=1)
+        self.assertTrue(mbg.cacheHits > 0)
+        self._assertSameValues(uncached, cached)
+        # The cacheSize of the group applies to any slicer, including a very small cache.
+        cached = self._makeBundles(useCache=False, nside=32)
+        mbg = self._runBundles(cached, nProcs=1, cacheSize=2)
+        self.assertTrue(mbg.cacheHits > 0)
+        self._assertSameValues(uncached, cached)
+
+    def testRunAllSharedQuery(self):
+        """Test that runAll queries the database once for translatable constraints,
+        with the same results as querying for each constraint."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            dbFile = os.path.join(tmpDir, 'test.db')
+            conn = sqlite3.connect(dbFile)
+            conn.execute('create table observations (night int, fieldRA real, fieldDec real, '
+                         'fiveSigmaDepth real, airmass real, observationStartMJD real, filter text)')
+            filters = np.array(list('ugrizy'))[np.arange(len(self.simData)) % 6]
+            conn.executemany('insert into observations values (?, ?, ?, ?, ?, ?, ?)',
+                             [tuple(row) + (f,) for row, f in zip(self.simData.tolist(), filters)])
+            conn.commit()
+            conn.close()
+            constraints = ["filter = 'r'", "filter = 'g' and night < 1000", "night like '1%'", '']
+
+            def makeBundles():
+                bundleList = []
+                for i, constraint in enumerate(constraints):
+                    slicer = slicers.HealpixSlicer(nside=8, verbose=False)
+                    bundle = metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'), slicer,
+                                                        constraint, metadata='c%d' % i)
+                    bundle.stackerList = []
+                    bundleList.append(bundle)
+                return bundleList
+
+            results = {}
+            queries = {}
+            for shared in (True, False):
+                database = db.Database(dbFile, defaultTable='observations')
+                queries[shared] = []
+
+                def fetchMetricData(colnames, sqlconstraint=None, groupBy=None, tableName=None,
+                                    _fetch=database.fetchMetricData, _queries=queries[shared]):
+                    _queries.append(sqlconstraint)
+                    return _fetch(colnames, sqlconstraint, groupBy=groupBy, tableName=tableName)
+                database.fetchMetricData = fetchMetricData
+                bundleList = makeBundles()
+                mbg = metricBundles.MetricBundleGroup(bundleList, database, outDir=tmpDir,
+                                                      saveEarly=False, verbose=False)
+                if shared:
+                    mbg.runAll()
+                else:
+                    for constraint in mbg.constraints:
+                        mbg.runCurrent(constraint)
+                results[shared] = bundleList
+                database.close()
+            # One shared query, plus the untranslatable LIKE constraint.
+            self.assertEqual(len(queries[True]), 2)
+            self.assertIn("night like '1%'", queries[True])
+            self.assertEqual(len(queries[False]), len(constraints))
+            self._assertSameValues(results[True], results[False])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testRunAllSharedQueryProposals(self):
+        """Test the shared query keeps the visits of each proposal, when the visits are grouped by MJD."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            dbFile = os.path.join(tmpDir, 'opsim.db')
+            conn = sqlite3.connect(dbFile)
+            conn.execute('create table SummaryAllProps (observationId int, night int, fieldRA real, '
+                         'fieldDec real, fiveSigmaDepth real, airmass real, observationStartMJD real, '
+                         'filter text, proposalId int)')
+            # Every visit counts towards proposal 1 or 2, and every third visit counts towards both.
+            rows = []
+            filters = np.array(list('ugrizy'))[np.arange(len(self.simData)) % 6]
+            for i, (row, f) in enumerate(zip(self.simData.tolist(), filters)):
+                proposals = [1, 2] if i % 3 == 0 else [i % 3]
+                for proposalId in proposals:
+                    rows.append((i,) + tuple(row) + (f, proposalId))
+            conn.executemany('insert into SummaryAllProps values (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+            conn.close()
+            constraints = ['proposalId = 1', 'proposalId = 2', "filter = 'r'"]
+            results = {}
+            for shared in (True, False):
+                database = db.OpsimDatabaseV4(dbFile)
+                bundleList = []
+                for i, constraint in enumerate(constraints):
+                    slicer = slicers.UniSlicer()
+                    bundle = metricBundles.MetricBundle(metrics.CountMetric(col='observationStartMJD'),
+                                                        slicer, constraint, metadata='c%d' % i)
+                    bundle.stackerList = []
+                    bundleList.append(bundle)
+                mbg = metricBundles.MetricBundleGroup(bundleList, database, outDir=tmpDir,
+                                                      saveEarly=False, verbose=False)
+                if shared:
+                    sharedData, masks, groupBy = mbg._getSharedData()
+                    self.assertEqual(groupBy, 'observationStartMJD')
+                    self.assertEqual(len(masks), len(constraints))
+                    mbg.runAll()
+                else:
+                    for constraint in mbg.constraints:
+                        mbg.runCurrent(constraint)
+                results[shared] = bundleList
+                database.close()
+            self._assertSameValues(results[True], results[False])
+            nvisits = len(self.simData)
+            counts = [b.metricValues[0] for b in results[True]]
+            self.assertEqual(counts, [len(range(0, nvisits, 3)) + len(range(1, nvisits, 3)),
+                                      len(range(0, nvisits, 3)) + len(range(2, nvisits, 3)),
+                                      len(range(2, nvisits, 6))])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testRunBatch(self):
+        """Test that metrics calculated with runBatch match running them at each slicePoint."""
+        # Use a small area (so there are empty slicePoints) and repeat some values (for the medians).
+        self.simData['fieldDec'] = -70. + self.simData['fieldDec'] / 10.
+        self.simData['airmass'][::3] = self.simData['airmass'][1::3][:len(self.simData[::3])]
+
+        def makeBundles():
+            metricList = [metrics.CountMetric(col='night'), metrics.MeanMetric(col='airmass'),
+                          metrics.MedianMetric(col='airmass'), metrics.Coaddm5Metric(),
+                          metrics.MinMetric(col='airmass'), metrics.MaxMetric(col='airmass'),
+                          metrics.SumMetric(col='airmass'),
+                          metrics.FracAboveMetric(col='airmass', cutoff=1.5),
+                          metrics.FracBelowMetric(col='airmass', cutoff=1.5, scale=100),
+                          metrics.PercentileMetric(col='airmass', percentile=20),
+                          metrics.PercentileMetric(col='night', percentile=75),
+                          metrics.RmsMetric(col='airmass')]
+            return [metricBundles.MetricBundle(metric, slicers.HealpixSlicer(nside=16, verbose=False), '')
+                    for metric in metricList]
+        perSlice = makeBundles()
+        self._runBundles(perSlice, nProcs=1, batchSize=0)
+        self.assertTrue(perSlice[0].metricValues.mask.sum() > 0)
+        for batchSize in (7, 10000):
+            batch = makeBundles()
+            self._runBundles(batch, nProcs=1, batchSize=batchSize)
+            for bp, bb in zip(perSlice, batch):
+                np.testing.assert_array_equal(bp.metricValues.mask, bb.metricValues.mask)
+                np.testing.assert_allclose(bp.metricValues.compressed(), bb.metricValues.compressed(),
+                                           rtol=1e-12)
+        # Only the metrics which implement runBatch themselves are calculated in batches.
+        self.assertTrue(metrics.MedianMetric(col='airmass').canRunBatch())
+        self.assertFalse(metrics.RmsMetric(col='airmass').canRunBatch())
+
+    def testRunBatchSubsetSlicer(self):
+        """Test runBatch with a slicer which selects its own visits (not using the slicer's batch index)."""
+        self.simData['fieldDec'] = -70. + self.simData['fieldDec'] / 10.
+        hpid = np.arange(0, 3072, 5)
+
+        def makeBundles():
+            metricList = [metrics.CountMetric(col='night'), metrics.MedianMetric(col='airmass')]
+            return [metricBundles.MetricBundle(metric, slicers.HealpixSubsetSlicer(nside=16, hpid=hpid,
+                                                                                   verbose=False), '')
+                    for metric in metricList]
+        perSlice = makeBundles()
+        self._runBundles(perSlice, nProcs=1, batchSize=0)
+        batch = makeBundles()
+        self._runBundles(batch, nProcs=1)
+        for bp, bb in zip(perSlice, batch):
+            self.assertGreater((~bp.metricValues.mask).sum(), 0)
+            self.assertLess((~bp.metricValues.mask).sum(), len(hpid))
+            np.testing.assert_array_equal(bp.metricValues.mask, bb.metricValues.mask)
+            np.testing.assert_allclose(bp.metricValues.compressed(), bb.metricValues.compressed(), rtol=1e-12)
+
+    def testRunBatchNan(self):
+        """Test that runBatch medians and percentiles are nan where the values include nan, as run."""
+        self.simData['fieldDec'] = -70. + self.simData['fieldDec'] / 10.
+        self.simData['airmass'][::50] = np.nan
+
+        def makeBundles():
+            metricList = [metrics.MedianMetric(col='airmass'),
+                          metrics.PercentileMetric(col='airmass', percentile=20)]
+            return [metricBundles.MetricBundle(metric, slicers.HealpixSlicer(nside=16, verbose=False), '')
+                    for metric in metricList]
+        perSlice = makeBundles()
+        self._runBundles(perSlice, nProcs=1, batchSize=0)
+        batch = makeBundles()
+        self._runBundles(batch, nProcs=1, batchSize=10000)
+        for bp, bb in zip(perSlice, batch):
+            values = bp.metricValues.compressed()
+            self.assertTrue(np.isnan(values).any())
+            self.assertFalse(np.isnan(values).all())
+            np.testing.assert_array_equal(bp.metricValues.mask, bb.metricValues.mask)
+            np.testing.assert_allclose(values, bb.metricValues.compressed(), rtol=1e-12)
+
+    def testStackerCache(self):
+        """Test that stackers run once per configuration, and later compatible groups reuse their columns."""
+        del stackerRuns[:]
+        bundleList = []
+        for nside, scale in ((8, 1.), (8, 2.), (4, 1.), (4, 2.)):
+            slicer = slicers.HealpixSlicer(nside=nside, verbose=False)
+            bundle = metricBundles.MetricBundle(metrics.MeanMetric(col='scaledAirmass'), slicer, '',
+                                                stackerList=[ScaleStacker(scale=scale)],
+                                                metadata='%d %.0f' % (nside, scale))
+            bundleList.append(bundle)
+        self._runBundles(bundleList, nProcs=1)
+        self.assertEqual(sorted(stackerRuns), [1., 2.])
+        for single, double in (bundleList[0:2], bundleList[2:4]):
+            np.testing.assert_allclose(double.metricValues.compressed(), single.metricValues.compressed() * 2.)
+
+
+    def _plotBundles(self, outDir, nProcs, airmassScale=1.):
+        bundleList = self._makeBundles()[:3]
+        simData = self.simData.copy()
+        simData['airmass'] *= airmassScale
+        bd = metricBundles.makeBundlesDictFromList(bundleList)
+        resultsDb = db.ResultsDb(outDir=outDir)
+        mbg = metricBundles.MetricBundleGroup(bd, None, outDir=outDir, resultsDb=resultsDb, saveEarly=False,
+                                              verbose=False)
+        mbg.setCurrent('')
+        mbg.runCurrent('', simData=simData)
+        mbg.plotCurrent(figformat='png', dpi=30, nProcs=nProcs)
+        plots = {}
+        for plot in resultsDb.session.query(db.resultsDb.PlotRow):
+            self.assertIsNotNone(plot.plotFingerprint)
+            self.assertGreater(plot.renderTime, 0)
+            plots[plot.plotFile] = (plot.plotFingerprint, os.path.getmtime(os.path.join(outDir, plot.plotFile)))
+        resultsDb.close()
+        return plots
+
+    def testPlotCurrent(self):
+        """Test plotting in parallel, and skipping unchanged plots."""
+        tmpDir = tempfile.mkdtemp(prefix='TMBGplot')
+        try:
+            serialDir = os.path.join(tmpDir, 'serial')
+            serial = self._plotBundles(serialDir, nProcs=1)
+            # Each bundle makes a skymap, histogram and power spectrum.
+            self.assertEqual(len(serial), 9)
+            parallel = self._plotBundles(os.path.join(tmpDir, 'parallel'), nProcs=3)
+            self.assertEqual(sorted(parallel.keys()), sorted(serial.keys()))
+            for plotFile in serial:
+                self.assertEqual(parallel[plotFile][0], serial[plotFile][0])
+            # Plotting again does not remake any plots.
+            again = self._plotBundles(os.path.join(tmpDir, 'parallel'), nProcs=3)
+            self.assertEqual(again, parallel)
+            # Only the plots of the metric values which change are remade.
+            changed = self._plotBundles(serialDir, nProcs=1, airmassScale=1.1)
+            for plotFile in serial:
+                self.assertEqual(changed[plotFile] != serial[plotFile], 'airmass' in plotFile)
+        finally:
+            shutil.rmtree(tmpDir)
+
+class TestMetricResultCache(unittest.TestCase):
+
+    def testFingerprint(self):
+        fingerprint = metricBundles.MetricResultCache.fingerprint
+        self.assertEqual(fingerprint([3, 1, 2]), fingerprint(np.array([1, 2, 3])))
+        self.assertNotEqual(fingerprint([1, 2, 3]), fingerprint([1, 2, 4]))
+        self.assertNotEqual(fingerprint([1, 2]), fingerprint([1, 2, 2]))
+
+    def testEviction(self):
+        cache = metricBundles.MetricResultCache(2)
+        cache.put('a', 0)
+        cache.put('b', 1)
+        # Using 'a' makes 'b' the least recently used entry.
+        self.assertEqual(cache.get('a'), 0)
+        cache.put('c', 2)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
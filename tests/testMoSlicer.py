@@ -0,0 +1,210 @@
+import matplotlib
+matplotlib.use("Agg")
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import lsst.sims.maf.slicers as slicers
+import lsst.sims.maf.metrics as metrics
+import lsst.sims.maf.stackers as stackers
+import lsst.sims.maf.metricBundles as mmb
+import lsst.utils.tests
+
+
+def writeFiles(outDir, nobj=6, nobs=200, random=81):
+    """Write a small orbit file and an (unsorted) observation file.
+
+    The last object has no observations.
+    """
+    rng = np.random.RandomState(random)
+    orbitFile = os.path.join(outDir, 'orbits.txt')
+    with open(orbitFile, 'w') as f:
+        f.write('objId q e inc Omega argPeri tPeri epoch H g sed_filename\n')
+        for i in range(nobj):
+            f.write('%d %f %f %f %f %f %f %f %f %f %s\n'
+                    % (i + 10, 1. + rng.rand(), rng.rand() * 0.5, rng.rand() * 20., rng.rand() * 360.,
+                       rng.rand() * 360., 59580. + rng.rand() * 1000., 59580., 18. + rng.rand() * 4., 0.15,
+                       'C.dat'))
+    obsFile = os.path.join(outDir, 'obs.txt')
+    objIds = rng.randint(0, nobj - 1, nobs) + 10
+    with open(obsFile, 'w') as f:
+        f.write('objId observationStartMJD night ra dec dradt ddecdt velocity geo_dist solarElong '
+                'magV dmagColor dmagDetect fiveSigmaDepth\n')
+        for i in range(nobs):
+            # Four visits per night, 30 minutes apart.
+            f.write('%d %f %d %f %f %f %f %f %f %f %f %f %f %f\n'
+                    % (objIds[i], 59580. + i // 4 + (i % 4) * 0.02, i // 4 + 1,
+                       rng.rand() * 360., rng.rand() * 90. - 90., rng.rand(), rng.rand(), rng.rand(),
+                       rng.rand() * 2, rng.rand() * 180., 20. + rng.rand() * 4., rng.rand() * 0.2,
+                       rng.rand() * 0.1, 23. + rng.rand()))
+    return orbitFile, obsFile
+
+
+class TestMoObjSlicer(unittest.TestCase):
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.orbitFile, self.obsFile = writeFiles(self.outDir)
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def _checkSlices(self, slicer):
+        nobs = 0
+        for i, ssoObs in enumerate(slicer):
+            objId = slicer.orbits['objId'].iloc[i]
+            expected = slicer.obs.query('objId == %d' % (objId)).to_records()
+            self.assertEqual(ssoObs['obs'].dtype, expected.dtype)
+            np.testing.assert_array_equal(ssoObs['obs'], expected)
+            self.assertEqual(ssoObs['orbit']['objId'], objId)
+            nobs += len(ssoObs['obs'])
+        self.assertEqual(nobs, len(slicer.obs))
+        # The last object has no observations.
+        self.assertEqual(len(slicer[slicer.nSso - 1]['obs']), 0)
+
+    def testSliceObs(self):
+        """Test the observations of each object match selecting them from the observation dataframe."""
+        slicer = slicers.MoObjSlicer(Hrange=np.arange(15, 20, 0.5), verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=self.obsFile)
+        self.assertEqual(slicer.nSso, 6)
+        self._checkSlices(slicer)
+        np.testing.assert_array_equal(slicer[0]['Hvals'], np.arange(15, 20, 0.5))
+        # And after choosing a subset of the observations.
+        slicer.subsetObs('observationStartMJD < 59605')
+        self.assertEqual(len(slicer.obs), 100)
+        self._checkSlices(slicer)
+
+    def _groupedObsFile(self):
+        """Rewrite the observation file with the observations grouped by object."""
+        with open(self.obsFile) as f:
+            lines = f.readlines()
+        groupedFile = os.path.join(self.outDir, 'obs_grouped.txt')
+        with open(groupedFile, 'w') as f:
+            f.write(lines[0])
+            f.writelines(sorted(lines[1:], key=lambda line: int(line.split()[0])))
+        return groupedFile
+
+    def testSliceObsCopy(self):
+        """Test that modifying the observations of an object does not change the slicer's observations."""
+        slicer = slicers.MoObjSlicer(verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=self.obsFile)
+        ssoObs = slicer[0]['obs']
+        magV = ssoObs['magV'].copy()
+        ssoObs['magV'] += 1.
+        np.testing.assert_array_equal(slicer[0]['obs']['magV'], magV)
+
+    def testReadObsChunks(self):
+        """Test reading the observations in chunks of whole objects, from text or binary files."""
+        # The observations of each object must be in one block of the file.
+        with self.assertRaises(ValueError):
+            list(slicers.readObsChunks(self.obsFile, chunkSize=30))
+        groupedFile = self._groupedObsFile()
+        slicer = slicers.MoObjSlicer(verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=groupedFile)
+        chunks = list(slicers.readObsChunks(groupedFile, chunkSize=30))
+        self.assertTrue(len(chunks) > 1)
+        for i, chunk in enumerate(chunks[:-1]):
+            self.assertTrue(chunk['objId'].values[-1] < chunks[i + 1]['objId'].values[0])
+        allObs = pd.concat(chunks)
+        pd.testing.assert_frame_equal(allObs, pd.read_csv(groupedFile, delim_whitespace=True))
+        # Reading the binary files gives the same observations.
+        binaryDir = os.path.join(self.outDir, 'obs_binary')
+        slicers.convertObsFile(groupedFile, binaryDir, chunkSize=30)
+        binarySlicer = slicers.MoObjSlicer(verbose=False)
+        binarySlicer.setupSlicer(self.orbitFile, obsFile=binaryDir)
+        pd.testing.assert_frame_equal(binarySlicer.allObs, slicer.allObs)
+        for a, b in zip(slicer, binarySlicer):
+            np.testing.assert_array_equal(a['obs'], b['obs'])
+
+    def _runBundles(self, slicer):
+        # Use an SNR limit rather than the (random) visibility, so the results do not depend on the order.
+        bundles = {'nobs': mmb.MoMetricBundle(metrics.NObsMetric(snrLimit=5), slicer, runName='test'),
+                   'arc': mmb.MoMetricBundle(metrics.ObsArcMetric(snrLimit=5), slicer, runName='test'),
+                   'arcLate': mmb.MoMetricBundle(metrics.ObsArcMetric(snrLimit=5), slicer, runName='test',
+                                                 constraint='observationStartMJD > 59605')}
+        bg = mmb.MoMetricBundleGroup(bundles, outDir=os.path.join(self.outDir, 'out'), verbose=False)
+        bg.runAll()
+        return bundles
+
+    def testRunChunks(self):
+        """Test running the metrics on chunks of the observations gives the same metric values."""
+        groupedFile = self._groupedObsFile()
+        Hrange = np.arange(14, 20, 1.)
+        slicer = slicers.MoObjSlicer(Hrange=Hrange, verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=groupedFile)
+        expected = self._runBundles(slicer)
+        slicer = slicers.MoObjSlicer(Hrange=Hrange, verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=groupedFile, chunkSize=25)
+        self.assertIsNone(slicer.allObs)
+        chunked = self._runBundles(slicer)
+        for k in expected:
+            np.testing.assert_array_equal(chunked[k].metricValues.mask, expected[k].metricValues.mask)
+            np.testing.assert_array_equal(chunked[k].metricValues.compressed(),
+                                          expected[k].metricValues.compressed())
+        # The object without observations is masked.
+        self.assertTrue(np.all(chunked['nobs'].metricValues.mask[-1]))
+
+    def _runHBundles(self, **kwargs):
+        Hrange = np.arange(14, 24, 0.5)
+        slicer = slicers.MoObjSlicer(Hrange=Hrange, verbose=False)
+        slicer.setupSlicer(self.orbitFile, obsFile=self.obsFile)
+        discovery = metrics.DiscoveryMetric(nNightsPerWindow=2, tWindow=30)
+        discoverySnr = metrics.DiscoveryMetric(nNightsPerWindow=2, tWindow=30, snrLimit=5,
+                                               metricName='DiscoverySnr')
+        bundles = {'nobs': mmb.MoMetricBundle(metrics.NObsMetric(), slicer, runName='test'),
+                   'nnights': mmb.MoMetricBundle(metrics.NNightsMetric(), slicer, runName='test'),
+                   'arc': mmb.MoMetricBundle(metrics.ObsArcMetric(), slicer, runName='test'),
+                   'discovery': mmb.MoMetricBundle(discovery, slicer, runName='test',
+                                                   stackerList=[stackers.EclStacker()],
+                                                   childMetrics=discovery.childMetrics),
+                   'discoverySnr': mmb.MoMetricBundle(discoverySnr, slicer, runName='test',
+                                                      stackerList=[stackers.EclStacker()],
+                                                      childMetrics=discoverySnr.childMetrics)}
+        bg = mmb.MoMetricBundleGroup(bundles, outDir=os.path.join(self.outDir, 'out'), verbose=False,
+                                     **kwargs)
+        bg.runAll()
+        return bundles
+
+    def _checkSameValues(self, expected, vectorized):
+        for k in expected:
+            bundles = [(expected[k], vectorized[k])]
+            bundles += [(expected[k].childBundles[c], vectorized[k].childBundles[c])
+                        for c in expected[k].childBundles]
+            for b, vb in bundles:
+                np.testing.assert_array_equal(vb.metricValues.mask, b.metricValues.mask)
+                for value, vValue in zip(b.metricValues.compressed(), vb.metricValues.compressed()):
+                    if isinstance(value, dict):
+                        for key in value:
+                            np.testing.assert_array_equal(vValue[key], value[key])
+                    else:
+                        np.testing.assert_array_equal(vValue, value)
+
+    def testRunH(self):
+        """Test calculating the metric values for all H values at once gives the same metric values."""
+        expected = self._runHBundles(vectorizeH=False)
+        vectorized = self._runHBundles(vectorizeH=True)
+        self.assertTrue(vectorized['discovery'].metric.canRunH())
+        self.assertGreater(expected['discovery'].metricValues.count(), 0)
+        self._checkSameValues(expected, vectorized)
+
+    def testRunParallel(self):
+        """Test calculating the metric values in several processes gives the same metric values."""
+        for vectorizeH in (False, True):
+            expected = self._runHBundles(vectorizeH=vectorizeH)
+            parallel = self._runHBundles(vectorizeH=vectorizeH, nProcs=2)
+            self._checkSameValues(expected, parallel)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -9,6 +9,7 @@ import numpy.ma as ma
 import unittest
 from lsst.sims.maf.slicers.opsimFieldSlicer import OpsimFieldSlicer
 from lsst.sims.maf.slicers.uniSlicer import UniSlicer
+import lsst.sims.maf.stackers as stackers
 import warnings
 import lsst.utils.tests
 
@@ -256,6 +257,25 @@ class TestOpsimFieldSlicerSlicing(unittest.TestCase):
                 binidxs = np.sort(binidxs)
                 np.testing.assert_equal(self.simData['testdata'][didxs], self.simData['testdata'][binidxs])
 
+    def testSlicingOpSimFields(self):
+        """Test slicing on the OpSim fields, using the fieldIds from the OpSimFieldStacker."""
+        fields, tree = stackers.getOpSimFields()
+        rng = np.random.RandomState(99)
+        idxs = rng.randint(0, len(fields), 1000)
+        simData = np.zeros(1000, dtype=list(zip(['fieldRA', 'fieldDec'], [float, float])))
+        simData['fieldRA'] = np.degrees(fields['fieldRA'][idxs])
+        simData['fieldDec'] = np.degrees(fields['fieldDec'][idxs])
+        simData = stackers.OpSimFieldStacker().run(simData)
+        slicer = OpsimFieldSlicer(simDataFieldIdColName='opsimFieldId')
+        slicer.setupSlicer(simData)
+        np.testing.assert_array_equal(slicer.slicePoints['sid'], fields['fieldId'])
+        np.testing.assert_array_equal(slicer.slicePoints['ra'], fields['fieldRA'])
+        # The fields are only read once.
+        self.assertIs(stackers.getOpSimFields()[1], tree)
+        for s in slicer:
+            np.testing.assert_array_equal(np.sort(s['idxs']),
+                                          np.where(fields['fieldId'][idxs] == s['slicePoint']['sid'])[0])
+
 
 class TestOpsimFieldSlicerPlotting(unittest.TestCase):
 
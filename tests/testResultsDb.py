@@ -3,9 +3,11 @@ from builtins import range
 import matplotlib
 matplotlib.use("Agg")
 import os
+import sqlite3
 import warnings
 import unittest
 import numpy as np
+from sqlalchemy import text
 import lsst.sims.maf.db as db
 import shutil
 import tempfile
@@ -81,6 +83,94 @@ class TestResultsDb(unittest.TestCase):
             self.assertIn("not save", str(w[-1].message))
         shutil.rmtree(tempdir)
 
+    def _addResults(self, resultsDb):
+        metricIds = []
+        for i in range(3):
+            metricId = resultsDb.updateMetric(self.metricName + str(i), self.slicerName, self.runName,
+                                              self.constraint, self.metadata, self.metricDataFile)
+            metricIds.append(metricId)
+            resultsDb.updateDisplay(metricId, dict(self.displayDict))
+            resultsDb.updateDisplay(metricId, {'group': 'other'}, overwrite=False)
+            resultsDb.updatePlot(metricId, self.plotType, self.plotName)
+            resultsDb.updatePlot(metricId, self.plotType, self.plotName)
+            resultsDb.updateSummaryStat(metricId, self.summaryStatName1, self.summaryStatValue1 + i)
+            resultsDb.updateSummaryStat(metricId, self.summaryStatName3, self.summaryStatValue3)
+        # Adding the same metric again returns the same metricId.
+        metricId = resultsDb.updateMetric(self.metricName + '0', self.slicerName, self.runName,
+                                          self.constraint, self.metadata, self.metricDataFile)
+        self.assertEqual(metricId, metricIds[0])
+        resultsDb.updateDisplay(metricId, {'group': 'replaced', 'caption': 'new'})
+        return metricIds
+
+    def testBatchWrites(self):
+        """Test batched writes give the same database contents as individual writes."""
+        tempdir = tempfile.mkdtemp(prefix='resDb')
+        resultsDb = db.ResultsDb(outDir=tempdir, database='serial.db')
+        self._addResults(resultsDb)
+        batchDb = db.ResultsDb(outDir=tempdir, database='batch.db')
+        with batchDb.batchWrites():
+            metricIds = self._addResults(batchDb)
+            # Nothing has been written yet, except the metrics.
+            self.assertEqual(len(batchDb.getSummaryStats()), 0)
+            self.assertEqual(batchDb.getAllMetricIds(), metricIds)
+        np.testing.assert_array_equal(batchDb.getSummaryStats(), resultsDb.getSummaryStats())
+        np.testing.assert_array_equal(batchDb.getPlotFiles(), resultsDb.getPlotFiles())
+        for rDb in (resultsDb, batchDb):
+            displays = rDb.session.query(db.DisplayRow).order_by(db.DisplayRow.metricId).all()
+            self.assertEqual([d.displayGroup for d in displays], ['replaced', 'seeing', 'seeing'])
+        # A new batch picks up the existing metrics and displays.
+        with batchDb.batchWrites():
+            self.assertEqual(self._addResults(batchDb), metricIds)
+        self.assertEqual(len(batchDb.session.query(db.PlotRow).all()), 3)
+        self.assertEqual(len(batchDb.getSummaryStats()), 2 * len(resultsDb.getSummaryStats()))
+        # The lookup columns are indexed.
+        indexes = batchDb.session.execute(text("select name from sqlite_master where type='index'"))
+        self.assertIn('idx_metrics_lookup', [i[0] for i in indexes])
+        resultsDb.close()
+        batchDb.close()
+        shutil.rmtree(tempdir)
+
+
+    def testPlotFingerprints(self):
+        """Test plot fingerprints are stored, including in databases made before the column existed."""
+        tempdir = tempfile.mkdtemp(prefix='resDb')
+        database = os.path.join(tempdir, 'old.db')
+        # The tables of an older database, without the plot fingerprints or any indexes.
+        with sqlite3.connect(database) as conn:
+            conn.execute('create table metrics (metricId integer primary key, metricName varchar, '
+                         'slicerName varchar, simDataName varchar, sqlConstraint varchar, '
+                         'metricMetadata varchar, metricDataFile varchar)')
+            conn.execute('create table displays (displayId integer primary key, metricId integer, '
+                         'displayGroup varchar, displaySubgroup varchar, displayOrder float, '
+                         'displayCaption varchar)')
+            conn.execute('create table plots (plotId integer primary key, metricId integer, '
+                         'plotType varchar, plotFile varchar)')
+            conn.execute('create table summarystats (statId integer primary key, metricId integer, '
+                         'summaryName varchar, summaryValue float)')
+            conn.execute("insert into metrics values (1, 'Count', 'UniSlicer', 'run', '', '', 'a.npz')")
+            conn.execute("insert into plots values (1, 1, 'SkyMap', 'old_SkyMap.png')")
+            conn.execute("insert into summarystats values (1, 1, 'Mean', 2.5)")
+        with open(database, 'rb') as f:
+            contents = f.read()
+        # Reading the older database does not change it.
+        resultsDb = db.ResultsDb(database=database)
+        self.assertEqual(resultsDb.getPlotFingerprints(), {})
+        self.assertEqual(list(resultsDb.getPlotFiles()['plotFile']), ['old_SkyMap.png'])
+        self.assertEqual(list(resultsDb.getSummaryStats()['summaryValue']), [2.5])
+        resultsDb.close()
+        with open(database, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        # Writing to it adds the missing columns and indexes.
+        resultsDb = db.ResultsDb(database=database)
+        resultsDb.updatePlot(1, self.plotType, self.plotName, plotFingerprint='abc', renderTime=0.5)
+        indexes = resultsDb.session.execute(text("select name from sqlite_master where type='index'"))
+        self.assertIn('idx_plots_metricId', [i[0] for i in indexes])
+        with resultsDb.batchWrites():
+            resultsDb.updatePlot(1, 'SkyMap', 'old_SkyMap.png', plotFingerprint='def')
+        self.assertEqual(resultsDb.getPlotFingerprints(), {'old_SkyMap.png': 'def', self.plotName: 'abc'})
+        resultsDb.close()
+        shutil.rmtree(tempdir)
+
 
 class TestUseResultsDb(unittest.TestCase):
 
@@ -0,0 +1,116 @@
+import matplotlib
+matplotlib.use("Agg")
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import lsst.sims.maf.db as db
+import lsst.utils.tests
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    from lsst.sims.maf.runComparison import RunComparison
+
+
+class TestRunComparison(unittest.TestCase):
+
+    def setUp(self):
+        self.baseDir = tempfile.mkdtemp(prefix='runComp')
+        self.runNames = ['run1', 'run2', 'run3']
+        for i, runName in enumerate(self.runNames):
+            # Results for run1 are split between the run directory and a subdirectory.
+            for outDir in [runName, os.path.join(runName, 'sub')][:2 - min(i, 1)]:
+                resultsDb = db.ResultsDb(outDir=os.path.join(self.baseDir, outDir))
+                for m in range(3):
+                    if outDir.endswith('sub') and m != 2:
+                        continue
+                    metricId = resultsDb.updateMetric('metric%d' % m, 'HealpixSlicer', runName, '',
+                                                      'meta', 'file.npz')
+                    resultsDb.updateSummaryStat(metricId, 'Mean', float(i + m))
+                    resultsDb.updateSummaryStat(metricId, 'Median', float(i * m))
+                    # Only some of the runs have every metric / summary statistic.
+                    if i != 1:
+                        metricId = resultsDb.updateMetric('metric%d' % m, 'OneDSlicer', runName, '',
+                                                          'other', 'file2.npz')
+                        resultsDb.updateSummaryStat(metricId, 'Max', float(i * 10 + m))
+                resultsDb.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.baseDir)
+
+    def _expected(self, rc, colName, metricName, metricMetadata=None, slicerName=None, summaryName=None):
+        """Find the summary statistics by querying each results database for each metric."""
+        expected = {}
+        for r in rc.runlist:
+            for resultsDb in rc.runresults[r].values():
+                mIds = resultsDb.getMetricId(metricName, metricMetadata=metricMetadata,
+                                             slicerName=slicerName)
+                if len(mIds) == 0:
+                    continue
+                stats = resultsDb.getSummaryStats(mIds, summaryName=summaryName)
+                for stat in stats:
+                    name = rc._buildSummaryName(metricName, metricMetadata, slicerName,
+                                                stat['summaryName'])
+                    if len(stats) == 1:
+                        name = colName
+                    expected[(r, name)] = stat['summaryValue']
+        return expected
+
+    def testAddSummaryStats(self):
+        """Test the summary statistics match those found in each results database."""
+        rc = RunComparison(self.baseDir, self.runNames)
+        self.assertEqual(sorted(rc.runresults['run1'].keys()), ['run1', 'sub'])
+        metricDict = {'m0 mean': {'metricName': 'metric0', 'metricMetadata': 'meta',
+                                  'slicerName': 'HealpixSlicer', 'summaryName': 'Mean'},
+                      'm1 healpix': {'metricName': 'metric1', 'metricMetadata': 'meta',
+                                     'slicerName': 'HealpixSlicer'},
+                      'm2': {'metricName': 'metric2', 'metricMetadata': None, 'slicerName': 'OneDSlicer'},
+                      'missing': {'metricName': 'metric5', 'metricMetadata': None, 'slicerName': None}}
+        rc.addSummaryStats(metricDict)
+        self.assertEqual(list(rc.summaryStats.index), rc.runlist)
+        np.testing.assert_array_equal(rc.summaryStats['m0 mean'].values, [0., 1., 2.])
+        for colName, metric in metricDict.items():
+            expected = self._expected(rc, colName, metric['metricName'], metric['metricMetadata'],
+                                      metric['slicerName'], metric['summaryName'])
+            self.assertEqual(len(expected) > 0, metric['metricName'] != 'metric5')
+            for (r, name), value in expected.items():
+                self.assertEqual(rc.summaryStats.loc[r, name], value)
+        # Run2 has no OneDSlicer metrics.
+        self.assertTrue(np.isnan(rc.summaryStats.loc['run2', 'm2']))
+        self.assertEqual(rc.summaryStats.loc['run1', 'm2'], 2.)
+        self.assertEqual(rc.headerStats.loc['SummaryName', 'Mean metric1 meta HealpixSlicer'], 'Mean')
+        rc.close()
+
+    def testStatsCache(self):
+        """Test the summary statistics are cached, and updated when a results database changes."""
+        statsCache = os.path.join(self.baseDir, 'stats.db')
+        rc = RunComparison(self.baseDir, self.runNames, statsCache=statsCache)
+        stats = rc._readSummaryStats()
+        self.assertTrue(os.path.isfile(statsCache))
+        rc.close()
+        rc = RunComparison(self.baseDir, self.runNames, statsCache=statsCache)
+        cached = rc._readSummaryStats()
+        np.testing.assert_array_equal(cached.values, stats.values)
+        # Add a summary statistic to one of the runs, which invalidates the cache.
+        resultsDb = rc.runresults['run2']['run2']
+        resultsDb.updateSummaryStat(resultsDb.getMetricId('metric0')[0], 'Rms', 5.)
+        os.utime(resultsDb.database, (0, os.path.getmtime(resultsDb.database) + 10))
+        rc.addSummaryStats({'rms': {'metricName': 'metric0', 'metricMetadata': None,
+                                    'slicerName': None, 'summaryName': 'Rms'}})
+        self.assertEqual(rc.summaryStats.loc['run2', 'rms'], 5.)
+        self.assertEqual(len(rc._readSummaryStats()), len(stats) + 1)
+        rc.close()
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
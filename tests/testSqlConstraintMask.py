@@ -0,0 +1,58 @@
+from builtins import zip
+import numpy as np
+import unittest
+import lsst.sims.maf.db as db
+import lsst.utils.tests
+
+
+class TestSqlConstraintMask(unittest.TestCase):
+
+    def setUp(self):
+        names = ['night', 'filter', 'fieldDec', 'note']
+        types = [int, (np.str_, 1), float, (np.str_, 10)]
+        rng = np.random.RandomState(12)
+        self.data = np.zeros(500, dtype=list(zip(names, types)))
+        self.data['night'] = rng.randint(0, 100, 500)
+        self.data['filter'] = rng.choice(list('ugrizy'), 500)
+        self.data['fieldDec'] = rng.rand(500) * 180. - 90.
+        self.data['note'] = rng.choice(['DD:COSMOS', 'WFD', 'blob'], 500)
+
+    def testTranslation(self):
+        """Test that supported constraints select the expected rows."""
+        d = self.data
+        tests = {'': np.ones(len(d), dtype=bool),
+                 "filter = 'r'": d['filter'] == 'r',
+                 'filter="r"': d['filter'] == 'r',
+                 'night <= 30 and fieldDec > -20.5': (d['night'] <= 30) & (d['fieldDec'] > -20.5),
+                 "filter = 'g' or (night > 50 AND NOT filter == 'y')":
+                     (d['filter'] == 'g') | ((d['night'] > 50) & ~(d['filter'] == 'y')),
+                 "filter in ('u', 'g') and night != 3": np.in1d(d['filter'], ['u', 'g']) & (d['night'] != 3),
+                 "filter not in ('u', 'g')": ~np.in1d(d['filter'], ['u', 'g']),
+                 'night between 10 and 20': (d['night'] >= 10) & (d['night'] <= 20),
+                 'night not between 10 and 20': (d['night'] < 10) | (d['night'] > 20),
+                 "note <> 'it''s'": d['note'] != "it's",
+                 'fieldDec < -1e1': d['fieldDec'] < -10.}
+        for constraint, expected in tests.items():
+            mask = db.SqlConstraintMask(constraint)
+            np.testing.assert_array_equal(mask(d), expected, err_msg=constraint)
+        self.assertEqual(db.SqlConstraintMask("night < 5 and filter = 'r'").columns, set(['night', 'filter']))
+
+    def testUntranslatable(self):
+        """Test that constraints which can not be translated raise a ValueError."""
+        for constraint in ["note like '%DD%'", 'night < 365 * 2', 'night is null', 'abs(fieldDec) < 10',
+                           "filter = 'r' and", '(night < 3', 'night', 'night < 3)']:
+            with self.assertRaises(ValueError):
+                db.SqlConstraintMask(constraint)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -2,11 +2,15 @@ from __future__ import print_function
 from builtins import str
 from builtins import zip
 import numpy as np
+import ephem
 import matplotlib
 import warnings
 import unittest
+import palpy
 import lsst.utils.tests
 import lsst.sims.maf.stackers as stackers
+import lsst.sims.maf.stackers.coordStackers as coordStackers
+import lsst.sims.maf.utils as utils
 from lsst.sims.utils import _galacticFromEquatorial, calcLmstLast, Site, _altAzPaFromRaDec, \
     ObservationMetaData
 from lsst.sims.survey.fields import FieldsDatabase
@@ -33,6 +37,30 @@ class TestStackerClasses(unittest.TestCase):
             data, cols_present = stacker._addStackerCols(data)
             self.assertEqual(cols_present, True)
 
+    def testAddColsColumnar(self):
+        """Test that columns are added to ColumnarSimData without copying the existing columns.
+        """
+        data = np.zeros(90, dtype=list(zip(['alt', 'night'], [float, int])))
+        data['alt'] = np.arange(0, 90)
+        data['night'] = np.arange(0, 90) // 10
+        simData = utils.ColumnarSimData(data)
+        alt = simData['alt']
+        stacker = stackers.ZenithDistStacker(altCol='alt', degrees=True)
+        newData = stacker.run(simData)
+        self.assertIs(newData, simData)
+        self.assertIs(simData['alt'], alt)
+        self.assertIn(stacker.colsAdded[0], simData.dtype.names)
+        expected = stacker.run(data)
+        np.testing.assert_array_equal(simData['zenithDistance'], expected['zenithDistance'])
+        # Slicing by rows returns the same records as the structured array.
+        idxs = np.array([3, 5, 80])
+        self.assertEqual(simData[idxs].dtype, expected.dtype)
+        np.testing.assert_array_equal(simData[idxs], expected[idxs])
+        np.testing.assert_array_equal(simData[simData['night'] == 2], expected[expected['night'] == 2])
+        np.testing.assert_array_equal(simData[['alt', 'night']], expected[['alt', 'night']])
+        self.assertEqual(simData[4]['night'], expected[4]['night'])
+        np.testing.assert_array_equal(simData.toRecArray(), expected)
+
     def testEQ(self):
         """
         Test that stackers can be compared
@@ -57,6 +85,13 @@ class TestStackerClasses(unittest.TestCase):
         s2 = stackers.RandomDitherFieldPerVisitStacker(decCol='blah')
         assert(s1 != s2)
 
+        # Stackers with public methods (other than run) can also be compared.
+        s1 = stackers.MoMagStacker()
+        s2 = stackers.MoMagStacker()
+        assert(s1 == s2)
+        s2 = stackers.MoMagStacker(gamma=0.039)
+        assert(s1 != s2)
+
     def testNormAirmass(self):
         """
         Test the normalized airmass stacker.
@@ -92,6 +127,30 @@ class TestStackerClasses(unittest.TestCase):
         self.assertGreater(min(np.abs(data['ra_pi_amp'])), 0.)
         self.assertGreater(min(np.abs(data['dec_pi_amp'])), 0.)
 
+    def testParallaxFactorPerVisit(self):
+        """
+        Test the (vectorized) parallax factors match calculating them for each visit with palpy.
+        """
+        rng = np.random.RandomState(32)
+        data = np.zeros(300, dtype=list(zip(['fieldRA', 'fieldDec', 'observationStartMJD'],
+                                            [float, float, float])))
+        data['fieldRA'] = rng.rand(300) * 360.
+        data['fieldDec'] = np.degrees(np.arcsin(rng.rand(300) * 2. - 1.))
+        data['observationStartMJD'] = 59853. + rng.rand(300) * 3650.
+        stacker = stackers.ParallaxFactorStacker(degrees=True)
+        stacker.blockSize = 70
+        data = stacker.run(data)
+        ra = np.radians(data['fieldRA'])
+        dec = np.radians(data['fieldDec'])
+        for i in range(len(data)):
+            amprms = palpy.mappa(2000., data['observationStartMJD'][i])
+            ra1, dec1 = palpy.mapqk(ra[i], dec[i], 0., 0., 1., 0., amprms)
+            ra0, dec0 = palpy.mapqk(ra[i], dec[i], 0., 0., 0., 0., amprms)
+            x1, y1 = stacker._gnomonic_project_toxy(ra1, dec1, ra[i], dec[i])
+            x0, y0 = stacker._gnomonic_project_toxy(ra0, dec0, ra[i], dec[i])
+            self.assertAlmostEqual(data['ra_pi_amp'][i], np.degrees(x1 - x0) * 3600., delta=1e-6)
+            self.assertAlmostEqual(data['dec_pi_amp'][i], np.degrees(y1 - y0) * 3600., delta=1e-6)
+
     def _tDitherRange(self, diffsra, diffsdec, ra, dec, maxDither):
         self.assertLessEqual(np.abs(diffsra).max(), maxDither)
         self.assertLessEqual(np.abs(diffsdec).max(), maxDither)
@@ -244,6 +303,57 @@ class TestStackerClasses(unittest.TestCase):
         self._tDitherPerNight(diffsra, diffsdec, data['fieldRA'],
                               data['fieldDec'], data['night'])
 
+    def testGroupIndices(self):
+        """
+        Test numbering the visits within each field.
+        """
+        rng = np.random.RandomState(42)
+        fieldIds = rng.randint(0, 50, 1000)
+        nights = rng.randint(0, 100, 1000)
+        stacker = stackers.BaseDitherStacker()
+        perVisit = stacker._groupIndices(fieldIds)
+        perNight = stacker._groupIndices(fieldIds, nights)
+        for fieldId in np.unique(fieldIds):
+            match = np.where(fieldIds == fieldId)[0]
+            np.testing.assert_array_equal(perVisit[match], np.arange(len(match)))
+            np.testing.assert_array_equal(perNight[match],
+                                          np.searchsorted(np.unique(nights[match]), nights[match]))
+        self.assertEqual(len(stacker._groupIndices(np.array([], int), np.array([], int))), 0)
+
+    def testDitherFieldPerNight(self):
+        """
+        Test the per-field dither patterns step through the offsets for each field.
+        """
+        maxDither = 0.5
+        ndata = 2000
+        rng = np.random.RandomState(42)
+        data = np.zeros(ndata, dtype=list(zip(['fieldRA', 'fieldDec', 'fieldId', 'night'],
+                                              [float, float, int, int])))
+        data['fieldId'] = rng.randint(0, 30, ndata)
+        data['fieldRA'] = data['fieldId'] * 5. + 30.
+        data['fieldDec'] = data['fieldId'] * 2. - 60.
+        data['night'] = np.sort(rng.randint(0, 300, ndata))
+        for stackerClass, nightly in ((stackers.RandomDitherFieldPerNightStacker, True),
+                                      (stackers.SpiralDitherFieldPerVisitStacker, False),
+                                      (stackers.SpiralDitherFieldPerNightStacker, True),
+                                      (stackers.HexDitherFieldPerVisitStacker, False),
+                                      (stackers.HexDitherFieldPerNightStacker, True)):
+            stacker = stackerClass(maxDither=maxDither)
+            result = stacker.run(data.copy())
+            raCol, decCol = stacker.colsAdded
+            diffsra = (result[raCol] - data['fieldRA']) * np.cos(np.radians(data['fieldDec']))
+            diffsdec = result[decCol] - data['fieldDec']
+            self.assertLessEqual(np.sqrt(diffsra**2 + diffsdec**2).max(), maxDither)
+            for fieldId in np.unique(data['fieldId']):
+                match = np.where(data['fieldId'] == fieldId)[0]
+                if nightly:
+                    vertexIdxs = np.searchsorted(np.unique(data['night'][match]), data['night'][match])
+                else:
+                    vertexIdxs = np.arange(len(match))
+                vertexIdxs = vertexIdxs % len(stacker.xOff)
+                np.testing.assert_allclose(np.radians(diffsra[match]), stacker.xOff[vertexIdxs], atol=1e-10)
+                np.testing.assert_allclose(np.radians(diffsdec[match]), stacker.yOff[vertexIdxs], atol=1e-10)
+
     def testRandomRotDitherPerFilterChangeStacker(self):
         """
         Test the rotational dither stacker.
@@ -338,6 +448,134 @@ class TestStackerClasses(unittest.TestCase):
         check_pa = np.degrees(check_pa)
         np.testing.assert_array_almost_equal(data['PA'], check_pa, decimal=0)
 
+    def testEclipticStacker(self):
+        """
+        Test the ecliptic coordinates match those calculated with ephem for each visit.
+        """
+        rng = np.random.RandomState(43)
+        data = np.zeros(200, dtype=list(zip(['fieldRA', 'fieldDec', 'observationStartMJD'],
+                                            [float, float, float])))
+        data['fieldRA'] = rng.rand(200) * 360.
+        data['fieldDec'] = np.degrees(np.arcsin(rng.rand(200) * 2. - 1.))
+        data['observationStartMJD'] = 59853. + rng.rand(200) * 3650.
+        for subtractSunLon in (False, True):
+            stacker = stackers.EclipticStacker(subtractSunLon=subtractSunLon)
+            result = stacker.run(data.copy())
+            for i, visit in enumerate(data):
+                ecl = ephem.Ecliptic(ephem.Equatorial(np.radians(visit['fieldRA']),
+                                                      np.radians(visit['fieldDec']), epoch=ephem.J2000))
+                lon = ecl.lon
+                if subtractSunLon:
+                    sun = ephem.Sun(stackers.mjd2djd(visit['observationStartMJD']))
+                    lon = lon - ephem.Ecliptic(sun).lon
+                self.assertAlmostEqual(result['eclipLat'][i], np.degrees(ecl.lat), places=8)
+                dlon = (result['eclipLon'][i] - np.degrees(lon) + 180.) % 360. - 180.
+                self.assertAlmostEqual(dlon, 0., places=7)
+            self.assertTrue(np.all((result['eclipLon'] >= 0) & (result['eclipLon'] < 360.)))
+        # In radians.
+        stacker = stackers.EclipticStacker(raCol='ra', decCol='dec', degrees=False)
+        radData = np.zeros(3, dtype=list(zip(['ra', 'dec', 'observationStartMJD'], [float, float, float])))
+        radData['ra'] = [0, np.pi / 2., np.pi]
+        result = stacker.run(radData)
+        np.testing.assert_allclose(result['eclipLat'], [0, -np.radians(23.4392911), 0], atol=1e-12)
+        np.testing.assert_allclose(result['eclipLon'], [0, np.pi / 2., np.pi], atol=1e-12)
+
+    def testRaDecCoords(self):
+        """
+        Test the (shared) coordinate transformations.
+        """
+        rng = np.random.RandomState(87)
+        ra = rng.rand(500) * 2. * np.pi
+        dec = np.arcsin(rng.rand(500) * 2. - 1.)
+        mjd = 59853. + rng.rand(500) * 365.
+        lat = np.radians(-30.2)
+        lon = np.radians(-70.7)
+        with stackers.sharedRaDecCoords():
+            coords = stackers.getRaDecCoords(ra, dec, mjd)
+            # The same positions (even in a different array) reuse the same coordinates.
+            self.assertIs(stackers.getRaDecCoords(ra.copy(), dec), coords)
+            self.assertIs(stackers.getRaDecCoords(ra), coords)
+            alt, az = stackers.raDec2AltAz(ra, dec, lat, lon, mjd)
+            self.assertIs(stackers.getRaDecCoords(ra, dec, mjd), coords)
+            # The hour angle stacker reuses (rather than replaces) the coordinates of the same visits.
+            data = np.zeros(len(ra), dtype=list(zip(['observationStartLST', 'fieldRA'], [float, float])))
+            data['fieldRA'] = ra
+            stackers.HourAngleStacker(degrees=False).run(data)
+            self.assertIs(stackers.getRaDecCoords(ra, dec, mjd), coords)
+        # The hour angle stacker shares its coordinates with the transformations which follow it.
+        with stackers.sharedRaDecCoords():
+            stackers.HourAngleStacker(degrees=False).run(data)
+            self.assertIsNotNone(coordStackers._raDecCoordsCache['coords'])
+            self.assertIs(stackers.getRaDecCoords(ra, dec), coordStackers._raDecCoordsCache['coords'])
+        # The coordinates are only shared (and kept) within sharedRaDecCoords.
+        self.assertIsNot(stackers.getRaDecCoords(ra, dec, mjd), coords)
+        self.assertIsNone(coordStackers._raDecCoordsCache['coords'])
+        lmst, last = calcLmstLast(mjd, lon)
+        ha = np.radians(lmst * 15.) - ra
+        expectedAlt = np.arcsin(np.sin(dec) * np.sin(lat) + np.cos(dec) * np.cos(lat) * np.cos(ha))
+        np.testing.assert_allclose(alt, expectedAlt, atol=1e-10)
+        # Azimuth is measured from north through east.
+        x = np.cos(dec) * np.sin(-ha)
+        y = np.sin(dec) * np.cos(lat) - np.cos(dec) * np.sin(lat) * np.cos(ha)
+        expectedAz = np.arctan2(x, y) % (2. * np.pi)
+        dAz = (az - expectedAz + np.pi) % (2. * np.pi) - np.pi
+        np.testing.assert_allclose(dAz, 0, atol=1e-6)
+        # A single position at several times is broadcast against the times.
+        times = np.array([59000., 59000.3])
+        alt, az = stackers.raDec2AltAz(0.5, 0.3, lat, lon, times)
+        for i, t in enumerate(times):
+            altT, azT = stackers.raDec2AltAz(np.array([0.5]), np.array([0.3]), lat, lon, t)
+            np.testing.assert_allclose([alt[i], az[i]], [altT[0], azT[0]], atol=1e-12)
+        # Changing the positions makes new coordinates.
+        dec2 = dec.copy()
+        dec2[0] += 0.1
+        with stackers.sharedRaDecCoords():
+            coords = stackers.getRaDecCoords(ra, dec)
+            newCoords = stackers.getRaDecCoords(ra, dec2)
+        self.assertIsNot(newCoords, coords)
+        np.testing.assert_array_equal(newCoords.sinDec, np.sin(dec2))
+        # Counting the visible sites matches checking the altitude at each site and time.
+        sites = np.radians([[-30.2, -70.7], [19.8, -155.5], [28.8, -17.9]])
+        steps = np.array([0., 0.25])
+        coords = stackers.RaDecCoords(ra, dec, mjd)
+        coords.blockSize = 100
+        counts = coords.countVisible(sites[:, 0], sites[:, 1], steps, np.radians(30.), weights=[1, 3, 1])
+        expected = np.zeros(len(ra), int)
+        for (siteLat, siteLon), weight in zip(sites, [1, 3, 1]):
+            visible = np.zeros(len(ra), bool)
+            for step in steps:
+                alt, az = stackers.RaDecCoords(ra, dec, mjd + step).altAz(siteLat, siteLon, altonly=True)
+                visible |= alt >= np.radians(30.)
+            expected += weight * visible
+        np.testing.assert_array_equal(counts, expected)
+        self.assertGreater(len(np.unique(counts)), 3)
+
+    def testNFollowStacker(self):
+        """
+        Test the number of telescopes which can follow up each visit.
+        """
+        rng = np.random.RandomState(88)
+        data = np.zeros(300, dtype=list(zip(['fieldRA', 'fieldDec', 'observationStartMJD'],
+                                            [float, float, float])))
+        data['fieldRA'] = rng.rand(300) * 360.
+        data['fieldDec'] = np.degrees(np.arcsin(rng.rand(300) * 2. - 1.))
+        data['observationStartMJD'] = 59853. + rng.rand(300) * 365.
+        stacker = stackers.NFollowStacker(minSize=6.5, airmassLimit=2.0)
+        data = stacker.run(data)
+        expected = np.zeros(len(data), int)
+        for telescope in stacker.telescopes:
+            followed = np.zeros(len(data), bool)
+            for step in stacker.timeSteps:
+                alt, az = stackers.raDec2AltAz(np.radians(data['fieldRA']), np.radians(data['fieldDec']),
+                                               np.radians(telescope['lat']), np.radians(telescope['lon']),
+                                               data['observationStartMJD'] + step / 24., altonly=True)
+                airmass = 1. / np.cos(np.pi / 2. - alt)
+                followed |= (airmass <= 2.0) & (airmass >= 1.)
+            expected += followed
+        np.testing.assert_array_equal(data['nObservatories'], expected)
+        self.assertEqual(data['nObservatories'].max(), len(stacker.telescopes))
+        self.assertLess(data['nObservatories'].min(), len(stacker.telescopes))
+
     def testFilterColorStacker(self):
         """Test the filter color stacker."""
         data = np.zeros(60, dtype=list(zip(['filter'], ['<U1'])))
@@ -437,6 +675,39 @@ class TestStackerClasses(unittest.TestCase):
 
         self.assertGreater(new_data['opsimFieldId'].max(), 0)
 
+    def testOpSimFieldStackerNearest(self):
+        """
+        Test the OpSimFieldStacker finds the closest field, or none at all.
+        """
+        fields, tree = stackers.getOpSimFields()
+        s = stackers.OpSimFieldStacker(raCol='ra', decCol='dec', degrees=False)
+        self.assertIs(s.tree, tree)
+        self.assertEqual(s, stackers.OpSimFieldStacker(raCol='ra', decCol='dec', degrees=False))
+        rng = np.random.RandomState(812352)
+        data = np.zeros(2000, dtype=list(zip(['ra', 'dec'], [float, float])))
+        data['ra'] = rng.rand(2000) * 2. * np.pi
+        data['dec'] = np.arcsin(rng.rand(2000) * 2. - 1.)
+        data = s.run(data)
+        self.assertEqual(data['opsimFieldId'].dtype.kind, 'i')
+        # Compare with the angular distance to every field.
+        dist = np.arccos(np.clip(np.outer(np.sin(data['dec']), np.sin(fields['fieldDec'])) +
+                                 np.outer(np.cos(data['dec']), np.cos(fields['fieldDec'])) *
+                                 np.cos(data['ra'][:, np.newaxis] - fields['fieldRA']), -1, 1))
+        closest = np.argmin(dist, axis=1)
+        inField = dist[np.arange(len(data)), closest] <= np.radians(1.75)
+        np.testing.assert_array_equal(data['opsimFieldId'][inField], fields['fieldId'][closest[inField]])
+        np.testing.assert_array_equal(data['opsimFieldId'][~inField], -666)
+
+    def testOrderStackers(self):
+        """Test that stackers are ordered so the columns they need are added first."""
+        stackerList = [stackers.ParallacticAngleStacker(raCol='randomDitherPerNightRa',
+                                                        decCol='randomDitherPerNightDec'),
+                       stackers.ZenithDistStacker(),
+                       stackers.RandomDitherPerNightStacker()]
+        ordered = stackers.orderStackers(stackerList)
+        self.assertEqual([s.__class__.__name__ for s in ordered],
+                         ['ZenithDistStacker', 'RandomDitherPerNightStacker', 'ParallacticAngleStacker'])
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
@@ -5,6 +5,8 @@ import numpy as np
 import healpy as hp
 import unittest
 import lsst.sims.maf.metrics as metrics
+import lsst.sims.maf.slicers as slicers
+import lsst.sims.maf.metricBundles as metricBundles
 import lsst.utils.tests
 
 
@@ -101,6 +103,53 @@ class TestSummaryMetrics(unittest.TestCase):
         np.testing.assert_equal(result, 0.0)
 
 
+    def _summaryMetrics(self):
+        return [metrics.MeanMetric(), metrics.RmsMetric(), metrics.MedianMetric(), metrics.MaxMetric(),
+                metrics.MinMetric(), metrics.NoutliersNsigmaMetric(nSigma=1.5),
+                metrics.NoutliersNsigmaMetric(nSigma=-1.), metrics.CountMetric(), metrics.SumMetric(),
+                metrics.FullRangeMetric(), metrics.RobustRmsMetric(),
+                metrics.PercentileMetric(percentile=25), metrics.PercentileMetric(percentile=75),
+                metrics.PercentileMetric(percentile=33.3)]
+
+    def testRunSummary(self):
+        """Test summary statistics calculated with runSummary match those calculated with run."""
+        rng = np.random.RandomState(662)
+        floats = rng.rand(101)
+        # Include repeated values and a nan.
+        withNan = np.concatenate([floats[:50], floats[:10], [np.nan]])
+        for values in [floats, floats[:100], floats[:1], rng.randint(0, 20, 50), withNan]:
+            summaryValues = metrics.SummaryValues(values)
+            for metric in self._summaryMetrics():
+                metric.colname = 'metricdata'
+                self.assertTrue(metric.canRunSummary())
+                np.testing.assert_equal(metric.runSummary(summaryValues), metric.run(summaryValues.records))
+        # Summary metrics which do not implement runSummary (or override run) use run.
+        self.assertFalse(metrics.TableFractionMetric().canRunSummary())
+        self.assertFalse(metrics.AbsMeanMetric().canRunSummary())
+
+    def testComputeSummaryStats(self):
+        """Test the summary statistics of a metric bundle."""
+        rng = np.random.RandomState(2412)
+        slicer = slicers.HealpixSlicer(nside=4, verbose=False)
+        summaryMetrics = self._summaryMetrics() + [metrics.MeanMetric(maskVal=0, metricName='MeanMask'),
+                                                   metrics.TableFractionMetric()]
+        bundle = metricBundles.MetricBundle(metrics.MeanMetric('airmass'), slicer, '',
+                                            summaryMetrics=summaryMetrics)
+        values = rng.rand(slicer.nslice)
+        bundle.metricValues = np.ma.MaskedArray(data=values, mask=values < 0.2, fill_value=slicer.badval)
+        bundle.computeSummaryStats()
+        self.assertEqual(len(bundle.summaryValues), len(summaryMetrics))
+        for metric in summaryMetrics:
+            summaryName = metric.name.replace(' metricdata', '').replace(' None', '')
+            # Summary metrics with a maskVal use the masked values too.
+            if hasattr(metric, 'maskVal'):
+                values = bundle.metricValues.filled(metric.maskVal)
+            else:
+                values = bundle.metricValues.compressed()
+            expected = metric.run(np.array(values, dtype=[('metricdata', float)]))
+            np.testing.assert_equal(bundle.summaryValues[summaryName], expected)
+
+
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
 
@@ -1,4 +1,7 @@
 from builtins import zip
+import os
+import shutil
+import tempfile
 import numpy as np
 import numpy.ma as ma
 import matplotlib
@@ -6,6 +9,8 @@ matplotlib.use("Agg")
 import healpy as hp
 import unittest
 import lsst.sims.maf.slicers as slicers
+import lsst.sims.maf.metrics as metrics
+import lsst.sims.maf.metricBundles as metricBundles
 import lsst.utils.tests
 
 
@@ -164,6 +169,99 @@ class TestSlicers(unittest.TestCase):
             np.testing.assert_almost_equal(dataBack, metricdata)
 
 
+    def _checkNpyFormat(self, slicer, metricValues):
+        """Check metric values saved in the npy format read back the same as those saved as npz."""
+        outDir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(outDir, 'test.npz')
+            slicer.writeData(filename, metricValues, metadata='testdata', plotDict={'units': 'mag'})
+            expected, expectedSlicer, expectedHeader = self.baseslicer.readData(filename)
+            dirname = os.path.join(outDir, 'test.npyd')
+            slicer.writeData(dirname, metricValues, metadata='testdata', plotDict={'units': 'mag'},
+                             fileFormat='npy')
+            self.assertTrue(os.path.isfile(os.path.join(dirname, 'header.json')))
+            metricValuesBack, slicerBack, header = self.baseslicer.readData(dirname)
+            self.assertEqual(slicerBack, expectedSlicer)
+            self.assertEqual(header, expectedHeader)
+            self.assertEqual(metricValuesBack.shape, expected.shape)
+            np.testing.assert_array_equal(ma.getmaskarray(metricValuesBack), ma.getmaskarray(expected))
+            for key in expectedSlicer.slicePoints:
+                np.testing.assert_array_equal(slicerBack.slicePoints[key], expectedSlicer.slicePoints[key])
+            if expected.dtype != object:
+                np.testing.assert_array_equal(metricValuesBack, expected)
+            else:
+                for value, valueBack in zip(expected.compressed(), metricValuesBack.compressed()):
+                    if isinstance(value, dict):
+                        self.assertEqual(sorted(value.keys()), sorted(valueBack.keys()))
+                        for key in value:
+                            np.testing.assert_array_equal(valueBack[key], value[key])
+                    else:
+                        np.testing.assert_array_equal(valueBack, value)
+            return metricValuesBack
+        finally:
+            shutil.rmtree(outDir)
+
+    def test_npyFormat(self):
+        rng = np.random.RandomState(2121)
+        nside = 16
+        slicer = slicers.HealpixSlicer(nside=nside)
+        metricValues = rng.rand(slicer.nslice)
+        masked = ma.MaskedArray(data=metricValues, mask=np.where(metricValues < .1, True, False),
+                                fill_value=slicer.badval)
+        # Numeric metric values are memory-mapped.
+        self.assertIsInstance(self._checkNpyFormat(slicer, masked).data, np.memmap)
+        self._checkNpyFormat(slicer, metricValues)
+        # Dicts of scalars, fixed length arrays and variable length arrays are saved as columns.
+        values = np.empty(slicer.nslice, dtype='object')
+        for i in range(slicer.nslice):
+            values[i] = {'a': i * 2., 'b': np.array([i, i + 1]), 'c': np.arange(i % 4)}
+        objectValues = ma.MaskedArray(data=values, mask=masked.mask, fill_value=slicer.badval)
+        self._checkNpyFormat(slicer, objectValues)
+        # As are arrays of different lengths.
+        for i in range(slicer.nslice):
+            values[i] = np.arange(i % 5) * 1.5
+        self._checkNpyFormat(slicer, values)
+        # Other objects are pickled.
+        for i in range(slicer.nslice):
+            values[i] = {'name': 'value %d' % i}
+        self._checkNpyFormat(slicer, values)
+        # Other slicers.
+        slicer = slicers.OneDSlicer(sliceColName='testdata')
+        dataValues = np.zeros(1000, dtype=[('testdata', 'float')])
+        dataValues['testdata'] = rng.rand(1000)
+        slicer.setupSlicer(dataValues)
+        self._checkNpyFormat(slicer, rng.rand(slicer.nslice))
+        slicer = slicers.UniSlicer()
+        slicer.setupSlicer(dataValues)
+        self._checkNpyFormat(slicer, np.array([25.]))
+
+    def test_npyMetricBundle(self):
+        rng = np.random.RandomState(522)
+        slicer = slicers.HealpixSlicer(nside=8)
+        bundle = metricBundles.MetricBundle(metrics.MeanMetric('testdata'), slicer, 'night < 10',
+                                            runName='testRun', plotDict={'units': 'mag'})
+        bundle.metricValues = ma.MaskedArray(data=rng.rand(slicer.nslice), mask=np.zeros(slicer.nslice, bool),
+                                             fill_value=slicer.badval)
+        outDir = tempfile.mkdtemp()
+        try:
+            bundle.write(outDir=outDir, fileFormat='npy')
+            filename = os.path.join(outDir, bundle.fileRoot + '.npyd')
+            self.assertTrue(os.path.isdir(filename))
+            bundleBack = metricBundles.createEmptyMetricBundle()
+            bundleBack.read(filename)
+            self.assertEqual(bundleBack.fileRoot, bundle.fileRoot)
+            self.assertEqual(bundleBack.metric.name, bundle.metric.name)
+            self.assertEqual(bundleBack.metric.units, 'mag')
+            self.assertEqual(bundleBack.constraint, bundle.constraint)
+            np.testing.assert_array_equal(bundleBack.metricValues, bundle.metricValues)
+            # The metric values can be modified, without changing the file on disk.
+            bundleBack.metricValues[0] = -1
+            bundleBack.read(filename)
+            self.assertEqual(bundleBack.metricValues[0], bundle.metricValues[0])
+        finally:
+            shutil.rmtree(outDir)
+
+
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
 